@@ -7,45 +7,145 @@
 Mission Application API for Python Mission Applications.
 """
 
+import asyncio
+from collections import deque
+import concurrent.futures
+import functools
+import gzip
+import hashlib
 import json
 import logging
+import re
 from logging.handlers import SysLogHandler
 import requests
+from requests.adapters import HTTPAdapter
 import socket
+import struct
 import sys
+import threading
+import time
 import toml
+from urllib3.exceptions import ProtocolError
+from urllib3.util import make_headers
+import zlib
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 SERVICE_CONFIG_PATH = "/etc/kubos-config.toml"
 UDP_BUFF_LEN = 1024
 DEFAULT_TIMEOUT = 10.0  # Seconds
+DEFAULT_POOL_SIZE = 4
+# Seconds. Below the services' default keep-alive of 5 seconds, so idle
+# connections are dropped before the service closes them
+DEFAULT_IDLE_TIMEOUT = 4.0
+# Threads running the requests of Services.query_many
+QUERY_MANY_WORKERS = 8
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+CBOR_MIMETYPE = "application/cbor"
+# Content encodings the HTTP client can decode
+ACCEPT_ENCODING = make_headers(accept_encoding=True)['accept-encoding']
+# Content encodings AsyncServices can decode
+ASYNC_ACCEPT_ENCODING = "gzip, deflate"
+# Times a UDP request is sent again while waiting for its response
+DEFAULT_UDP_RETRIES = 2
+# Seconds a UDP query keeps for sending its full text after a persisted
+# query hash, however long the hash took to be answered
+MIN_UDP_TIMEOUT = 1.0
+# Largest UDP payload over IPv4
+MAX_DATAGRAM = 65507
+# Datagram framing of UDP services, as in kubos_service.udp_service
+FRAME_MAGIC = 0xCB
+FRAME_HEADER = struct.Struct('>BBIHH')
+FLAG_CBOR = 0x01
+# telemetry-service reads direct UDP inserts into a 4096 byte buffer
+TELEMETRY_DATAGRAM = 4096
+INSERT_BULK = (
+    'mutation ($entries: [InsertEntry!]!) '
+    '{ insertBulk(entries: $entries) { success, errors } }')
+# Strings, comments, braces and names of a GraphQL document
+GRAPHQL_TOKEN = re.compile(
+    r'"""[\s\S]*?"""|"(?:\\.|[^"\\])*"|#[^\n]*|[{}]|[_A-Za-z][_0-9A-Za-z]*')
+
+
+@functools.lru_cache(maxsize=256)
+def query_hash(query):
+    """Return the SHA-256 hash identifying a persisted query"""
+    return hashlib.sha256(query.encode()).hexdigest()
+
 
+@functools.lru_cache(maxsize=256)
+def _is_mutation(query):
+    """Return whether a GraphQL document holds a mutation"""
+    depth = 0
+    for match in GRAPHQL_TOKEN.finditer(query):
+        token = match.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+        elif depth == 0 and token == "mutation":
+            return True
+    return False
 
-class Services:
 
-    def __init__(self, service_config_filepath=SERVICE_CONFIG_PATH):
+class _Client:
+    """Configuration, request checks and response parsing shared by the clients"""
+
+    def __init__(self, service_config_filepath, persisted_queries, encoding,
+                 compression, pool_size, idle_timeout, udp_retries):
+        if encoding not in ["json", "cbor"]:
+            raise ValueError("Encoding must be 'json' or 'cbor'.")
+        if encoding == "cbor" and cbor2 is None:
+            raise ImportError("CBOR encoding requires the cbor2 package.")
         self.config = toml.load(service_config_filepath)
+        self.persisted_queries = persisted_queries
+        self.encoding = encoding
+        self.compression = compression
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.udp_retries = udp_retries
+        # (ip, port) of services without persisted query support
+        self._unpersisted = set()
+        self._request_id = 0
+        self._request_id_lock = threading.Lock()
 
-    def query(self, service, query, timeout=DEFAULT_TIMEOUT):
-        """Send a GraphQL request to a service
-        
-        Args:
-        
-            - service (str): The service that the request should be sent to. Must be defined in
-              the system's ``config.toml`` file
-            - query (str): The GraphQL request
-            - timeout (int): The amount of time that this function should wait for a response from the
-              service
-        
-        Returns:
-            The JSON response from the service
-            
-        Raises:
-            EnvironmentError: An error was returned within the JSON response from the service
-            KeyError: The `service` value was invalid
-            TimeoutError: The function timed out while waiting for a response from teh service
-            TypeError: The `query` value was invalid
-            
-        """
+    def _transport(self, service):
+        transport = self.config[service].get("transport", "http")
+        if transport not in ["http", "udp"]:
+            raise ValueError(
+                "{} transport must be 'http' or 'udp'.".format(service))
+        return transport
+
+    def _datagram(self, body):
+        # A framed request: a single fragment with a new request id
+        with self._request_id_lock:
+            self._request_id = (self._request_id + 1) & 0xFFFFFFFF
+            request_id = self._request_id
+        if self.encoding == "cbor":
+            (flags, payload) = (FLAG_CBOR, cbor2.dumps(body))
+        else:
+            (flags, payload) = (0, json.dumps(body).encode())
+        return (request_id, FRAME_HEADER.pack(FRAME_MAGIC, flags, request_id, 0, 1) + payload)
+
+    def _reassemble(self, fragments, data, request_id):
+        # Returns the decoded response once every fragment has arrived
+        if len(data) < FRAME_HEADER.size or data[0] != FRAME_MAGIC:
+            # Services without framing answer with one plain datagram
+            return self._body(data, '')
+        (_, flags, response_id, index, count) = FRAME_HEADER.unpack_from(data)
+        if response_id != request_id or index >= count:
+            # A late response to an earlier request
+            return None
+        fragments[index] = data[FRAME_HEADER.size:]
+        if len(fragments) < count:
+            return None
+        content = b"".join(fragments[index] for index in range(count))
+        return self._body(content, CBOR_MIMETYPE if flags & FLAG_CBOR else '')
+
+    def _endpoint(self, service, query):
         # Check inputs
         if service not in self.config:
             raise KeyError(
@@ -59,10 +159,9 @@ class Services:
         # Lookup port/ip
         ip = self.config[service]["addr"]["ip"]
         port = self.config[service]["addr"]["port"]
+        return (query, ip, port)
 
-        # Talk to the server
-        response = self._http_query(query, ip, port, timeout)
-
+    def _result(self, response, service):
         # Format the response and detect errors
         (data, errors) = self._format(response, service)
 
@@ -72,30 +171,45 @@ class Services:
                 "{} Endpoint Error: {}".format(service, errors))
 
         return data
-    
-    def _http_query(self, query, ip, port, timeout):
-        
-        # Service connection info
-        url = "http://{}:{}".format(ip, port)
-        
-        # Put our query in the message body as JSON
-        body = {'query':query} 
-        
-        # Send the request and wait for the response
-        response = requests.post(str.encode(url), json=body, timeout=timeout)
-        
-        # Make sure that we got a good response
-        response.raise_for_status()
-        
-        # Return the good message body
-        return response.text
+
+    def _body(self, content, content_type):
+        # CBOR responses are decoded here, JSON ones by _format
+        if content_type.startswith(CBOR_MIMETYPE):
+            return cbor2.loads(content)
+        return content.decode() if isinstance(content, bytes) else content
+
+    def _persisted_status(self, response):
+        # Classifies the decoded response to a request holding only a
+        # query's hash: "found" if the query ran, "missing" if the service
+        # doesn't know the hash, or "unsupported" if the service failed the
+        # request without running it, as services without persisted
+        # queries do
+        if isinstance(response, (str, bytes)):
+            try:
+                response = json.loads(response)
+            except ValueError:
+                return "unsupported"
+        if not isinstance(response, dict):
+            return "unsupported"
+        errors = response.get('errors')
+        if errors and PERSISTED_QUERY_NOT_FOUND in str(errors):
+            return "missing"
+        if errors and response.get('data') is None:
+            return "unsupported"
+        return "found"
+
+    def _remaining(self, timeout, started):
+        # What's left of a UDP query's timeout for its second request
+        return max(timeout - (time.monotonic() - started),
+                   min(timeout, MIN_UDP_TIMEOUT))
 
     def _format(self, response, service):
         
         
         # Parse JSON response
         try:
-            response = json.loads(response)
+            if type(response) in [str, bytes]:
+                response = json.loads(response)
         except Exception as e:
             print("Response was unable to be parsed as JSON.")
             print("It is likely incomplete or the endpoint is misbehaving")
@@ -128,6 +242,925 @@ class Services:
 
         return (data, errors)
 
+
+class Services(_Client):
+
+    def __init__(self, service_config_filepath=SERVICE_CONFIG_PATH,
+                 persisted_queries=False, encoding="json", compression=True,
+                 pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 udp_retries=DEFAULT_UDP_RETRIES):
+        """
+        Args:
+
+            - service_config_filepath (str): The system's ``config.toml`` file
+            - persisted_queries (bool): Send the hash of each query instead of its text.
+              Services that don't know the hash are sent the full text once
+            - encoding (str): ``"json"``, or ``"cbor"`` to ask services for CBOR encoded
+              responses, which are smaller and faster to decode. Requires the ``cbor2``
+              package. Services without CBOR support still answer in JSON
+            - compression (bool): Accept compressed responses, which are decoded
+              transparently
+            - pool_size (int): The number of keep-alive connections kept open to each service
+            - idle_timeout (float): Seconds after which unused connections to a service are
+              closed. ``0`` keeps them until the service closes them
+            - udp_retries (int): The number of times a request to a UDP service is sent again
+              while waiting for its response. Mutations are sent once, as they may have run
+              even if their response was lost
+
+        Services are queried over HTTP, or over UDP if their section of the config file
+        sets ``transport = "udp"``.
+
+        Raises:
+            ImportError: ``"cbor"`` encoding was requested but ``cbor2`` isn't installed
+            ValueError: The `encoding` value was invalid
+        """
+        _Client.__init__(self, service_config_filepath, persisted_queries,
+                         encoding, compression, pool_size, idle_timeout,
+                         udp_retries)
+        # url -> [requests.Session, time last used]
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._executor = None
+
+    def close(self):
+        """Close the connections kept open to services"""
+        with self._sessions_lock:
+            for (session, _) in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def query(self, service, query, timeout=DEFAULT_TIMEOUT, variables=None):
+        """Send a GraphQL request to a service
+        
+        Args:
+        
+            - service (str): The service that the request should be sent to. Must be defined in
+              the system's ``config.toml`` file
+            - query (str): The GraphQL request
+            - timeout (int): The amount of time that this function should wait for a response from the
+              service
+            - variables (dict): Values of the variables used by the request
+        
+        Returns:
+            The JSON response from the service
+            
+        Raises:
+            EnvironmentError: An error was returned within the JSON response from the service
+            KeyError: The `service` value was invalid
+            TimeoutError: The function timed out while waiting for a response from teh service
+            TypeError: The `query` value was invalid
+            
+        """
+        (query, ip, port) = self._endpoint(service, query)
+
+        # Talk to the server
+        if self._transport(service) == "udp":
+            response = self._udp_query(query, ip, port, timeout, variables)
+        else:
+            response = self._http_query(query, ip, port, timeout, variables)
+
+        return self._result(response, service)
+
+    def query_many(self, queries, timeout=DEFAULT_TIMEOUT):
+        """Send several GraphQL requests at once
+
+        The requests run concurrently, so this takes about as long as the slowest one.
+
+        Args:
+
+            - queries (list): ``(service, query)`` or ``(service, query, variables)`` tuples,
+              as would be passed to :meth:`query`
+            - timeout (int): The amount of time that this function should wait for all of the
+              responses
+
+        Returns:
+            A list holding, for each request in order, the JSON response from the service, or
+            the exception :meth:`query` raised for it. Requests without a response within
+            `timeout` get a ``requests.exceptions.Timeout``
+        """
+        queries = list(queries)
+        deadline = time.monotonic() + timeout
+
+        def run(service, query, variables=None):
+            # Requests waiting for a thread only get what's left of the timeout
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout(
+                    "{} was not queried within {} seconds".format(service, timeout))
+            return self.query(service, query, timeout=remaining, variables=variables)
+
+        with self._sessions_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=QUERY_MANY_WORKERS)
+            executor = self._executor
+        futures = [executor.submit(run, *item) for item in queries]
+        concurrent.futures.wait(futures, timeout=max(0, deadline - time.monotonic()))
+
+        results = []
+        for (item, future) in zip(queries, futures):
+            if not future.done():
+                future.cancel()
+                results.append(requests.exceptions.Timeout(
+                    "{} did not respond within {} seconds".format(item[0], timeout)))
+            elif future.exception() is not None:
+                results.append(future.exception())
+            else:
+                results.append(future.result())
+        return results
+
+    def subscribe(self, service, query, period=1.0, on_change=False,
+                  variables=None, callback=None, timeout=DEFAULT_TIMEOUT):
+        """Subscribe to the results of a GraphQL query
+
+        The service runs the query every `period` seconds and pushes the results back
+        over a streaming HTTP response, until the subscription is closed.
+
+        Args:
+
+            - service (str): The service that the request should be sent to. Must be defined in
+              the system's ``config.toml`` file
+            - query (str): The GraphQL query
+            - period (float): The number of seconds between runs of the query
+            - on_change (bool): Only push results which differ from the previous one
+            - variables (dict): Values of the variables used by the query
+            - callback (function): If given, ``callback(data, errors)`` is called with each
+              result from a background thread. `errors` is ``None`` unless the service
+              returned errors
+            - timeout (int): The amount of time that this function should wait for the
+              service to accept the subscription
+
+        Returns:
+            A :class:`Subscription`
+
+        Raises:
+            EnvironmentError: The service refused the subscription
+            KeyError: The `service` value was invalid
+            TypeError: The `query` value was invalid
+            ValueError: The service is configured for UDP
+        """
+        (query, ip, port) = self._endpoint(service, query)
+        if self._transport(service) != "http":
+            raise ValueError("Subscriptions need the HTTP transport.")
+        body = {'query': query, 'period': period, 'onChange': on_change}
+        if variables is not None:
+            body['variables'] = variables
+
+        # Results can be a long time apart, so only the connection times out
+        response = requests.post(
+            str.encode("http://{}:{}/subscribe".format(ip, port)), json=body,
+            headers={'Accept': 'text/event-stream'}, stream=True,
+            timeout=(timeout, None))
+        if response.status_code == 400:
+            (_, errors) = self._format(response.text, service)
+            response.close()
+            raise EnvironmentError(
+                "{} Endpoint Error: {}".format(service, errors))
+        response.raise_for_status()
+
+        subscription = Subscription(self, service, response)
+        if callback is not None:
+            subscription.start(callback)
+        return subscription
+    
+    def _http_query(self, query, ip, port, timeout, variables=None):
+        
+        # Service connection info
+        url = "http://{}:{}".format(ip, port)
+        
+        # Put our query in the message body as JSON
+        body = {'query':query} 
+        if variables is not None:
+            body['variables'] = variables
+        
+        if self.persisted_queries and (ip, port) not in self._unpersisted:
+            # Send the hash alone first
+            body['extensions'] = {
+                'persistedQuery': {'version': 1, 'sha256Hash': query_hash(query)}
+            }
+            hashed = dict(body)
+            del hashed['query']
+            response = self._post(url, hashed, timeout)
+            if 400 <= response.status_code < 500:
+                # Services without persisted queries reject a request with
+                # no query text, each with its own error
+                status = "unsupported"
+                if PERSISTED_QUERY_NOT_FOUND.encode() in response.content:
+                    status = "missing"
+            else:
+                response.raise_for_status()
+                content = self._body(
+                    response.content, response.headers.get('Content-Type', ''))
+                status = self._persisted_status(content)
+                if status == "found":
+                    return content
+            if status == "unsupported":
+                self._unpersisted.add((ip, port))
+                del body['extensions']
+        
+        # Send the request and wait for the response
+        response = self._post(url, body, timeout)
+        
+        # Make sure that we got a good response
+        response.raise_for_status()
+        
+        # Return the good message body
+        return self._body(
+            response.content, response.headers.get('Content-Type', ''))
+
+    def _udp_query(self, query, ip, port, timeout, variables=None):
+        # A mutation may have run even if its response was lost
+        retries = 0 if _is_mutation(query) else self.udp_retries
+        body = {'query': query}
+        if variables is not None:
+            body['variables'] = variables
+
+        if self.persisted_queries and (ip, port) not in self._unpersisted:
+            # Send the hash alone first
+            body['extensions'] = {
+                'persistedQuery': {'version': 1, 'sha256Hash': query_hash(query)}
+            }
+            hashed = dict(body)
+            del hashed['query']
+            started = time.monotonic()
+            response = self._udp_exchange(ip, port, hashed, timeout, retries)
+            status = self._persisted_status(response)
+            if status == "found":
+                return response
+            if status == "unsupported":
+                self._unpersisted.add((ip, port))
+                del body['extensions']
+            timeout = self._remaining(timeout, started)
+
+        return self._udp_exchange(ip, port, body, timeout, retries)
+
+    def _udp_exchange(self, ip, port, body, timeout, retries):
+        (request_id, datagram) = self._datagram(body)
+        deadline = time.monotonic() + timeout
+        attempts = retries + 1
+        fragments = {}
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Only the service's datagrams are received, and a closed port
+            # is reported as ConnectionRefusedError
+            sock.connect((ip, port))
+            for attempt in range(attempts):
+                sock.send(datagram)
+                # Split what's left of the timeout between the attempts left
+                now = time.monotonic()
+                attempt_end = now + (deadline - now) / (attempts - attempt)
+                while True:
+                    remaining = attempt_end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sock.settimeout(remaining)
+                    try:
+                        data = sock.recv(MAX_DATAGRAM)
+                    except socket.timeout:
+                        break
+                    response = self._reassemble(fragments, data, request_id)
+                    if response is not None:
+                        return response
+        except ConnectionRefusedError as e:
+            raise requests.exceptions.ConnectionError(e)
+        finally:
+            sock.close()
+        raise requests.exceptions.Timeout(
+            "No response from {}:{} within {} seconds".format(ip, port, timeout))
+
+    def _post(self, url, body, timeout):
+        headers = {
+            'Accept-Encoding': ACCEPT_ENCODING if self.compression else 'identity'
+        }
+        if self.encoding == "cbor":
+            headers['Accept'] = CBOR_MIMETYPE
+        (session, kept) = self._session(url)
+        try:
+            response = session.post(
+                str.encode(url), json=body, headers=headers, timeout=timeout)
+        except requests.exceptions.ConnectionError as e:
+            self._drop_session(url)
+            if not (kept and _closed_before_response(e)):
+                raise
+            # A restarted service drops the kept connections before reading
+            # the request, so try once more on a new one
+            (session, _) = self._session(url)
+            response = session.post(
+                str.encode(url), json=body, headers=headers, timeout=timeout)
+        self._keep(url, response)
+        return response
+
+    def _session(self, url):
+        # One session per service, keeping up to pool_size connections alive.
+        # Returns the session and whether it has a connection kept alive
+        now = time.monotonic()
+        with self._sessions_lock:
+            entry = self._sessions.get(url)
+            if entry is not None and self.idle_timeout and \
+                    now - entry[1] > self.idle_timeout:
+                entry[0].close()
+                entry = None
+            if entry is None:
+                session = requests.Session()
+                session.mount("http://", HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size))
+                entry = self._sessions[url] = [session, now, False]
+            entry[1] = now
+            return (entry[0], entry[2])
+
+    def _keep(self, url, response):
+        # Whether the service kept the connection open after the response
+        kept = response.headers.get('Connection', '').lower() != 'close'
+        with self._sessions_lock:
+            entry = self._sessions.get(url)
+            if entry is not None:
+                entry[2] = kept
+
+    def _drop_session(self, url):
+        with self._sessions_lock:
+            entry = self._sessions.pop(url, None)
+        if entry is not None:
+            entry[0].close()
+
+
+def _closed_before_response(error):
+    # The connection was closed or reset before any response bytes arrived
+    reason = error.args[0] if error.args else None
+    return isinstance(reason, ProtocolError) and \
+        isinstance(reason.args[-1], (ConnectionResetError, BrokenPipeError))
+
+
+class Subscription:
+    """Results of a query subscription, as pushed by the service
+
+    Iterating returns the data of each result as it arrives. A result with errors
+    raises an EnvironmentError, and iteration can continue afterwards. Iteration
+    stops once the subscription is closed or the service ends it.
+    """
+
+    def __init__(self, services, service, response):
+        self.service = service
+        self._services = services
+        self._response = response
+        self._events = self._read_events()
+        self._thread = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._services._result(next(self._events), self.service)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """End the subscription"""
+        self._response.close()
+
+    def start(self, callback):
+        """Call ``callback(data, errors)`` with each result from a background thread"""
+        def run():
+            try:
+                for event in self._events:
+                    (data, errors) = self._services._format(event, self.service)
+                    callback(data, errors if errors not in ([], None, "") else None)
+            except Exception:
+                # Closing the subscription ends the stream with an error
+                pass
+
+        self._thread = threading.Thread(target=run, name="subscription")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_events(self):
+        # Server-sent events: "data: ..." lines, with each event ended by a blank line
+        data = []
+        buffer = b""
+        for chunk in self._chunks():
+            buffer += chunk
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                line = line.rstrip(b"\r")
+                if line.startswith(b"data:"):
+                    data.append(line[5:].lstrip(b" "))
+                elif not line and data:
+                    yield b"\n".join(data).decode()
+                    data = []
+
+    def _chunks(self):
+        # read1 returns as soon as anything arrives. Older urllib3 versions
+        # don't have it, and need a chunked response
+        read1 = getattr(self._response.raw, 'read1', None)
+        if read1 is None:
+            yield from self._response.iter_content(chunk_size=None)
+            return
+        while True:
+            chunk = read1(65536)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _DatagramQueue(asyncio.DatagramProtocol):
+    # Queues the datagrams, and errors, received on a UDP endpoint
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(data)
+
+    def error_received(self, exc):
+        self.queue.put_nowait(exc)
+
+
+class AsyncServices(_Client):
+    """asyncio counterpart of :class:`Services`
+
+    Queries are coroutines, so many services can be queried concurrently from one event
+    loop. Errors are raised as by :meth:`Services.query`, including the ``requests``
+    ``ConnectionError``, ``HTTPError`` and ``Timeout`` exceptions. Connections kept open
+    belong to the event loop which opened them, so use an instance from one loop only.
+    """
+
+    def __init__(self, service_config_filepath=SERVICE_CONFIG_PATH,
+                 persisted_queries=False, encoding="json", compression=True,
+                 pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 udp_retries=DEFAULT_UDP_RETRIES):
+        """
+        Args:
+            The same as for :class:`Services`
+
+        Raises:
+            ImportError: ``"cbor"`` encoding was requested but ``cbor2`` isn't installed
+            ValueError: The `encoding` value was invalid
+        """
+        _Client.__init__(self, service_config_filepath, persisted_queries,
+                         encoding, compression, pool_size, idle_timeout,
+                         udp_retries)
+        # (ip, port) -> [(reader, writer, time last used)] of idle connections
+        self._idle = {}
+
+    async def query(self, service, query, timeout=DEFAULT_TIMEOUT, variables=None):
+        """Send a GraphQL request to a service
+
+        Args:
+
+            - service (str): The service that the request should be sent to. Must be defined in
+              the system's ``config.toml`` file
+            - query (str): The GraphQL request
+            - timeout (int): The amount of time that this function should wait for a response from the
+              service
+            - variables (dict): Values of the variables used by the request
+
+        Returns:
+            The JSON response from the service
+
+        Raises:
+            EnvironmentError: An error was returned within the JSON response from the service
+            KeyError: The `service` value was invalid
+            requests.exceptions.Timeout: The function timed out while waiting for a response
+              from the service
+            TypeError: The `query` value was invalid
+        """
+        (query, ip, port) = self._endpoint(service, query)
+        if self._transport(service) == "udp":
+            request = self._udp_query(query, ip, port, timeout, variables)
+        else:
+            request = self._http_query(query, ip, port, variables)
+        try:
+            response = await asyncio.wait_for(request, timeout)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.Timeout(
+                "{} did not respond within {} seconds".format(service, timeout))
+        return self._result(response, service)
+
+    async def close(self):
+        """Close the connections kept open to services"""
+        for connections in self._idle.values():
+            for (_, writer, _) in connections:
+                writer.close()
+        self._idle.clear()
+
+    async def _http_query(self, query, ip, port, variables=None):
+        body = {'query': query}
+        if variables is not None:
+            body['variables'] = variables
+
+        if self.persisted_queries and (ip, port) not in self._unpersisted:
+            # Send the hash alone first
+            body['extensions'] = {
+                'persistedQuery': {'version': 1, 'sha256Hash': query_hash(query)}
+            }
+            hashed = dict(body)
+            del hashed['query']
+            response = await self._post(ip, port, hashed)
+            if 400 <= response[0] < 500:
+                # Services without persisted queries reject a request with
+                # no query text, each with its own error
+                status = "unsupported"
+                if PERSISTED_QUERY_NOT_FOUND.encode() in response[3]:
+                    status = "missing"
+            else:
+                content = self._check(response, ip, port)
+                status = self._persisted_status(content)
+                if status == "found":
+                    return content
+            if status == "unsupported":
+                self._unpersisted.add((ip, port))
+                del body['extensions']
+
+        return self._check(await self._post(ip, port, body), ip, port)
+
+    async def _udp_query(self, query, ip, port, timeout, variables=None):
+        # A mutation may have run even if its response was lost
+        retries = 0 if _is_mutation(query) else self.udp_retries
+        body = {'query': query}
+        if variables is not None:
+            body['variables'] = variables
+
+        if self.persisted_queries and (ip, port) not in self._unpersisted:
+            # Send the hash alone first
+            body['extensions'] = {
+                'persistedQuery': {'version': 1, 'sha256Hash': query_hash(query)}
+            }
+            hashed = dict(body)
+            del hashed['query']
+            started = time.monotonic()
+            response = await self._udp_exchange(ip, port, hashed, timeout, retries)
+            status = self._persisted_status(response)
+            if status == "found":
+                return response
+            if status == "unsupported":
+                self._unpersisted.add((ip, port))
+                del body['extensions']
+            timeout = self._remaining(timeout, started)
+
+        return await self._udp_exchange(ip, port, body, timeout, retries)
+
+    async def _udp_exchange(self, ip, port, body, timeout, retries):
+        (request_id, datagram) = self._datagram(body)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        attempts = retries + 1
+        fragments = {}
+        (transport, protocol) = await loop.create_datagram_endpoint(
+            _DatagramQueue, remote_addr=(ip, port))
+        try:
+            for attempt in range(attempts):
+                transport.sendto(datagram)
+                # Split what's left of the timeout between the attempts left
+                now = loop.time()
+                attempt_end = now + (deadline - now) / (attempts - attempt)
+                while True:
+                    remaining = attempt_end - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        data = await asyncio.wait_for(protocol.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if isinstance(data, Exception):
+                        raise requests.exceptions.ConnectionError(data)
+                    response = self._reassemble(fragments, data, request_id)
+                    if response is not None:
+                        return response
+        finally:
+            transport.close()
+        raise requests.exceptions.Timeout(
+            "No response from {}:{} within {} seconds".format(ip, port, timeout))
+
+    def _check(self, response, ip, port):
+        (status, reason, headers, content) = response
+        if status >= 400:
+            raise requests.exceptions.HTTPError(
+                "{} Error: {} for url: http://{}:{}/".format(status, reason, ip, port))
+        return self._body(content, headers.get('content-type', ''))
+
+    async def _post(self, ip, port, body):
+        payload = json.dumps(body).encode()
+        head = [
+            "POST / HTTP/1.1",
+            "Host: {}:{}".format(ip, port),
+            "Content-Type: application/json",
+            "Content-Length: {}".format(len(payload)),
+            "Accept-Encoding: {}".format(
+                ASYNC_ACCEPT_ENCODING if self.compression else "identity")
+        ]
+        if self.encoding == "cbor":
+            head.append("Accept: {}".format(CBOR_MIMETYPE))
+        request = ("\r\n".join(head) + "\r\n\r\n").encode() + payload
+
+        (reader, writer, reused) = await self._connect(ip, port)
+        while True:
+            try:
+                writer.write(request)
+                await writer.drain()
+                (status, reason, headers, content, keep) = await self._read_response(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if not reused:
+                    raise requests.exceptions.ConnectionError(e)
+                # A restarted service drops the kept connections, so try
+                # once more on a new one
+                (reader, writer, reused) = await self._connect(ip, port, new=True)
+            except BaseException:
+                writer.close()
+                raise
+
+        if keep:
+            self._release(ip, port, reader, writer)
+        else:
+            writer.close()
+
+        encoding = headers.get('content-encoding', 'identity').lower()
+        if encoding == 'gzip':
+            content = gzip.decompress(content)
+        elif encoding == 'deflate':
+            content = zlib.decompress(content)
+        return (status, reason, headers, content)
+
+    async def _connect(self, ip, port, new=False):
+        now = time.monotonic()
+        idle = self._idle.get((ip, port), [])
+        while idle and not new:
+            (reader, writer, used) = idle.pop()
+            if reader.at_eof() or (self.idle_timeout and now - used > self.idle_timeout):
+                writer.close()
+                continue
+            return (reader, writer, True)
+        try:
+            (reader, writer) = await asyncio.open_connection(ip, port)
+        except OSError as e:
+            raise requests.exceptions.ConnectionError(e)
+        return (reader, writer, False)
+
+    def _release(self, ip, port, reader, writer):
+        idle = self._idle.setdefault((ip, port), [])
+        if len(idle) < self.pool_size:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def _read_response(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        (version, status, reason) = (line.decode('latin-1').rstrip() + "  ").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (key, _, value) = line.decode('latin-1').partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        keep = (version == "HTTP/1.1" and
+                headers.get('connection', '').lower() != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b"".join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            # The body ends when the service closes the connection
+            content = await reader.read()
+            keep = False
+        return (int(status), reason.strip(), headers, content, keep)
+
+
+class TelemetryWriter:
+    """Stores telemetry points in the telemetry database service in batches
+
+    :meth:`write` only queues a point. A background thread sends the queued points once
+    `batch_size` of them are waiting or `interval` seconds have passed, so sampling doesn't
+    wait for the database. Points still queued are sent by :meth:`close`, which is also
+    called when a ``with`` block using the writer ends.
+    """
+
+    def __init__(self, services=None, service="telemetry-service", transport="graphql",
+                 batch_size=100, interval=1.0, buffer=1000, block=False, block_timeout=1.0,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        Args:
+
+            - services (:class:`Services`): The client used to send ``insertBulk``
+              mutations and to read the service's address. By default, a new one using
+              the default config file
+            - service (str): The telemetry service's name in the config file
+            - transport (str): ``"graphql"`` sends ``insertBulk`` mutations. ``"udp"``
+              sends JSON arrays of points to the service's ``direct_port``, without waiting
+              for the service to store them
+            - batch_size (int): The number of waiting points which triggers a send
+            - interval (float): The most seconds a point waits before being sent
+            - buffer (int): The most points queued. When full, the oldest point is dropped
+            - block (bool): When the queue is full, first wait up to `block_timeout` seconds
+              for the next send to make room
+            - block_timeout (float): See `block`
+            - timeout (float): The time to wait for the service to answer a mutation
+
+        Raises:
+            KeyError: The `service` value, or its ``direct_port`` for ``"udp"``, is
+              missing from the config file
+            ValueError: The `transport` value was invalid
+        """
+        if transport not in ["graphql", "udp"]:
+            raise ValueError("Transport must be 'graphql' or 'udp'.")
+        self._own_services = services is None
+        self.services = Services() if services is None else services
+        if service not in self.services.config:
+            raise KeyError(
+                "Service name invalid. Check config file for service names.")
+        self.service = service
+        self.transport = transport
+        if transport == "udp":
+            if "direct_port" not in self.services.config[service]:
+                raise KeyError("{} has no direct_port in the config file.".format(service))
+            self.address = (self.services.config[service]["addr"]["ip"],
+                            self.services.config[service]["direct_port"])
+        self.batch_size = batch_size
+        self.interval = interval
+        self.block = block
+        self.block_timeout = block_timeout
+        self.timeout = timeout
+
+        self._buffer = deque()
+        self._capacity = buffer
+        self._cond = threading.Condition()
+        self._socket = None
+        self._stopping = False
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.failed = 0
+        self.flushes = 0
+        self.flush_latency = None
+        self.last_error = None
+
+        self._thread = threading.Thread(target=self._run, name="telemetry-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, subsystem, parameter, value, timestamp=None):
+        """Queue a telemetry point
+
+        Args:
+
+            - subsystem (str): The subsystem the point belongs to
+            - parameter (str): The name of the point
+            - value: The value of the point, which is stored as a string
+            - timestamp (float): The UNIX time of the point. Defaults to the current time
+
+        Raises:
+            ValueError: The writer was closed
+        """
+        point = {
+            'timestamp': time.time() if timestamp is None else timestamp,
+            'subsystem': subsystem,
+            'parameter': parameter,
+            'value': str(value)
+        }
+        with self._cond:
+            if self._stopping:
+                raise ValueError("Write to a closed TelemetryWriter.")
+            if len(self._buffer) >= self._capacity and self.block:
+                self.blocked += 1
+                self._cond.notify_all()
+                deadline = time.monotonic() + self.block_timeout
+                while len(self._buffer) >= self._capacity:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if len(self._buffer) >= self._capacity:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(point)
+            self.queued += 1
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def stats(self):
+        """Counters of the points written
+
+        Returns:
+            A dict with the number of points waiting (``depth``), the number of points
+            ``queued``, ``sent``, ``dropped`` from a full queue and ``failed`` to send,
+            the number of writes which waited for room (``blocked``), the number of
+            ``flushes``, the duration of the last one in seconds (``flush_latency``) and
+            the last error sending points (``last_error``)
+        """
+        with self._cond:
+            return {
+                'depth': len(self._buffer),
+                'queued': self.queued,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+                'failed': self.failed,
+                'flushes': self.flushes,
+                'flush_latency': self.flush_latency,
+                'last_error': self.last_error
+            }
+
+    def close(self):
+        """Send the queued points and stop the background thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._socket is not None:
+            self._socket.close()
+        if self._own_services:
+            self.services.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.interval
+                while len(self._buffer) < self.batch_size and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = list(self._buffer)
+                self._buffer.clear()
+                stopping = self._stopping
+                # Wake up writers waiting for room
+                self._cond.notify_all()
+            if batch:
+                self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        try:
+            for start in range(0, len(batch), self.batch_size):
+                self._send(batch[start:start + self.batch_size])
+        except Exception as e:
+            with self._cond:
+                self.failed += len(batch)
+                self.last_error = "{}: {}".format(type(e).__name__, e)
+            return
+        with self._cond:
+            self.sent += len(batch)
+            self.flushes += 1
+            self.flush_latency = time.monotonic() - started
+
+    def _send(self, points):
+        if self.transport == "udp":
+            self._send_udp(points)
+            return
+        response = self.services.query(
+            service=self.service, query=INSERT_BULK,
+            variables={'entries': points}, timeout=self.timeout)
+        if not response['insertBulk']['success']:
+            raise EnvironmentError(response['insertBulk']['errors'])
+
+    def _send_udp(self, points):
+        # Split into arrays which fit telemetry-service's receive buffer
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        datagram = []
+        size = 2
+        for point in [json.dumps(point) for point in points]:
+            if datagram and size + len(point) + 1 > TELEMETRY_DATAGRAM:
+                self._socket.sendto(("[" + ",".join(datagram) + "]").encode(), self.address)
+                datagram = []
+                size = 2
+            datagram.append(point)
+            size += len(point) + 1
+        if datagram:
+            self._socket.sendto(("[" + ",".join(datagram) + "]").encode(), self.address)
+
+
 def logging_setup(app_name, level = logging.DEBUG):
     """Set up the logger for the program
     All log messages will be sent to rsyslog using the User facility.
@@ -161,4 +1194,4 @@ def logging_setup(app_name, level = logging.DEBUG):
     logger.addHandler(syslog)
     logger.addHandler(stdout)
     
-    return logger
\ No newline at end of file
+    return logger
@@ -11,5 +11,6 @@ setup(name='app_api',
       version='0.1.0',
       description='Mission Application API for KubOS',
       py_modules=["app_api"],
-      install_requires=['toml']
+      install_requires=['toml'],
+      extras_require={'cbor': ['cbor2']}
       )
@@ -9,11 +9,19 @@ Unit testing for the Kubos App API.
 """
 
 import app_api
+import asyncio
+import gzip
+from http.client import RemoteDisconnected
+import json
+import socket
+import threading
 import unittest
 import mock
 import responses
+import time
 
-from requests.exceptions import ConnectionError, HTTPError
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+from urllib3.exceptions import ProtocolError
 
 class TestAppAPI(unittest.TestCase):
 
@@ -133,5 +141,550 @@ class TestAppAPI(unittest.TestCase):
         with self.assertRaises(HTTPError):
             response = self.api.query(service=service, query=query)
 
+    @responses.activate
+    def test_variables(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        
+        self.api.query(service="test-service", query="query ($a: Int) {test(a: $a)}",
+                       variables={'a': 1})
+        
+        body = json.loads(responses.calls[0].request.body)
+        assert body['variables'] == {'a': 1}
+
+    @responses.activate
+    def test_compressed_response(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            body=gzip.compress(json.dumps({'data':'test data'}).encode()),
+            headers={'Content-Encoding': 'gzip'},
+            content_type='application/json',
+            status=200)
+        
+        response = self.api.query(service="test-service", query="test query")
+        
+        assert response == "test data"
+        assert 'gzip' in responses.calls[0].request.headers['Accept-Encoding']
+
+    @responses.activate
+    def test_compression_disabled(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        
+        api = app_api.Services("test_config.toml", compression=False)
+        api.query(service="test-service", query="test query")
+        
+        assert responses.calls[0].request.headers['Accept-Encoding'] == 'identity'
+
+    @responses.activate
+    def test_session_reuse(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+
+        self.api.query(service="test-service", query="test query")
+        (session, kept) = self.api._session("http://0.0.0.0:8000")
+        self.api.query(service="test-service", query="test query")
+
+        assert kept
+        assert self.api._session("http://0.0.0.0:8000")[0] is session
+
+    @responses.activate
+    def test_reconnect(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        # The kept connection was closed by the service
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            body=ConnectionError(ProtocolError(
+                'Connection aborted.', RemoteDisconnected('Remote end closed connection'))))
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+
+        self.api.query(service="test-service", query="test query")
+        response = self.api.query(service="test-service", query="test query")
+
+        assert response == "test data"
+        assert len(responses.calls) == 3
+
+    @responses.activate
+    def test_no_retry_on_new_connection(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            body=ConnectionError(ProtocolError(
+                'Connection aborted.', RemoteDisconnected('Remote end closed connection'))))
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+
+        # The request may have run, so it isn't sent again
+        with self.assertRaises(ConnectionError):
+            self.api.query(service="test-service", query="mutation {passthrough}")
+        assert len(responses.calls) == 1
+
+    @responses.activate
+    def test_query_many(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+
+        results = self.api.query_many([
+            ("test-service", "test query"),
+            ("bad-service", "test query"),
+            ("test-service", "query ($a: Int) {test(a: $a)}", {'a': 1})])
+
+        assert results[0] == "test data"
+        assert isinstance(results[1], KeyError)
+        assert results[2] == "test data"
+
+    @responses.activate
+    def test_query_many_deadline(self):
+        def slow(request):
+            time.sleep(0.2)
+            return (200, {}, json.dumps({'data':'test data'}))
+
+        responses.add_callback(
+            responses.POST, 'http://0.0.0.0:8000', callback=slow)
+
+        started = time.monotonic()
+        results = self.api.query_many(
+            [("test-service", "test query")] * 2, timeout=0.05)
+
+        assert time.monotonic() - started < 0.15
+        assert all(isinstance(result, Timeout) for result in results)
+        # Let the abandoned requests finish while the mock is still active
+        self.api._executor.shutdown(wait=True)
+
+class TestPersistedQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.api = app_api.Services("test_config.toml", persisted_queries=True)
+        self.query = "test query"
+        self.sha = app_api.query_hash(self.query)
+
+    @responses.activate
+    def test_known_hash(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        
+        response = self.api.query(service="test-service", query=self.query)
+        
+        assert response == "test data"
+        assert len(responses.calls) == 1
+        body = json.loads(responses.calls[0].request.body)
+        assert 'query' not in body
+        assert body['extensions']['persistedQuery']['sha256Hash'] == self.sha
+
+    @responses.activate
+    def test_unknown_hash(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'errors':[{'message': app_api.PERSISTED_QUERY_NOT_FOUND}]},
+            status=200)
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        
+        response = self.api.query(service="test-service", query=self.query)
+        
+        assert response == "test data"
+        body = json.loads(responses.calls[1].request.body)
+        assert body['query'] == self.query
+        assert body['extensions']['persistedQuery']['sha256Hash'] == self.sha
+
+    @responses.activate
+    def test_unsupported(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'errors':[{'message': 'Must provide query string.'}]},
+            status=400)
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        
+        self.api.query(service="test-service", query=self.query)
+        self.api.query(service="test-service", query=self.query)
+        
+        # Only the first query tried sending the hash alone
+        assert len(responses.calls) == 3
+        body = json.loads(responses.calls[2].request.body)
+        assert body == {'query': self.query}
+
+    @responses.activate
+    def test_unsupported_other_error(self):
+        # As the Rust services answer a request without a query
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            body='Request body deserialize error: missing field `query`',
+            status=400)
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+
+        response = self.api.query(service="test-service", query=self.query)
+
+        assert response == "test data"
+        body = json.loads(responses.calls[1].request.body)
+        assert body == {'query': self.query}
+        assert ('0.0.0.0', 8000) in self.api._unpersisted
+
+class TestCBOR(unittest.TestCase):
+
+    def setUp(self):
+        if app_api.cbor2 is None:
+            self.skipTest("cbor2 is not installed")
+        self.api = app_api.Services("test_config.toml", encoding="cbor")
+
+    def test_bad_encoding(self):
+        with self.assertRaises(ValueError):
+            app_api.Services("test_config.toml", encoding="xml")
+
+    @responses.activate
+    def test_cbor_response(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            body=app_api.cbor2.dumps({'data': {'values': [1.5, 2.5]}}),
+            content_type=app_api.CBOR_MIMETYPE,
+            status=200)
+        
+        response = self.api.query(service="test-service", query="test query")
+        
+        assert response == {'values': [1.5, 2.5]}
+        assert responses.calls[0].request.headers['Accept'] == app_api.CBOR_MIMETYPE
+
+    @responses.activate
+    def test_json_fallback(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data':'test data'},
+            status=200)
+        
+        response = self.api.query(service="test-service", query="test query")
+        
+        assert response == "test data"
+
+class TestSubscriptions(unittest.TestCase):
+
+    def setUp(self):
+        self.api = app_api.Services("test_config.toml")
+
+    @responses.activate
+    def test_subscribe(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000/subscribe',
+            body=b'data: {"data": 1, "errors": null}\n\n'
+                 b': keep-alive\n\n'
+                 b'data: {"data": 2, "errors": null}\n\n',
+            content_type='text/event-stream',
+            status=200)
+
+        subscription = self.api.subscribe(
+            service="test-service", query="test query", period=5.0,
+            on_change=True)
+
+        assert list(subscription) == [1, 2]
+        body = json.loads(responses.calls[0].request.body)
+        assert body == {'query': 'test query', 'period': 5.0, 'onChange': True}
+
+    @responses.activate
+    def test_subscribe_error_result(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000/subscribe',
+            body=b'data: {"data": null, "errors": ["bad"]}\n\n'
+                 b'data: {"data": 2, "errors": null}\n\n',
+            content_type='text/event-stream',
+            status=200)
+
+        subscription = self.api.subscribe(service="test-service", query="test query")
+
+        with self.assertRaises(EnvironmentError):
+            next(subscription)
+        # The subscription carries on after an error
+        assert next(subscription) == 2
+
+    @responses.activate
+    def test_subscribe_refused(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000/subscribe',
+            json={'errors':[{'message': 'Only queries can be subscribed to'}]},
+            status=400)
+
+        with self.assertRaises(EnvironmentError):
+            self.api.subscribe(service="test-service", query="mutation {noop}")
+
+class TestAsyncServices(unittest.TestCase):
+
+    def setUp(self):
+        self.api = app_api.AsyncServices("test_config.toml")
+        # (status, JSON body or None to never answer) per request
+        self.responses = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = [line for line in head.split(b"\r\n")
+                          if line.startswith(b"Content-Length:")][0]
+                await reader.readexactly(int(length.split(b":")[1]))
+                (status, body) = self.responses.pop(0)
+                if body is None:
+                    await asyncio.sleep(1)
+                    return
+                body = json.dumps(body).encode()
+                writer.write(
+                    b"HTTP/1.1 %d Status\r\nContent-Type: application/json\r\n"
+                    b"Content-Length: %d\r\n\r\n" % (status, len(body)) + body)
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    def run_queries(self, count=1, **kwargs):
+        async def run():
+            server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+            self.api.config["test-service"]["addr"] = {
+                "ip": "127.0.0.1", "port": server.sockets[0].getsockname()[1]}
+            try:
+                return [await self.api.query(
+                            service="test-service", query="test query", **kwargs)
+                        for _ in range(count)]
+            finally:
+                await self.api.close()
+                server.close()
+        return asyncio.run(run())
+
+    def test_query(self):
+        self.responses = [(200, {'data': 'test data'}), (200, {'data': 'more data'})]
+
+        assert self.run_queries(2) == ['test data', 'more data']
+        # The connection was kept open for the second query
+        assert self.connections == 1
+
+    def test_endpoint_error(self):
+        self.responses = [(200, {'errors': ["Lots of errors"], 'data': ""})]
+
+        with self.assertRaises(EnvironmentError):
+            self.run_queries()
+
+    def test_bad_status(self):
+        self.responses = [(404, {})]
+
+        with self.assertRaises(HTTPError):
+            self.run_queries()
+
+    def test_timeout(self):
+        self.responses = [(200, None)]
+
+        with self.assertRaises(Timeout):
+            self.run_queries(timeout=0.05)
+
+class TestUDP(unittest.TestCase):
+
+    def setUp(self):
+        self.api = app_api.Services("test_config.toml", udp_retries=1)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.api.config["test-service"]["transport"] = "udp"
+        self.api.config["test-service"]["addr"] = {
+            "ip": "127.0.0.1", "port": self.sock.getsockname()[1]}
+        # Payloads of the fragments to answer each request with, or None to drop it
+        self.responses = []
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.api.close()
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                (data, addr) = self.sock.recvfrom(app_api.MAX_DATAGRAM)
+            except OSError:
+                return
+            (_, _, request_id, _, _) = app_api.FRAME_HEADER.unpack_from(data)
+            self.requests.append(json.loads(data[app_api.FRAME_HEADER.size:]))
+            fragments = self.responses.pop(0)
+            if fragments is None:
+                continue
+            # A response to an earlier request is ignored
+            self.sock.sendto(app_api.FRAME_HEADER.pack(
+                app_api.FRAME_MAGIC, 0, request_id - 1, 0, 1) + b'{}', addr)
+            # Fragments may arrive out of order
+            for index in reversed(range(len(fragments))):
+                self.sock.sendto(app_api.FRAME_HEADER.pack(
+                    app_api.FRAME_MAGIC, 0, request_id, index, len(fragments))
+                    + fragments[index], addr)
+
+    def test_query(self):
+        self.responses = [[b'{"data": "test', b' data", "errors"', b': null}']]
+
+        response = self.api.query(service="test-service", query="test query",
+                                  variables={"x": 1})
+
+        assert response == "test data"
+        assert self.requests == [{'query': 'test query', 'variables': {'x': 1}}]
+
+    def test_retry(self):
+        self.responses = [None, [b'{"data": "test data"}']]
+
+        response = self.api.query(service="test-service", query="test query",
+                                  timeout=2)
+
+        assert response == "test data"
+        assert len(self.requests) == 2
+
+    def test_timeout(self):
+        self.responses = [None, None]
+
+        with self.assertRaises(Timeout):
+            self.api.query(service="test-service", query="test query", timeout=0.2)
+        assert len(self.requests) == 2
+
+    def test_mutation_not_retried(self):
+        self.responses = [None, [b'{"data": "test data"}']]
+
+        with self.assertRaises(Timeout):
+            self.api.query(service="test-service",
+                           query="mutation { reset }", timeout=0.2)
+        assert len(self.requests) == 1
+
+    def test_is_mutation(self):
+        assert app_api._is_mutation("mutation { reset }")
+        assert app_api._is_mutation(
+            "fragment f on Query { ping } # query\nmutation M($x: Int) { reset }")
+        assert not app_api._is_mutation("{ mutation }")
+        assert not app_api._is_mutation('query { ping(note: "mutation {") }')
+        assert not app_api._is_mutation("# mutation\n{ ping }")
+
+    def test_persisted_unsupported(self):
+        self.api.persisted_queries = True
+        self.responses = [
+            [b'{"data": null, "errors": [{"message": "Unknown field"}]}'],
+            [b'{"data": "test data"}']]
+
+        response = self.api.query(service="test-service", query="test query")
+
+        assert response == "test data"
+        assert 'query' not in self.requests[0]
+        assert self.requests[1] == {'query': 'test query'}
+
+    def test_persisted_timeout(self):
+        started = time.monotonic() - 5
+
+        assert self.api._remaining(2, started) == app_api.MIN_UDP_TIMEOUT
+        assert self.api._remaining(0.2, started) == 0.2
+
+    def test_bad_transport(self):
+        self.api.config["test-service"]["transport"] = "tcp"
+
+        with self.assertRaises(ValueError):
+            self.api.query(service="test-service", query="test query")
+
+    def test_async_query(self):
+        self.responses = [[b'{"data": "test', b' data"}']]
+        api = app_api.AsyncServices("test_config.toml")
+        api.config = self.api.config
+
+        response = asyncio.run(api.query(service="test-service", query="test query"))
+
+        assert response == "test data"
+
+class TestTelemetryWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.api = app_api.Services("test_config.toml")
+
+    @responses.activate
+    def test_batch(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data': {'insertBulk': {'success': True, 'errors': ''}}},
+            status=200)
+
+        with app_api.TelemetryWriter(self.api, "test-service", batch_size=2,
+                                     interval=10) as writer:
+            writer.write("OBC", "available_mem", 100, timestamp=1.0)
+            writer.write("OBC", "active_apps", 2, timestamp=1.0)
+            writer.write("OBC", "available_mem", 90, timestamp=2.0)
+
+        entries = [json.loads(call.request.body)['variables']['entries']
+                   for call in responses.calls]
+        assert entries == [
+            [{'timestamp': 1.0, 'subsystem': 'OBC', 'parameter': 'available_mem', 'value': '100'},
+             {'timestamp': 1.0, 'subsystem': 'OBC', 'parameter': 'active_apps', 'value': '2'}],
+            [{'timestamp': 2.0, 'subsystem': 'OBC', 'parameter': 'available_mem', 'value': '90'}]]
+        stats = writer.stats()
+        assert (stats['sent'], stats['depth']) == (3, 0)
+
+    @responses.activate
+    def test_failed(self):
+        responses.add(
+            responses.POST, 'http://0.0.0.0:8000',
+            json={'data': {'insertBulk': {'success': False, 'errors': 'Database locked'}}},
+            status=200)
+
+        with app_api.TelemetryWriter(self.api, "test-service") as writer:
+            writer.write("OBC", "available_mem", 100)
+
+        stats = writer.stats()
+        assert (stats['sent'], stats['failed']) == (0, 1)
+        assert "Database locked" in stats['last_error']
+
+    def test_dropped(self):
+        writer = app_api.TelemetryWriter(self.api, "test-service", batch_size=10,
+                                         interval=10, buffer=2)
+        for value in range(3):
+            writer.write("OBC", "counter", value)
+
+        stats = writer.stats()
+        assert (stats['depth'], stats['dropped']) == (2, 1)
+        # Keep close() from sending
+        writer._buffer.clear()
+        writer.close()
+
+    def test_udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(2)
+        self.api.config["test-service"]["addr"]["ip"] = "127.0.0.1"
+        self.api.config["test-service"]["direct_port"] = sock.getsockname()[1]
+
+        with app_api.TelemetryWriter(self.api, "test-service", transport="udp") as writer:
+            for value in range(100):
+                writer.write("OBC", "counter", value, timestamp=1.0)
+
+        points = []
+        while len(points) < 100:
+            datagram = sock.recv(app_api.MAX_DATAGRAM)
+            # Each datagram fits telemetry-service's receive buffer
+            assert len(datagram) <= app_api.TELEMETRY_DATAGRAM
+            points += json.loads(datagram)
+        sock.close()
+        assert [point['value'] for point in points] == [str(value) for value in range(100)]
+
+    def test_missing_direct_port(self):
+        with self.assertRaises(KeyError):
+            app_api.TelemetryWriter(self.api, "test-service", transport="udp")
+
 if __name__ == '__main__':
     unittest.main()
@@ -10,9 +10,15 @@ API for interacting with all Pumpkin SupMCUs.
 See Pumpkin SUPERNOVA Firmware Reference Manual Rev 3.28
 """
 
+import asyncio
 import binascii
+import functools
+import heapq
 import struct
 import time
+import weakref
+from collections import deque, namedtuple
+from types import MappingProxyType
 import i2c
 
 #############
@@ -20,6 +26,13 @@ import i2c
 DELAY = 0.200
 I2C_BUS_NUM = 1
 HEADER_SIZE = 5
+# Adaptive mode: poll the data ready flag instead of always waiting DELAY
+ADAPTIVE_DELAY = False
+POLL_INTERVAL = 0.002       # First wait between data ready polls
+POLL_INTERVAL_MAX = 0.020   # Longest wait between data ready polls
+READY_TIMEOUT = 1.000       # Give up polling and read anyway after this
+EARLY_FACTOR = 0.5          # First poll at this fraction of the estimate
+LATENCY_WEIGHT = 0.25       # Weight of new samples in the latency estimate
 TELEMETRY = {
     "supervisor": {
         "firmware_version": {"command": "SUP:TEL? 0,data",  "length": 48, "parsing": "str"},
@@ -222,15 +235,234 @@ TELEMETRY = {
 # End Config Data
 #################
 
+# A field from TELEMETRY compiled into its ready-to-use form.
+# command: bytes written to the MCU, stopbyte included
+# struct: struct.Struct for the parsing string, or None for "str"/"hex"
+# names: tuple of subfield names, or None for single value fields
+TelemetryField = namedtuple(
+    'TelemetryField',
+    ['name', 'command', 'length', 'parsing', 'struct', 'names'])
+
+
+def _compile_field(name, config):
+    """
+    Validates one TELEMETRY entry and builds its TelemetryField.
+    """
+    command = config['command']
+    if type(command) is str:
+        command = str.encode(command)
+    if type(command) is not bytes:
+        raise TypeError('Commands must be str or bytes: ' + str(name))
+
+    parsing = config['parsing']
+    if type(parsing) not in [str, bytes]:
+        raise TypeError(
+            'Parsing field must be a valid struct parsing string. Input: '
+            + str(type(parsing)))
+
+    names = config.get('names')
+    if parsing in ["str", "hex"]:
+        compiled = None
+        count = 1
+    else:
+        compiled = struct.Struct(parsing)
+        if compiled.size != config['length']:
+            raise ValueError(
+                "Length doesn't match parsing string: " + str(name))
+        count = len(compiled.unpack(bytes(compiled.size)))
+
+    if names is not None:
+        if count == 1:
+            raise KeyError(
+                "Only one item parsed but subfields are listed: " + str(name))
+        if len(names) != count:
+            raise KeyError(
+                "Number of field names doesn't match parsing strings: " +
+                str(name))
+        names = tuple(names)
+    elif count > 1:
+        raise KeyError(
+            "Must be a names field when multiple items are parsed: " +
+            str(name))
+
+    return TelemetryField(
+        name=name,
+        command=command + b'\x0A',
+        length=config['length'],
+        parsing=parsing,
+        struct=compiled,
+        names=names)
+
+
+class TelemetryRegistry:
+    """
+    Read-only, precompiled form of a TELEMETRY table.
+
+    modules maps each module name to its own compiled fields, all_fields
+    maps each module name to its fields plus the supervisor fields (what
+    fields=["all"] requests). Both are immutable, so the registry can be
+    shared freely without the source table being modified.
+    """
+
+    def __init__(self, telemetry):
+        self.source = telemetry
+        modules = {}
+        for module in telemetry:
+            modules[module] = MappingProxyType({
+                name: _compile_field(name, config)
+                for name, config in telemetry[module].items()})
+        supervisor = modules.get('supervisor', {})
+        all_fields = {}
+        for module in modules:
+            combined = dict(modules[module])
+            combined.update(supervisor)
+            all_fields[module] = MappingProxyType(combined)
+        self.modules = MappingProxyType(modules)
+        self.all_fields = MappingProxyType(all_fields)
+
+
+_registry = TelemetryRegistry(TELEMETRY)
+
+
+def get_registry():
+    """
+    Returns the compiled TELEMETRY registry.
+
+    The table is compiled once at import. If TELEMETRY is replaced with a
+    new table it is recompiled on the next call. Modifying the existing
+    table in place is not detected.
+    """
+    global _registry
+    if _registry.source is not TELEMETRY:
+        _registry = TelemetryRegistry(TELEMETRY)
+    return _registry
+
+
+class LatencyStats:
+    """
+    Learned data ready latency of one field on one module.
+
+    The estimate is a moving average of how long the MCU took to set the
+    data ready flag, capped at READY_TIMEOUT. Each latency is the midpoint
+    between the last poll that found the flag clear and the first that
+    found it set. The first poll is made at EARLY_FACTOR of the estimate
+    (and never later than DELAY). If the flag is already set then, the
+    estimate was too high and drops to the new latency in one step.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.timeouts = 0
+        self.estimate = DELAY
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def settle_time(self):
+        """
+        Seconds to wait after the command before the first poll.
+        """
+        return min(self.estimate * EARLY_FACTOR, DELAY)
+
+    def record(self, latency, early=False):
+        """
+        Adds a measured latency to the statistics and the estimate. early
+        is set if the flag was already set at the first poll.
+        """
+        self.count += 1
+        self.total += latency
+        if self.minimum is None or latency < self.minimum:
+            self.minimum = latency
+        if self.maximum is None or latency > self.maximum:
+            self.maximum = latency
+        if early and latency < self.estimate:
+            self.estimate = latency
+        else:
+            self.estimate += LATENCY_WEIGHT * (latency - self.estimate)
+        self.estimate = min(self.estimate, READY_TIMEOUT)
+
+    def record_timeout(self):
+        """
+        Counts a field that was still not ready after READY_TIMEOUT.
+        """
+        self.timeouts += 1
+        self.estimate = READY_TIMEOUT
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'timeouts': self.timeouts,
+            'estimate': self.estimate,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.minimum,
+            'max': self.maximum
+        }
+
+
+_latency_stats = {}
+
+
+def get_latency_stats(address=None):
+    """
+    Returns the data ready latency statistics gathered in adaptive mode.
+
+    Output: A dict of {address: {fieldname: stats}}, where stats has the
+    keys "count", "timeouts", "estimate", "mean", "min" and "max" (seconds).
+    If address is given, only that module's {fieldname: stats} is returned.
+    """
+    output = {}
+    for (field_address, name), stats in list(_latency_stats.items()):
+        output.setdefault(field_address, {})[name] = stats.as_dict()
+    if address is not None:
+        return output.get(address, {})
+    return output
+
+
+def reset_latency_stats():
+    """
+    Forgets all learned latencies.
+    """
+    _latency_stats.clear()
+
+
+_buses = {}
+
+
+def get_bus(bus=None):
+    """
+    Returns the process-wide I2C handle for a bus (I2C_BUS_NUM by default).
+
+    The handle stays open and only re-issues the slave address ioctl when a
+    different module is addressed, so every MCU on the bus shares one file
+    descriptor.
+    """
+    if bus is None:
+        bus = I2C_BUS_NUM
+    if bus not in _buses:
+        _buses.setdefault(bus, i2c.I2C(bus=bus, persistent=True))
+    return _buses[bus]
+
 
 class MCU:
 
-    def __init__(self, address):
+    def __init__(self, address, i2cfile=None, adaptive=None):
         """
         Sets the bus number and stores the address
+
+        i2cfile can be given to use a specific I2C handle, otherwise the
+        shared handle for I2C_BUS_NUM is used.
+        adaptive selects data ready polling instead of a fixed DELAY.
+        Defaults to ADAPTIVE_DELAY.
         """
-        self.i2cfile = i2c.I2C(bus=I2C_BUS_NUM)
+        if i2cfile is None:
+            i2cfile = get_bus()
+        if adaptive is None:
+            adaptive = ADAPTIVE_DELAY
+        self.i2cfile = i2cfile
         self.address = address
+        self.adaptive = adaptive
+        # Seconds after the command of the last poll finding it not ready
+        self._polled = 0.0
 
     def write(self, command):
         """
@@ -271,9 +503,11 @@ class MCU:
 
     def _build_telemetry_dict(self, module, fields=["all"]):
         """
-        This method builds the dictionary of requested data.
+        This method builds the mapping of requested field names to their
+        compiled TelemetryFields.
         """
-        if module not in TELEMETRY:
+        registry = get_registry()
+        if module not in registry.modules:
             # Check that module is listed in config file
             raise KeyError(
                 'Module name: '+str(module)+' not found in mcu_config file.')
@@ -283,22 +517,17 @@ class MCU:
                 'fields argument must be a list of fieldnames from ' +
                 'the configuration data. Input: ' + str(fields))
 
-        module_telem = TELEMETRY[module]
-        supervisor_telem = TELEMETRY['supervisor']
+        all_fields = registry.all_fields[module]
         if fields == ["all"]:
             # Pulling all info
-            requests = module_telem
-            requests.update(supervisor_telem)
-            return requests
+            return all_fields
 
         # Builds requested dict
         # Validates fields input values
         requests = {}
         for field in fields:
-            if field in module_telem:
-                requests[field] = module_telem[field]
-            elif field in supervisor_telem:
-                requests[field] = supervisor_telem[field]
+            if field in all_fields:
+                requests[field] = all_fields[field]
             else:
                 raise KeyError('Invalid field: '+str(field))
         return requests
@@ -311,30 +540,108 @@ class MCU:
         # Create empty dictionary
         output_dict = {}
 
-        for telem_field in dict:
-            input_dict = dict[telem_field]
+        for field in dict.values():
             # Write command for the MCU to prepare the data
-            self.write(input_dict['command'])
+            self._send(field)
+            started = time.monotonic()
             # Delay time specified in the config parameter
             # (specified in the Pumpkin Firmware Reference Manual)
-            time.sleep(DELAY)
-            # Read the data
-            raw_read_data = self.read(count=input_dict['length']+HEADER_SIZE)
-            # Check and parse the header into a formatted dict
-            read_data = self._header_parse(raw_read_data)
-            # Parse the data
-            parsed_data = self._unpack(
-                parsing=input_dict['parsing'],
-                data=read_data['data'])
-            output_dict.update(
-                self._format_data(
-                    telem_field=telem_field,
-                    input_dict=input_dict,
-                    read_data=read_data,
-                    parsed_data=parsed_data))
+            # or learned in adaptive mode
+            wait = self._settle_time(field)
+            attempt = 0
+            while True:
+                time.sleep(wait)
+                result, wait = self._check_ready(field, started, attempt)
+                if result is not None:
+                    break
+                attempt += 1
+            output_dict.update(result)
 
         return output_dict
 
+    def _settle_time(self, field):
+        """
+        Seconds to wait after writing a field's command before checking it.
+        """
+        if not self.adaptive:
+            return DELAY
+        return self._latency(field).settle_time()
+
+    def _check_ready(self, field, started, attempt):
+        """
+        Called once a field's settle time has passed. started is when the
+        command was written, attempt how many polls already found the data
+        not ready.
+
+        Output: (formatted data, None) once the field has been read, or
+        (None, seconds to wait before the next poll) if it is not ready yet.
+        Outside adaptive mode the field is always read straight away.
+        """
+        if not self.adaptive:
+            return self._read_telemetry_item(field), None
+
+        elapsed = time.monotonic() - started
+        stats = self._latency(field)
+        # Polls read the header alone, and the field is read once it is ready
+        header = self.read(count=HEADER_SIZE)
+        if header[0] == 1:
+            stats.record((self._polled + elapsed) / 2, early=attempt == 0)
+            return self._read_telemetry_item(field), None
+        if elapsed >= READY_TIMEOUT:
+            # Returned with timestamp 0, like a late fixed DELAY
+            stats.record_timeout()
+            return self._read_telemetry_item(field), None
+
+        self._polled = elapsed
+        wait = min(POLL_INTERVAL * (2 ** attempt), POLL_INTERVAL_MAX,
+                   READY_TIMEOUT - elapsed)
+        return None, wait
+
+    def _latency(self, field):
+        """
+        Returns the LatencyStats for a field on this module.
+        """
+        key = (self.address, field.name)
+        stats = _latency_stats.get(key)
+        if stats is None:
+            stats = _latency_stats.setdefault(key, LatencyStats())
+        return stats
+
+    def _send(self, field):
+        """
+        Writes the precompiled command (stopbyte included) for a field.
+        """
+        self._polled = 0.0
+        return self.i2cfile.write(device=self.address, data=field.command)
+
+    def _read_telemetry_item(self, field):
+        """
+        Reads back a single field whose command has already been written
+        and returns it formatted for the output_dict.
+        """
+        # Read the data
+        raw_read_data = self.read(count=field.length+HEADER_SIZE)
+        return self._parse_telemetry_item(field, raw_read_data)
+
+    def _parse_telemetry_item(self, field, raw_read_data):
+        """
+        Parses a field read back from the MCU, header included, and returns
+        it formatted for the output_dict.
+        """
+        # Check and parse the header into a formatted dict
+        read_data = self._header_parse(raw_read_data)
+        # Parse the data
+        if field.struct is not None:
+            parsed_data = field.struct.unpack(read_data['data'])
+        else:
+            parsed_data = self._unpack(
+                parsing=field.parsing,
+                data=read_data['data'])
+        return self._format_data(
+            field=field,
+            read_data=read_data,
+            parsed_data=parsed_data)
+
     def _header_parse(self, data):
         """
         Parses the header data. Format is:
@@ -387,40 +694,291 @@ class MCU:
         # All others parse directly with the parsing string.
         return struct.unpack(parsing, data)
 
-    def _format_data(self, telem_field, input_dict, read_data, parsed_data):
+    def _format_data(self, field, read_data, parsed_data):
         """
-        Takes in the read data, parsed data, and the input dictionary and outputs
-        a formatted dictionary in the form of:
+        Takes in the read data, parsed data, and the compiled TelemetryField
+        and outputs a formatted dictionary in the form of:
         {
             'fieldname': {'timestamp': int,'data': parsed data},
             etc...
         }
+        The parsed data is already known to match the field's names, since
+        that is checked when the registry is compiled.
         """
+        timestamp = read_data['timestamp']
+        if field.names is None:
+            return {field.name: {'timestamp': timestamp, 'data': parsed_data[0]}}
+
         output_dict = {}
-        if "names" in input_dict:
-            if len(parsed_data) == 1:
-                raise KeyError(
-                    "Only one item parsed but subfields are listed: " +
-                    telem_field)
-        if len(parsed_data) > 1:
-            # Multiple items parsed
-            if "names" not in input_dict:
-                raise KeyError(
-                    "Must be a names field when multiple items are parsed: " +
-                    telem_field)
-            if len(input_dict['names']) != len(parsed_data):
-                raise KeyError(
-                    "Number of field names doesn't match parsing strings: " +
-                    telem_field)
-            for ind, field in enumerate(input_dict['names']):
-                output_dict.update(
-                    {field: {
-                        'timestamp': read_data['timestamp'],
-                        'data': parsed_data[ind]}})
+        for name, value in zip(field.names, parsed_data):
+            output_dict[name] = {'timestamp': timestamp, 'data': value}
+        return output_dict
 
-        else:
-            # Single item parsed - pull in dict then update with parsed data.
-            # Must be done in this order otherwise it generates a keyerror.
-            output_dict[telem_field] = read_data
-            output_dict[telem_field]['data'] = parsed_data[0]
-        return output_dict
\ No newline at end of file
+
+class TelemetryScan:
+    """
+    Reads telemetry from several SupMCUs in one interleaved pass.
+
+    A SupMCU only prepares one telemetry response at a time, but separate
+    modules settle independently. The scan keeps one command in flight per
+    module and reads each one back as soon as its DELAY has elapsed (or its
+    data is ready, for MCUs in adaptive mode), so
+    scanning N modules takes roughly as long as the slowest module instead
+    of the sum of all of them.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+        # module -> [MCU, deque of TelemetryField]
+        self._queues = {}
+        # Heap of (deadline, sequence, module, TelemetryField, started,
+        # attempt)
+        self._in_flight = []
+        self._busy = set()
+        self._sequence = 0
+
+    def add(self, module, address=None, fields=["all"], mcu=None,
+            adaptive=None):
+        """
+        Queues fields to read from a module.
+
+        Input:
+        module = string module name, as for MCU.read_telemetry.
+        address = I2C address of the module. Not needed if mcu is given.
+        fields = list of field names, as for MCU.read_telemetry.
+        mcu = optional existing MCU instance to read through.
+        adaptive = data ready polling mode for a new MCU, as for MCU().
+        """
+        if mcu is None:
+            if address is None:
+                raise TypeError('An address or MCU is required for module: ' +
+                                str(module))
+            mcu = MCU(address=address, adaptive=adaptive)
+        requests = mcu._build_telemetry_dict(module=module, fields=fields)
+        if module not in self._queues:
+            self._queues[module] = [mcu, deque()]
+            self.results[module] = {}
+        self._queues[module][1].extend(requests.values())
+
+    def busy(self, address):
+        """
+        Returns True if a command is in flight to the given address.
+        """
+        return address in self._busy
+
+    def step(self):
+        """
+        Advances the scan without blocking.
+
+        Writes the next command to every idle module, then reads back the
+        module with the earliest deadline if it is due.
+
+        Output: None once every field has been read, otherwise the number of
+        seconds until the next read is due (0 if more work is ready now).
+        """
+        now = time.monotonic()
+        for module, (mcu, queue) in list(self._queues.items()):
+            if not queue or mcu.address in self._busy:
+                continue
+            field = queue.popleft()
+            try:
+                mcu._send(field)
+            except Exception as e:
+                self._fail(module, e)
+                continue
+            self._busy.add(mcu.address)
+            self._schedule(module, field, now, now, 0)
+
+        if not self._in_flight:
+            return None
+
+        deadline = self._in_flight[0][0]
+        if deadline > now:
+            return deadline - now
+
+        (_, _, module, field, started, attempt) = heapq.heappop(
+            self._in_flight)
+        mcu = self._queues[module][0]
+        try:
+            result, wait = mcu._check_ready(field, started, attempt)
+        except Exception as e:
+            self._busy.discard(mcu.address)
+            self._fail(module, e)
+            return 0
+        if result is None:
+            # Not ready yet, poll this module again later
+            self._schedule(
+                module, field, time.monotonic() + wait, started, attempt + 1,
+                settle=False)
+            return 0
+        self._busy.discard(mcu.address)
+        self.results[module].update(result)
+        return 0
+
+    def run(self):
+        """
+        Runs the scan to completion.
+
+        Output: A dict keyed by module name. Each value matches what
+        MCU.read_telemetry returns for that module. Modules that failed are
+        left out of the results and their exception is stored in errors.
+        """
+        while True:
+            wait = self.step()
+            if wait is None:
+                return self.results
+            if wait > 0:
+                time.sleep(wait)
+
+    def _schedule(self, module, field, when, started, attempt, settle=True):
+        """
+        Queues a check of an in-flight field. New commands wait for the
+        MCU's settle time on top of when.
+        """
+        if settle:
+            when += self._queues[module][0]._settle_time(field)
+        self._sequence += 1
+        heapq.heappush(
+            self._in_flight,
+            (when, self._sequence, module, field, started, attempt))
+
+    def _fail(self, module, error):
+        """
+        Drops the rest of a module's fields after an I2C or parsing error.
+        """
+        self.errors[module] = error
+        self._queues[module][1].clear()
+        self.results.pop(module, None)
+
+
+def scan_telemetry(modules, fields=["all"], adaptive=None):
+    """
+    Reads telemetry from several modules with their settle delays overlapped.
+
+    Input:
+    modules = dict of module name to I2C address.
+    fields = list of field names read from every module. Defaults to ["all"].
+    adaptive = data ready polling mode, as for MCU().
+
+    Output: A dict keyed by module name, each value matching what
+    MCU.read_telemetry returns for that module. If any module failed, the
+    first error is raised once the other modules have been read.
+    """
+    scan = TelemetryScan()
+    for module, address in modules.items():
+        scan.add(
+            module=module, address=address, fields=fields, adaptive=adaptive)
+    results = scan.run()
+    for module in scan.errors:
+        raise scan.errors[module]
+    return results
+
+
+# event loop -> {key: asyncio.Lock}
+_async_locks = weakref.WeakKeyDictionary()
+
+
+def _get_async_lock(key):
+    """
+    Returns the asyncio lock for a key on the running event loop.
+    """
+    loop = asyncio.get_event_loop()
+    locks = _async_locks.setdefault(loop, {})
+    if key not in locks:
+        locks[key] = asyncio.Lock()
+    return locks[key]
+
+
+class AsyncMCU:
+    """
+    asyncio counterpart of MCU.
+
+    Settle delays are awaited instead of slept. Each bus transaction holds
+    an asyncio lock for its /dev/i2c-N and runs in the loop's executor, so
+    the event loop stays free while other modules settle or transfer.
+    A per-module lock keeps one command in flight per module, so concurrent
+    reads of the same module are interleaved field by field.
+    """
+
+    def __init__(self, address, i2cfile=None, adaptive=None, executor=None):
+        """
+        Same arguments as MCU. executor is the concurrent.futures executor
+        used for bus transactions, the loop's default one if None.
+        """
+        self.mcu = MCU(address=address, i2cfile=i2cfile, adaptive=adaptive)
+        self.address = address
+        self.executor = executor
+        self._bus_key = getattr(
+            self.mcu.i2cfile, 'filepath', id(self.mcu.i2cfile))
+
+    async def write(self, command):
+        """
+        Writes a command, appending the stopbyte. See MCU.write.
+        """
+        async with self._module_lock():
+            return await self._transact(self.mcu.write, command)
+
+    async def read(self, count):
+        async with self._module_lock():
+            return await self._transact(self.mcu.read, count=count)
+
+    async def read_telemetry(self, module, fields=["all"]):
+        """
+        Reads and parses telemetry fields. Same input and output as
+        MCU.read_telemetry.
+        """
+        requests = self.mcu._build_telemetry_dict(module=module, fields=fields)
+        output_dict = {}
+        for field in requests.values():
+            output_dict.update(await self._read_field(field))
+        return output_dict
+
+    async def _read_field(self, field):
+        """
+        Writes a field's command, awaits until it is ready and reads it.
+        """
+        async with self._module_lock():
+            await self._transact(self.mcu._send, field)
+            started = time.monotonic()
+            wait = self.mcu._settle_time(field)
+            attempt = 0
+            while True:
+                await asyncio.sleep(wait)
+                result, wait = await self._transact(
+                    self.mcu._check_ready, field, started, attempt)
+                if result is not None:
+                    return result
+                attempt += 1
+
+    async def _transact(self, function, *args, **kwargs):
+        """
+        Runs a blocking bus transaction with the bus lock held.
+        """
+        async with _get_async_lock(self._bus_key):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self.executor, functools.partial(function, *args, **kwargs))
+
+    def _module_lock(self):
+        return _get_async_lock((self._bus_key, self.address))
+
+
+async def async_scan_telemetry(modules, fields=["all"], adaptive=None):
+    """
+    asyncio counterpart of scan_telemetry. Every module is read
+    concurrently through an AsyncMCU.
+
+    Output: A dict keyed by module name, each value matching what
+    MCU.read_telemetry returns for that module. If any module failed, the
+    first error is raised once the other modules have been read.
+    """
+    names = list(modules)
+    outputs = await asyncio.gather(
+        *[AsyncMCU(address=modules[module], adaptive=adaptive).read_telemetry(
+            module=module, fields=fields) for module in names],
+        return_exceptions=True)
+    for output in outputs:
+        if isinstance(output, Exception):
+            raise output
+    return dict(zip(names, outputs))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Columnar bulk decoder for recorded SupMCU telemetry frames.
+
+A frame is the raw I2C read of one field: the 5-byte header (data ready
+flag and timestamp) followed by the field's payload. A buffer of frames of
+the same field is decoded in one vectorized pass into one NumPy array per
+column, instead of a dict per sample.
+
+Requires NumPy.
+"""
+
+import functools
+import re
+
+import numpy as np
+
+import mcu_api
+
+# struct format code -> NumPy type code, for standard sizes
+_TYPE_CODES = {
+    'b': 'i1', 'B': 'u1', '?': '?',
+    'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4', 'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8',
+    'e': 'f2', 'f': 'f4', 'd': 'f8',
+    'c': 'S1'
+}
+_BYTE_ORDERS = {'<': '<', '>': '>', '!': '>', '=': '='}
+
+
+@functools.lru_cache(maxsize=None)
+def frame_dtype(field):
+    """
+    Returns the NumPy structured dtype of one frame of a TelemetryField.
+
+    The dtype has "ready" and "timestamp" header columns, then one column
+    per value: named after the field's names, or the field itself for
+    single values. "str" fields are fixed-width byte strings and "hex"
+    fields fixed-width void (raw bytes) columns.
+    """
+    columns = [('ready', 'u1'), ('timestamp', '<i4')]
+    if field.parsing == "str":
+        columns.append((field.name, 'S{}'.format(field.length)))
+    elif field.parsing == "hex":
+        columns.append((field.name, 'V{}'.format(field.length)))
+    else:
+        columns.extend(_payload_columns(field))
+
+    dtype = np.dtype(columns)
+    if dtype.itemsize != mcu_api.HEADER_SIZE + field.length:
+        raise ValueError(
+            "Frame size doesn't match field length: " + field.name)
+    return dtype
+
+
+def _payload_columns(field):
+    """
+    Converts a field's struct format string into dtype columns.
+    """
+    parsing = field.parsing
+    if type(parsing) is bytes:
+        parsing = parsing.decode()
+    order = _BYTE_ORDERS.get(parsing[:1])
+    if order is None:
+        # Native alignment has no fixed layout to map onto
+        raise ValueError(
+            'Only standard size parsing strings can be bulk decoded: ' +
+            field.name)
+
+    types = []
+    padding = 0
+    for repeat, code in re.findall(r'(\d*)([a-zA-Z?])', parsing[1:]):
+        repeat = int(repeat or 1)
+        if code == 'x':
+            types.append(('_pad{}'.format(padding), 'V{}'.format(repeat)))
+            padding += 1
+        elif code in 'sp':
+            types.append((None, 'S{}'.format(repeat)))
+        elif code in _TYPE_CODES:
+            type_code = _TYPE_CODES[code]
+            if type_code[0] in 'iuf':
+                type_code = order + type_code
+            types.extend([(None, type_code)] * repeat)
+        else:
+            raise ValueError(
+                'Unsupported parsing code {}: {}'.format(code, field.name))
+
+    names = field.names or (field.name,)
+    values = [column for column in types if column[0] is None]
+    if len(values) != len(names):
+        raise KeyError(
+            "Number of field names doesn't match parsing strings: " +
+            field.name)
+    names = iter(names)
+    return [(name if name is not None else next(names), type_code)
+            for name, type_code in types]
+
+
+def decode_frames(field, buffer, count=-1, offset=0):
+    """
+    Decodes a buffer of back to back frames of one field.
+
+    Input:
+    field = TelemetryField, eg.
+    mcu_api.get_registry().all_fields["bm2"]["temperature"]
+    buffer = bytes-like object holding the frames
+    count = number of frames to decode, -1 for all of them
+    offset = byte offset of the first frame in the buffer
+
+    Output: A dict of column name to NumPy array, with one entry per frame:
+    "ready" (bool), "timestamp" (float seconds, 0 when the data ready flag
+    was not set, as for MCU.read_telemetry), then one column per value.
+    "str" columns are cut at the first null byte. "hex" columns hold the
+    raw bytes.
+    """
+    frames = np.frombuffer(
+        buffer, dtype=frame_dtype(field), count=count, offset=offset)
+
+    ready = frames['ready'] == 1
+    columns = {
+        'ready': ready,
+        'timestamp': np.where(ready, frames['timestamp'] / 100.0, 0.0)
+    }
+    for name in frames.dtype.names[2:]:
+        if name.startswith('_pad'):
+            continue
+        column = frames[name]
+        if field.parsing == "str":
+            column = _cut_at_null(column, field.length)
+        columns[name] = column
+    return columns
+
+
+def _cut_at_null(column, length):
+    """
+    Zeroes every byte after the first null of each string, so the
+    fixed-width byte strings end at the null terminator.
+    """
+    raw = np.ascontiguousarray(column).view('u1').reshape(-1, length).copy()
+    nulls = raw == 0
+    ends = np.where(nulls.any(axis=1), nulls.argmax(axis=1), length)
+    raw[np.arange(length) >= ends[:, None]] = 0
+    return raw.view('S{}'.format(length)).reshape(-1)
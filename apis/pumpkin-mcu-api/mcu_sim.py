@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Simulated SupMCU I2C bus for testing and benchmarking without hardware.
+
+SimulatedBus has the same interface as i2c.I2C, so it can be passed to
+mcu_api.MCU(address, i2cfile=bus) or used as the bus manager's handle.
+Modules are emulated from the compiled TELEMETRY registry.
+"""
+
+import errno
+import random
+import re
+import struct
+import threading
+import time
+
+import mcu_api
+
+
+class _SimulatedModule:
+    """
+    State of one emulated SupMCU.
+    """
+
+    def __init__(self, name, fields, latency, rng):
+        self.name = name
+        # Pretend the module has been up for a while
+        self.booted = time.monotonic() - rng.uniform(60, 86400)
+        # command bytes (stopbyte included) -> TelemetryField
+        self.commands = {field.command: field for field in fields.values()}
+        # fieldname -> base settle latency in seconds
+        self.latencies = {
+            field.name: rng.uniform(*latency) for field in fields.values()}
+        self.samples = {}
+        self.field = None
+        self.written = None
+        self.ready_at = None
+        self.response = b''
+
+
+class SimulatedBus:
+    """
+    Emulates SupMCU modules on an I2C bus.
+
+    Input:
+    modules = dict of I2C address to module name in TELEMETRY.
+    latency = (min, max) seconds. Each field is given a fixed settle
+    latency drawn from this range.
+    jitter = extra random latency (seconds) added to every request.
+    bit_rate = bus clock in bits per second, used to simulate transfer
+    time. None transfers instantly.
+    seed = random seed, so runs are repeatable.
+    registry = TelemetryRegistry to emulate. Defaults to get_registry().
+
+    Reads return the 5-byte header (data ready flag and timestamp in
+    hundredths of a second) followed by a payload of the field's length.
+    Until the field's latency has passed, the ready flag is 0. Every full
+    read is recorded in latencies for benchmarking.
+    """
+
+    def __init__(self, modules, latency=(0.005, 0.050), jitter=0.002,
+                 bit_rate=100000, seed=0, registry=None):
+        if registry is None:
+            registry = mcu_api.get_registry()
+        self.filepath = "sim"
+        self.persistent = True
+        self.jitter = jitter
+        self.bit_rate = bit_rate
+        self.latencies = []
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._modules = {}
+        for address, name in modules.items():
+            self._modules[address] = _SimulatedModule(
+                name, registry.all_fields[name], latency, self._rng)
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    def write(self, device, data):
+        if type(data) is list:
+            data = bytearray(data)
+        elif type(data) is not bytes:
+            raise TypeError('Invalid data format: ' +
+                            str(type(data))+', must be bytes or list')
+        module = self._module(device)
+        self._transfer(len(data))
+        now = time.monotonic()
+        with self._lock:
+            field = module.commands.get(bytes(data))
+            module.field = field
+            module.written = now
+            module.response = b''
+            if field is not None:
+                module.ready_at = (
+                    now + module.latencies[field.name] +
+                    self._rng.uniform(0, self.jitter))
+        return True, data
+
+    def read(self, device, count):
+        module = self._module(device)
+        self._transfer(count)
+        now = time.monotonic()
+        with self._lock:
+            field = module.field
+            if field is None:
+                return bytes(count)
+            if now < module.ready_at:
+                return bytes(count)
+            if not module.response:
+                module.response = self._response(module, field, now)
+            if count > mcu_api.HEADER_SIZE:
+                self.latencies.append(now - module.written)
+            data = module.response[:count]
+        return data + bytes(count - len(data))
+
+    def readinto(self, device, buf):
+        data = self.read(device, len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def write_read(self, device, data, count):
+        self.write(device, data)
+        return self.read(device, count)
+
+    def _module(self, device):
+        if device not in self._modules:
+            raise OSError(errno.ENXIO, 'No such device or address')
+        return self._modules[device]
+
+    def _transfer(self, count):
+        """
+        Sleeps for the time count bytes (plus the address byte) take on the
+        bus, at 9 clocks per byte.
+        """
+        if self.bit_rate:
+            time.sleep((count + 1) * 9.0 / self.bit_rate)
+
+    def _response(self, module, field, now):
+        """
+        Builds the header and a correctly sized payload for a field.
+        """
+        sample = module.samples.get(field.name, 0) + 1
+        module.samples[field.name] = sample
+        timestamp = int((now - module.booted) * 100)
+        header = b'\x01' + struct.pack('<i', timestamp)
+        if field.struct is not None:
+            values = []
+            for repeat, code in re.findall(r'(\d*)([a-zA-Z?])',
+                                           field.struct.format):
+                if code == 'x':
+                    continue
+                if code in 'sp':
+                    values.append(b'\x00')
+                    continue
+                for _ in range(int(repeat or 1)):
+                    values.append(self._value(code, sample))
+            payload = field.struct.pack(*values)
+        elif field.parsing == "str":
+            text = '{} {}'.format(module.name, field.name).encode()
+            payload = text[:field.length - 1]
+        else:
+            payload = bytes(
+                (sample + i) & 0xFF for i in range(field.length))
+        payload = payload[:field.length]
+        return header + payload + bytes(field.length - len(payload))
+
+    def _value(self, code, sample):
+        if code in 'fd':
+            return sample * 0.5
+        if code == '?':
+            return bool(sample & 1)
+        if code == 'c':
+            return b'\x00'
+        # Integer codes, kept within the range of a signed byte
+        return sample & 0x7F
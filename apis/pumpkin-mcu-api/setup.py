@@ -10,8 +10,11 @@ from setuptools import setup
 setup(name='pumpkin_mcu',
       version='0.1.5',
       description='KubOS API for communicating with Pumpkin module MCUs',
-      py_modules=["mcu_api"],
+      py_modules=["mcu_api", "mcu_sim", "mcu_decode"],
       install_requires=[
           'i2c'
-      ]
+      ],
+      extras_require={
+          'bulk': ['numpy']
+      }
       )
@@ -10,6 +10,7 @@ API for interacting with all Pumpkin SupMCUs.
 Unit test module for the pumpkin mcu api
 """
 
+import asyncio
 import unittest
 import mcu_api
 import mock
@@ -20,13 +21,18 @@ import mock
 mcu_api.DELAY = 0
 mcu_api.HEADER_SIZE = 5
 mcu_api.TELEMETRY = {
-    "supervisor": {},
+    "supervisor": {
+        "sup_field": {"command": "SUPCOMMAND", "length": 1, "parsing": "<B"}
+    },
     "module_1": {
         "field_1": {"command": "TESTCOMMAND", "length": 2, "parsing": "hex"},
         "field_2": {"command": "TESTCOMMAND", "length": 2, "parsing": "str"},
         "field_3": {"command": "TESTCOMMAND", "length": 2, "parsing": "<H"},
         "field_4": {"command": "TESTCOMMAND", "length": 4, "parsing": "<HH",
                     "names": ["subfield_1", "subfield_2"]}
+    },
+    "module_2": {
+        "field_5": {"command": "TESTCOMMAND2", "length": 2, "parsing": "<H"}
     }
 }
 
@@ -49,6 +55,11 @@ class TestMCUAPI(unittest.TestCase):
                 data=fake_command + b'\x0a',
                 device=self.mcu.address)
 
+    def test_shares_bus_handle(self):
+        other = mcu_api.MCU(address=0x21)
+        self.assertIs(self.mcu.i2cfile, other.i2cfile)
+        self.assertTrue(self.mcu.i2cfile.persistent)
+
     def test_read(self):
         read_count = 20
         with mock.patch('i2c.I2C.read') as mock_i2cread:
@@ -73,15 +84,19 @@ class TestMCUAPI(unittest.TestCase):
                 fields=bad_fields)
 
     def test_build_telemetry_dict_all(self):
-        requests_assert = mcu_api.TELEMETRY['module_1']
-        self.assertEqual(self.mcu._build_telemetry_dict(
-            module="module_1"),
-            requests_assert)
+        requests = self.mcu._build_telemetry_dict(module="module_1")
+        self.assertEqual(
+            list(requests),
+            ["field_1", "field_2", "field_3", "field_4", "sup_field"])
+
+    def test_build_telemetry_dict_all_leaves_table_unchanged(self):
+        self.mcu._build_telemetry_dict(module="module_1")
+        self.assertNotIn("sup_field", mcu_api.TELEMETRY['module_1'])
 
     def test_build_telemetry_dict_field(self):
         requests_assert = {}
         requests_assert['field_1'] = \
-            mcu_api.TELEMETRY['module_1']['field_1']
+            mcu_api.get_registry().modules['module_1']['field_1']
         self.assertEqual(
             self.mcu._build_telemetry_dict(
                 module="module_1",
@@ -131,7 +146,7 @@ class TestMCUAPI(unittest.TestCase):
 
     def test_format_data_oneitem(self):
         fake_telem_field = 'field_1'  # Single item
-        fake_input_dict = mcu_api.TELEMETRY['module_1'][fake_telem_field]
+        fake_field = mcu_api.get_registry().modules['module_1'][fake_telem_field]
         fake_timestamp = 100.00
         fake_read_data = {'timestamp': fake_timestamp, 'data': None}
         fake_data = 200
@@ -142,8 +157,7 @@ class TestMCUAPI(unittest.TestCase):
         }
         self.assertEqual(
             self.mcu._format_data(
-                telem_field=fake_telem_field,
-                input_dict=fake_input_dict,
+                field=fake_field,
                 read_data=fake_read_data,
                 parsed_data=fake_parsed_data
             ),
@@ -151,7 +165,7 @@ class TestMCUAPI(unittest.TestCase):
 
     def test_format_data_multiitem(self):
         fake_telem_field = 'field_4'  # Has subfields
-        fake_input_dict = mcu_api.TELEMETRY['module_1'][fake_telem_field]
+        fake_field = mcu_api.get_registry().modules['module_1'][fake_telem_field]
         fake_timestamp = 100.00
         fake_read_data = {'timestamp': fake_timestamp, 'data': None}
         fake_data1 = 100
@@ -167,62 +181,18 @@ class TestMCUAPI(unittest.TestCase):
         }
         self.assertEqual(
             self.mcu._format_data(
-                telem_field=fake_telem_field,
-                input_dict=fake_input_dict,
+                field=fake_field,
                 read_data=fake_read_data,
                 parsed_data=fake_parsed_data
             ),
             output_assert)
 
-    def test_format_data_parsingrejection(self):
-        fake_telem_field = 'field_4'  # Has subfields
-        fake_input_dict = mcu_api.TELEMETRY['module_1'][fake_telem_field]
-        fake_read_data = {'timestamp': 100.00, 'data': None}
-        bad_parsed_data = ('whatever stuff',)
-        with self.assertRaises(KeyError):
-            self.mcu._format_data(
-                telem_field=fake_telem_field,
-                input_dict=fake_input_dict,
-                read_data=fake_read_data,
-                parsed_data=bad_parsed_data)
-
-    def test_format_data_namesrejection(self):
-        bad_telem_field = 'field_1'  # Single item
-        fake_input_dict = mcu_api.TELEMETRY['module_1'][bad_telem_field]
-        fake_read_data = {'timestamp': 100.00, 'data': None}
-        fake_parsed_data = (  # Multiple items
-            'whatever stuff',
-            'whatever other stuff'
-        )
-        with self.assertRaises(KeyError):
-            self.mcu._format_data(
-                telem_field=bad_telem_field,
-                input_dict=fake_input_dict,
-                read_data=fake_read_data,
-                parsed_data=fake_parsed_data)
-
-    def test_format_data_lengthrejection(self):
-        fake_telem_field = 'field_4'  # Single item
-        fake_input_dict = mcu_api.TELEMETRY['module_1'][fake_telem_field]
-        fake_read_data = {'timestamp': 100.00, 'data': None}
-        bad_parsed_data = (  # More than number of subfields
-            'whatever stuff',
-            'whatever other stuff',
-            'and things'
-        )
-        with self.assertRaises(KeyError):
-            self.mcu._format_data(
-                telem_field=fake_telem_field,
-                input_dict=fake_input_dict,
-                read_data=fake_read_data,
-                parsed_data=bad_parsed_data)
-
     def test_read_telemetry(self):
         module = 'module_1'
         field = 'field_1'
         fields = [field]
         input_assert = {}
-        input_assert[field] = mcu_api.TELEMETRY[module][field]
+        input_assert[field] = mcu_api.get_registry().modules[module][field]
         with mock.patch('mcu_api.MCU._read_telemetry_items') as mock_read_telemetry_items:
             self.mcu.read_telemetry(
                 module=module,
@@ -235,7 +205,7 @@ class TestMCUAPI(unittest.TestCase):
         field = 'field_2'
         fields = [field]
         input_dict = {}
-        input_dict[field] = mcu_api.TELEMETRY[module][field]
+        input_dict[field] = mcu_api.get_registry().modules[module][field]
         output_data = b'this should be returned'
         fake_timestamp = 841489.94
         return_data = b'\x01\x02\x03\x04\x05' + output_data + \
@@ -244,11 +214,325 @@ class TestMCUAPI(unittest.TestCase):
             'timestamp': fake_timestamp,
             'data': output_data.decode()
         }}
-        with mock.patch('mcu_api.MCU.write') as mock_write, mock.patch('mcu_api.MCU.read') as mock_read:
+        with mock.patch('i2c.I2C.write') as mock_write, mock.patch('mcu_api.MCU.read') as mock_read:
             mock_read.return_value = return_data
             self.assertEqual(
                 self.mcu._read_telemetry_items(dict=input_dict),
                 output_assert)
+            mock_write.assert_called_with(
+                device=self.mcu.address,
+                data=b'TESTCOMMAND\x0a')
+
+
+class TestTelemetryRegistry(unittest.TestCase):
+
+    def test_compiles_command_and_struct(self):
+        field = mcu_api.get_registry().modules['module_1']['field_4']
+        self.assertEqual(field.command, b'TESTCOMMAND\x0a')
+        self.assertEqual(field.struct.format, '<HH')
+        self.assertEqual(field.names, ('subfield_1', 'subfield_2'))
+
+    def test_special_parsing_has_no_struct(self):
+        field = mcu_api.get_registry().modules['module_1']['field_2']
+        self.assertIsNone(field.struct)
+        self.assertIsNone(field.names)
+
+    def test_registry_is_read_only(self):
+        registry = mcu_api.get_registry()
+        with self.assertRaises(TypeError):
+            registry.all_fields['module_1']['field_1'] = None
+
+    def test_recompiles_replaced_table(self):
+        original = mcu_api.TELEMETRY
+        try:
+            mcu_api.TELEMETRY = {"supervisor": {}, "other": {}}
+            self.assertIn("other", mcu_api.get_registry().modules)
+        finally:
+            mcu_api.TELEMETRY = original
+        self.assertIn("module_1", mcu_api.get_registry().modules)
+
+    def test_parsingrejection(self):
+        bad_table = {"supervisor": {}, "module": {
+            "field": {"command": "CMD", "length": 4, "parsing": 123}}}
+        with self.assertRaises(TypeError):
+            mcu_api.TelemetryRegistry(bad_table)
+
+    def test_namesrejection(self):
+        bad_table = {"supervisor": {}, "module": {
+            "field": {"command": "CMD", "length": 4, "parsing": "<HH"}}}
+        with self.assertRaises(KeyError):
+            mcu_api.TelemetryRegistry(bad_table)
+
+    def test_single_item_namesrejection(self):
+        bad_table = {"supervisor": {}, "module": {
+            "field": {"command": "CMD", "length": 2, "parsing": "<H",
+                      "names": ["subfield_1"]}}}
+        with self.assertRaises(KeyError):
+            mcu_api.TelemetryRegistry(bad_table)
+
+    def test_lengthrejection(self):
+        bad_table = {"supervisor": {}, "module": {
+            "field": {"command": "CMD", "length": 4, "parsing": "<HH",
+                      "names": ["subfield_1", "subfield_2", "subfield_3"]}}}
+        with self.assertRaises(KeyError):
+            mcu_api.TelemetryRegistry(bad_table)
+
+    def test_sizerejection(self):
+        bad_table = {"supervisor": {}, "module": {
+            "field": {"command": "CMD", "length": 3, "parsing": "<H"}}}
+        with self.assertRaises(ValueError):
+            mcu_api.TelemetryRegistry(bad_table)
+
+
+class TestTelemetryScan(unittest.TestCase):
+
+    def test_scan_interleaves_modules(self):
+        calls = []
+
+        def fake_write(i2cfile, device, data):
+            calls.append(('write', device))
+
+        def fake_read(mcu, count):
+            calls.append(('read', mcu.address))
+            return b'\x01\x02\x03\x04\x05' + b'\x07\x00'
+
+        with mock.patch('i2c.I2C.write', autospec=True) as mock_write, \
+                mock.patch('mcu_api.MCU.read', autospec=True) as mock_read:
+            mock_write.side_effect = fake_write
+            mock_read.side_effect = fake_read
+            scan = mcu_api.TelemetryScan()
+            scan.add(module="module_1", address=0x20, fields=["field_3"])
+            scan.add(module="module_2", address=0x21, fields=["field_5"])
+            results = scan.run()
+
+        # Both modules are commanded before either is read back
+        self.assertEqual(
+            calls[:2],
+            [('write', 0x20), ('write', 0x21)])
+        self.assertEqual(
+            results,
+            {
+                "module_1": {"field_3": {'timestamp': 841489.94, 'data': 7}},
+                "module_2": {"field_5": {'timestamp': 841489.94, 'data': 7}}
+            })
+
+    def test_scan_matches_read_telemetry(self):
+        def fake_read(count):
+            payload = b'\x01\x00\x02\x00'
+            return b'\x01\x02\x03\x04\x05' + payload[:count - 5]
+
+        fields = ["field_3", "field_4"]
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read:
+            mock_read.side_effect = fake_read
+            expected = mcu_api.MCU(address=0x20).read_telemetry(
+                module="module_1",
+                fields=fields)
+            scan = mcu_api.TelemetryScan()
+            scan.add(module="module_1", address=0x20, fields=fields)
+            self.assertEqual(scan.run(), {"module_1": expected})
+
+    def test_scan_records_module_errors(self):
+        def fake_write(i2cfile, device, data):
+            if device == 0x21:
+                raise IOError("no ack")
+
+        with mock.patch('i2c.I2C.write', autospec=True) as mock_write, \
+                mock.patch('mcu_api.MCU.read') as mock_read:
+            mock_write.side_effect = fake_write
+            mock_read.return_value = b'\x01\x02\x03\x04\x05\x07\x00'
+            scan = mcu_api.TelemetryScan()
+            scan.add(module="module_1", address=0x20, fields=["field_3"])
+            scan.add(module="module_2", address=0x21, fields=["field_5"])
+            results = scan.run()
+
+        self.assertIn("module_1", results)
+        self.assertNotIn("module_2", results)
+        self.assertIsInstance(scan.errors["module_2"], IOError)
+
+    def test_scan_requires_address(self):
+        scan = mcu_api.TelemetryScan()
+        with self.assertRaises(TypeError):
+            scan.add(module="module_1")
+
+
+class TestAdaptiveDelay(unittest.TestCase):
+
+    def setUp(self):
+        mcu_api.reset_latency_stats()
+        self.mcu = mcu_api.MCU(address=0x20, adaptive=True)
+        self.field = mcu_api.get_registry().modules['module_1']['field_3']
+
+    def fake_reads(self, not_ready_polls):
+        """
+        Returns a read side effect whose data is not ready for the given
+        number of polls.
+        """
+        polls = []
+
+        def fake_read(count):
+            polls.append(count)
+            if len(polls) <= not_ready_polls:
+                return bytes(count)
+            return b'\x01\x02\x03\x04\x05\x07\x00'[:count]
+
+        return fake_read
+
+    def test_polls_until_ready(self):
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read:
+            mock_read.side_effect = self.fake_reads(not_ready_polls=2)
+            output = self.mcu._read_telemetry_items(
+                dict={'field_3': self.field})
+
+        self.assertEqual(
+            output, {'field_3': {'timestamp': 841489.94, 'data': 7}})
+        # The header is polled until ready, then the field is read once
+        self.assertEqual(
+            mock_read.call_args_list,
+            [mock.call(count=5)] * 3 + [mock.call(count=7)])
+        stats = mcu_api.get_latency_stats(address=0x20)['field_3']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+
+    def test_times_out(self):
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read, \
+                mock.patch('mcu_api.READY_TIMEOUT', 0):
+            mock_read.side_effect = lambda count: b'\x00' * count
+            output = self.mcu._read_telemetry_items(
+                dict={'field_3': self.field})
+
+        self.assertEqual(output['field_3']['timestamp'], 0)
+        stats = mcu_api.get_latency_stats()[0x20]['field_3']
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['count'], 0)
+
+    def test_estimate_learns_latency(self):
+        stats = mcu_api.LatencyStats()
+        for _ in range(50):
+            stats.record(0.010)
+        self.assertAlmostEqual(stats.estimate, 0.010, places=4)
+        self.assertLess(stats.settle_time(), 0.010)
+        self.assertEqual(stats.as_dict()['count'], 50)
+
+    def test_estimate_drops_when_ready_early(self):
+        with mock.patch('mcu_api.DELAY', 0.200):
+            stats = mcu_api.LatencyStats()
+        stats.record(0.050, early=True)
+        self.assertEqual(stats.estimate, 0.050)
+
+    def test_records_midpoint(self):
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read, \
+                mock.patch('time.monotonic') as mock_time:
+            mock_read.side_effect = self.fake_reads(not_ready_polls=1)
+            self.mcu._send(self.field)
+            mock_time.return_value = 0.020
+            self.assertEqual(
+                self.mcu._check_ready(self.field, 0.0, 0), (None, 0.002))
+            mock_time.return_value = 0.030
+            result, _ = self.mcu._check_ready(self.field, 0.0, 1)
+
+        self.assertEqual(result, {'field_3': {'timestamp': 841489.94, 'data': 7}})
+        stats = mcu_api.get_latency_stats(address=0x20)['field_3']
+        self.assertAlmostEqual(stats['mean'], 0.025)
+
+    def test_settle_time_capped_at_delay(self):
+        stats = mcu_api.LatencyStats()
+        with mock.patch('mcu_api.DELAY', 0.05):
+            stats.record(1.0)
+            self.assertEqual(stats.settle_time(), 0.05)
+
+    def test_fixed_delay_reads_field_once(self):
+        mcu = mcu_api.MCU(address=0x20, adaptive=False)
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read:
+            mock_read.side_effect = self.fake_reads(not_ready_polls=0)
+            mcu._read_telemetry_items(dict={'field_3': self.field})
+        mock_read.assert_called_once_with(count=7)
+
+    def test_scan_polls_until_ready(self):
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read:
+            mock_read.side_effect = self.fake_reads(not_ready_polls=1)
+            scan = mcu_api.TelemetryScan()
+            scan.add(module="module_1", mcu=self.mcu, fields=["field_3"])
+            results = scan.run()
+
+        self.assertEqual(
+            results,
+            {"module_1": {'field_3': {'timestamp': 841489.94, 'data': 7}}})
+
+
+class TestAsyncMCU(unittest.TestCase):
+
+    def test_read_telemetry_matches_sync(self):
+        return_data = b'\x01\x02\x03\x04\x05' + b'\x07\x00'
+        with mock.patch('i2c.I2C.write'), \
+                mock.patch('mcu_api.MCU.read') as mock_read:
+            mock_read.return_value = return_data
+            expected = mcu_api.MCU(address=0x20).read_telemetry(
+                module="module_1", fields=["field_3"])
+            output = asyncio.run(
+                mcu_api.AsyncMCU(address=0x20).read_telemetry(
+                    module="module_1", fields=["field_3"]))
+        self.assertEqual(output, expected)
+
+    def test_write_appends_stopbyte(self):
+        with mock.patch('i2c.I2C.write') as mock_write:
+            asyncio.run(mcu_api.AsyncMCU(address=0x20).write(b'SUP:LED ON'))
+            mock_write.assert_called_with(
+                device=0x20, data=b'SUP:LED ON\x0a')
+
+    def test_modules_progress_concurrently(self):
+        calls = []
+
+        def fake_write(i2cfile, device, data):
+            calls.append(('write', device))
+
+        def fake_read(mcu, count):
+            calls.append(('read', mcu.address))
+            return b'\x01\x02\x03\x04\x05\x07'
+
+        with mock.patch('i2c.I2C.write', autospec=True) as mock_write, \
+                mock.patch('mcu_api.MCU.read', autospec=True) as mock_read, \
+                mock.patch('mcu_api.DELAY', 0.05):
+            mock_write.side_effect = fake_write
+            mock_read.side_effect = fake_read
+            results = asyncio.run(mcu_api.async_scan_telemetry(
+                modules={"module_1": 0x20, "module_2": 0x21},
+                fields=["sup_field"]))
+
+        self.assertEqual(
+            sorted(calls[:2]), [('write', 0x20), ('write', 0x21)])
+        self.assertEqual(
+            results["module_2"],
+            {"sup_field": {'timestamp': 841489.94, 'data': 7}})
+
+    def test_same_module_is_serialized(self):
+        calls = []
+
+        def fake_write(i2cfile, device, data):
+            calls.append('write')
+
+        def fake_read(mcu, count):
+            calls.append('read')
+            return b'\x01\x02\x03\x04\x05\x07\x00'
+
+        async def read_twice():
+            mcu = mcu_api.AsyncMCU(address=0x20)
+            return await asyncio.gather(
+                mcu.read_telemetry(module="module_1", fields=["field_3"]),
+                mcu.read_telemetry(module="module_1", fields=["field_3"]))
+
+        with mock.patch('i2c.I2C.write', autospec=True) as mock_write, \
+                mock.patch('mcu_api.MCU.read', autospec=True) as mock_read:
+            mock_write.side_effect = fake_write
+            mock_read.side_effect = fake_read
+            asyncio.run(read_twice())
+
+        self.assertEqual(calls, ['write', 'read', 'write', 'read'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit test module for the bulk telemetry frame decoder
+"""
+
+import struct
+import unittest
+import mcu_api
+import mcu_decode
+import mock
+
+############################
+# Testing configuration data
+
+TELEMETRY = {
+    "supervisor": {
+        "firmware_version": {"command": "SUP:TEL? 0,data", "length": 8, "parsing": "str"},
+        "cpu_selftests":    {"command": "SUP:TEL? 4,data", "length": 22, "parsing": "<QQhhh",
+                             "names": ["selftest0", "selftest1", "selftest2", "selftest3", "selftest4"]},
+        "mcu_load":         {"command": "SUP:TEL? 8,data", "length": 4, "parsing": "<f"}
+    },
+    "module_1": {
+        "status":           {"command": "MOD:TEL? 0,data", "length": 2, "parsing": "hex"},
+        "batt":             {"command": "MOD:TEL? 1,data", "length": 5, "parsing": "<hHB",
+                             "names": ["batt_current", "batt_voltage", "batt_status"]},
+        "padded":           {"command": "MOD:TEL? 2,data", "length": 4, "parsing": ">2xH"},
+        "native":           {"command": "MOD:TEL? 3,data", "length": 2, "parsing": "H"}
+    }
+}
+
+
+def frame(ready, timestamp, payload):
+    return struct.pack('<Bi', ready, timestamp) + payload
+
+
+class TestDecodeFrames(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(mcu_api, 'TELEMETRY', TELEMETRY)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fields = mcu_api.get_registry().all_fields['module_1']
+        self.mcu = mcu_api.MCU(address=0x20)
+
+    def assert_matches_mcu(self, field, frames):
+        columns = mcu_decode.decode_frames(field, b''.join(frames))
+        for index, raw in enumerate(frames):
+            with mock.patch('mcu_api.MCU.read') as mock_read:
+                mock_read.return_value = raw
+                expected = self.mcu._read_telemetry_item(field)
+            for name, value in expected.items():
+                self.assertEqual(
+                    columns['timestamp'][index], value['timestamp'])
+                decoded = columns[name][index]
+                if field.parsing == "str":
+                    decoded = decoded.decode()
+                self.assertAlmostEqual(decoded, value['data'], places=5)
+
+    def test_struct_with_names(self):
+        field = self.fields['cpu_selftests']
+        frames = [frame(1, 100 + i, struct.pack('<QQhhh', i, 2 * i, -i, 3, 4))
+                  for i in range(10)]
+        self.assert_matches_mcu(field, frames)
+
+    def test_single_float(self):
+        field = self.fields['mcu_load']
+        frames = [frame(1, i, struct.pack('<f', i * 0.25)) for i in range(5)]
+        self.assert_matches_mcu(field, frames)
+
+    def test_mixed_types(self):
+        field = self.fields['batt']
+        frames = [frame(1, 7, struct.pack('<hHB', -300, 8000, 1)),
+                  frame(1, 8, struct.pack('<hHB', 300, 8100, 0))]
+        self.assert_matches_mcu(field, frames)
+
+    def test_str(self):
+        field = self.fields['firmware_version']
+        frames = [frame(1, 1, b'v1.0\0abc'), frame(1, 2, b'12345678')]
+        self.assert_matches_mcu(field, frames)
+
+    def test_hex(self):
+        field = self.fields['status']
+        columns = mcu_decode.decode_frames(
+            field, frame(1, 1, b'\x12\x34') + frame(1, 2, b'\x00\xff'))
+        self.assertEqual(columns['status'][0].tobytes(), b'\x12\x34')
+        self.assertEqual(columns['status'][1].tobytes(), b'\x00\xff')
+
+    def test_padding_and_big_endian(self):
+        field = self.fields['padded']
+        columns = mcu_decode.decode_frames(
+            field, frame(1, 1, b'\xaa\xbb\x01\x02'))
+        self.assertEqual(columns['padded'][0], 0x0102)
+        self.assertNotIn('_pad0', columns)
+
+    def test_not_ready(self):
+        field = self.fields['mcu_load']
+        columns = mcu_decode.decode_frames(
+            field,
+            frame(0, 500, struct.pack('<f', 1)) +
+            frame(1, 500, struct.pack('<f', 1)))
+        self.assertEqual(list(columns['ready']), [False, True])
+        self.assertEqual(list(columns['timestamp']), [0, 5.0])
+
+    def test_count_and_offset(self):
+        field = self.fields['mcu_load']
+        frames = b'xx' + b''.join(
+            frame(1, i, struct.pack('<f', i)) for i in range(4))
+        columns = mcu_decode.decode_frames(field, frames, count=2, offset=2)
+        self.assertEqual(list(columns['mcu_load']), [0.0, 1.0])
+
+    def test_native_alignment_rejected(self):
+        with self.assertRaises(ValueError):
+            mcu_decode.frame_dtype(self.fields['native'])
+
+    def test_frame_dtype_size(self):
+        dtype = mcu_decode.frame_dtype(self.fields['cpu_selftests'])
+        self.assertEqual(dtype.itemsize, mcu_api.HEADER_SIZE + 22)
+        self.assertEqual(
+            dtype.names,
+            ('ready', 'timestamp', 'selftest0', 'selftest1', 'selftest2',
+             'selftest3', 'selftest4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
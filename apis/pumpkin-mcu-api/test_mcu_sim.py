@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit test module for the simulated SupMCU bus
+"""
+
+import unittest
+import mcu_api
+import mcu_sim
+import mock
+
+############################
+# Testing configuration data
+
+TELEMETRY = {
+    "supervisor": {
+        "firmware_version": {"command": "SUP:TEL? 0,data", "length": 48, "parsing": "str"},
+        "time":             {"command": "SUP:TEL? 5,data", "length": 8, "parsing": "<Q"}
+    },
+    "pim": {
+        "channel_currents": {"command": "PIM:TEL? 0,data", "length": 8, "parsing": "<HHHH",
+                             "names": ["channel0_current", "channel1_current", "channel2_current", "channel3_current"]},
+        "status":           {"command": "PIM:TEL? 5,data", "length": 1, "parsing": "hex"}
+    }
+}
+
+
+class TestSimulatedBus(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(mcu_api, 'TELEMETRY', TELEMETRY)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bus = mcu_sim.SimulatedBus(
+            modules={0x53: "pim"}, latency=(0, 0), jitter=0, bit_rate=None)
+        self.mcu = mcu_api.MCU(address=0x53, i2cfile=self.bus)
+
+    def test_read_telemetry(self):
+        output = self.mcu.read_telemetry(module="pim")
+        self.assertEqual(
+            sorted(output),
+            ["channel0_current", "channel1_current", "channel2_current",
+             "channel3_current", "firmware_version", "status", "time"])
+        self.assertEqual(output["firmware_version"]["data"],
+                         "pim firmware_version")
+        self.assertEqual(output["channel2_current"]["data"], 1)
+        self.assertNotEqual(output["time"]["timestamp"], 0)
+        self.assertEqual(len(self.bus.latencies), 4)
+
+    def test_samples_change(self):
+        first = self.mcu.read_telemetry(module="pim", fields=["time"])
+        second = self.mcu.read_telemetry(module="pim", fields=["time"])
+        self.assertEqual(second["time"]["data"], first["time"]["data"] + 1)
+
+    def test_not_ready_before_latency(self):
+        bus = mcu_sim.SimulatedBus(
+            modules={0x53: "pim"}, latency=(10, 10), jitter=0, bit_rate=None)
+        bus.write(0x53, b'PIM:TEL? 5,data\x0a')
+        self.assertEqual(bus.read(0x53, 6), b'\x00' * 6)
+        self.assertEqual(bus.latencies, [])
+
+    def test_adaptive_read(self):
+        bus = mcu_sim.SimulatedBus(
+            modules={0x53: "pim"}, latency=(0.01, 0.01), jitter=0,
+            bit_rate=None)
+        mcu = mcu_api.MCU(address=0x53, i2cfile=bus, adaptive=True)
+        output = mcu.read_telemetry(module="pim", fields=["status"])
+        self.assertNotEqual(output["status"]["timestamp"], 0)
+        self.assertGreaterEqual(bus.latencies[0], 0.01)
+
+    def test_unknown_command_has_no_data(self):
+        self.bus.write(0x53, b'SUP:LED ON\x0a')
+        self.assertEqual(self.bus.read(0x53, 6), b'\x00' * 6)
+
+    def test_unknown_address(self):
+        with self.assertRaises(OSError):
+            self.bus.write(0x20, b'SUP:LED ON\x0a')
+
+    def test_readinto(self):
+        self.bus.write(0x53, b'PIM:TEL? 5,data\x0a')
+        buf = bytearray(6)
+        self.assertEqual(self.bus.readinto(0x53, buf), 6)
+        self.assertEqual(buf[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -53,41 +53,40 @@ def get_telemetry(logger):
     logger.info("Gathering telemetry")
 
     # Get the current amount of available memory from the monitor service
-    try:
-        request = '{memInfo{available}}'
-        response = SERVICES.query(service="monitor-service", query=request)
-    except Exception as e: 
-        logger.error("Something went wrong: " + str(e) + "")
-        return
-        
-    data = response["memInfo"]
-    available = data["available"]
-    
-    logger.info("Current available memory: %s kB" % (available))
+    # and the installed apps from the apps service, both at once
+    (mem_info, apps) = SERVICES.query_many([
+        ("monitor-service", '{memInfo{available}}'),
+        ("app-service", '{ registeredApps { active } }')])
     
-    request = '''
-        mutation {
-            insert(subsystem: "OBC", parameter: "available_mem", value: "%s") {
-                success,
-                errors
-            }
-        }
-        ''' % (available)
-    
-    # Save the result to the telemetry database
-    try:
-        response = SERVICES.query(service="telemetry-service", query=request)
-    except Exception as e: 
-        logger.error("Something went wrong: " + str(e) + "")
+    # Save whichever results arrived to the telemetry database
+    points = []
+    if isinstance(mem_info, Exception):
+        logger.error("Something went wrong: " + str(mem_info) + "")
+    else:
+        available = mem_info["memInfo"]["available"]
+        logger.info("Current available memory: %s kB" % (available))
+        points.append(("available_mem", available))
+    if isinstance(apps, Exception):
+        logger.error("Something went wrong: " + str(apps) + "")
+    else:
+        active = len([app for app in apps["registeredApps"] if app["active"]])
+        logger.info("Current active applications: %s" % (active))
+        points.append(("active_apps", active))
+    if not points:
         return
-        
-    data = response["insert"]
-    success = data["success"]
-    errors = data["errors"]
     
-    if success == False:
-        logger.error("Telemetry insert encountered errors: " + str(errors) + "")
-    else:
+    for (parameter, value) in points:
+        TELEMETRY.write("OBC", parameter, value)
+    logger.info("Telemetry queued for insert")
+
+# Send the queued telemetry and report how the inserts went
+def close_telemetry(logger):
+
+    TELEMETRY.close()
+    stats = TELEMETRY.stats()
+    if stats["failed"]:
+        logger.error("Telemetry insert encountered errors: " + str(stats["last_error"]) + "")
+    elif stats["sent"]:
         logger.info("Telemetry insert completed successfully")
         
 def main():
@@ -128,12 +127,18 @@ def main():
     else:
         SERVICES = app_api.Services()
 
-    if args.mode == 'safemode':
-        safe_mode(logger, args.time)
-    elif args.apps is not None:
-        get_apps(logger)
-    else:
-        get_telemetry(logger)
+    # One writer batches every telemetry insert of the application
+    global TELEMETRY
+    TELEMETRY = app_api.TelemetryWriter(SERVICES)
+    try:
+        if args.mode == 'safemode':
+            safe_mode(logger, args.time)
+        elif args.apps is not None:
+            get_apps(logger)
+        else:
+            get_telemetry(logger)
+    finally:
+        close_telemetry(logger)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -9,20 +9,85 @@
 I2C Library
 """
 
+import ctypes
 import io
 import sys
 import fcntl
+import threading
 
 I2C_SLAVE = 0x0703
+I2C_RDWR = 0x0707
+I2C_M_RD = 0x0001
+
+
+class _I2CMsg(ctypes.Structure):
+    """
+    struct i2c_msg from linux/i2c.h
+    """
+    _fields_ = [
+        ('addr', ctypes.c_uint16),
+        ('flags', ctypes.c_uint16),
+        ('len', ctypes.c_uint16),
+        ('buf', ctypes.c_void_p)
+    ]
+
+
+class _I2CRdwrData(ctypes.Structure):
+    """
+    struct i2c_rdwr_ioctl_data from linux/i2c-dev.h
+    """
+    _fields_ = [
+        ('msgs', ctypes.POINTER(_I2CMsg)),
+        ('nmsgs', ctypes.c_uint32)
+    ]
 
 
 class I2C:
 
-    def __init__(self, bus):
+    def __init__(self, bus, persistent=False):
         """
         Retrieves the read/write file handle for the device
+
+        If persistent is True the device file is opened on first use and
+        kept open until close() is called, and the slave address is only
+        set again when a different device is addressed. Otherwise every
+        transaction opens and closes the device file.
         """
         self.filepath = "/dev/i2c-"+str(bus)
+        self.persistent = persistent
+        self._file = None
+        self._device = None
+        self._lock = threading.Lock()
+        self._was_persistent = persistent
+
+    def __enter__(self):
+        # Restored by __exit__
+        self._was_persistent = self.persistent
+        self.persistent = True
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        self.persistent = self._was_persistent
+
+    def open(self):
+        """
+        Opens the long-lived file handle used in persistent mode.
+        """
+        if self._file is None:
+            self._file = io.open(self.filepath, "r+b", buffering=0)
+            self._device = None
+        return self._file
+
+    def close(self):
+        """
+        Closes the long-lived file handle, if open.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._device = None
 
     def write(self, device, data):
         """
@@ -31,26 +96,109 @@ class I2C:
         Input must be a string or a list.
         Returns True and the data (as written to the device) if successful
         """
+        data = self._format(data)
+        with self._lock:
+            file = self._acquire(device)
+            try:
+                file.write(data)
+            finally:
+                self._release(file)
+        return True, data
 
-        with io.open(self.filepath, "r+b", buffering=0) as file:
+    def read(self, device, count):
+        """
+        Reads the specified number of bytes from the device.
+        """
+        with self._lock:
+            file = self._acquire(device)
+            try:
+                return file.read(count)
+            finally:
+                self._release(file)
 
-            fcntl.ioctl(file, I2C_SLAVE, device)
+    def readinto(self, device, buf):
+        """
+        Reads len(buf) bytes from the device into a caller-provided
+        writable buffer (eg. a bytearray), avoiding a new allocation.
+        Returns the number of bytes read.
+        """
+        with self._lock:
+            file = self._acquire(device)
+            try:
+                return file.readinto(buf)
+            finally:
+                self._release(file)
+
+    def write_read(self, device, data, count):
+        """
+        Writes data to the device then reads count bytes back in a single
+        combined transaction (repeated start, no stop in between).
+        Returns the bytes read.
+        """
+        buf = bytearray(count)
+        self.write_readinto(device, data, buf)
+        return bytes(buf)
+
+    def write_readinto(self, device, data, buf):
+        """
+        Same as write_read, but reads len(buf) bytes into a caller-provided
+        writable buffer. Returns the number of bytes read.
+        """
+        data = self._format(data)
+        write_buf = (ctypes.c_char * len(data)).from_buffer_copy(data)
+        read_buf = (ctypes.c_char * len(buf)).from_buffer(buf)
+
+        msgs = (_I2CMsg * 2)(
+            _I2CMsg(addr=device, flags=0, len=len(data),
+                    buf=ctypes.addressof(write_buf)),
+            _I2CMsg(addr=device, flags=I2C_M_RD, len=len(buf),
+                    buf=ctypes.addressof(read_buf)))
+        rdwr = _I2CRdwrData(msgs=msgs, nmsgs=2)
 
-            if type(data) is list:
-                data = bytearray(data)
-            elif type(data) is bytes:
-                pass
+        # I2C_RDWR carries the address in each message, so the cached
+        # slave address is left alone.
+        with self._lock:
+            if self.persistent:
+                fcntl.ioctl(self.open(), I2C_RDWR, rdwr)
             else:
-                raise TypeError('Invalid data format: ' +
-                                str(type(data))+', must be bytes or list')
-            file.write(data)
-            return True, data
+                with io.open(self.filepath, "r+b", buffering=0) as file:
+                    fcntl.ioctl(file, I2C_RDWR, rdwr)
+        return len(buf)
 
-    def read(self, device, count):
+    def _format(self, data):
         """
-        Reads the specified number of bytes from the device.
+        Checks the data type and converts lists into bytes.
+        """
+        if type(data) is list:
+            return bytearray(data)
+        elif type(data) is bytes:
+            return data
+        raise TypeError('Invalid data format: ' +
+                        str(type(data))+', must be bytes or list')
+
+    def _acquire(self, device):
         """
-        with io.open(self.filepath, "r+b", buffering=0) as file:
+        Returns a file handle addressed to the device.
+        Must be called with the lock held.
+        """
+        if not self.persistent:
+            file = io.open(self.filepath, "r+b", buffering=0)
+            try:
+                fcntl.ioctl(file, I2C_SLAVE, device)
+            except Exception:
+                file.close()
+                raise
+            return file
+
+        file = self.open()
+        if self._device != device:
             fcntl.ioctl(file, I2C_SLAVE, device)
+            self._device = device
+        return file
 
-            return file.read(count)
+    def _release(self, file):
+        """
+        Closes per-transaction file handles. Persistent handles stay open.
+        """
+        if not self.persistent:
+            file.close()
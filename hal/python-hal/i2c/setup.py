@@ -8,7 +8,7 @@ https://github.com/pypa/sampleproject
 from setuptools import setup
 
 setup(name='i2c',
-      version='0.1.0',
+      version='0.2.0',
       description='I2C library for KubOS',
       py_modules=["i2c"]
       )
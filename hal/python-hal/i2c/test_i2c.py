@@ -8,6 +8,7 @@
 Unit testing for the I2C library.
 """
 
+import ctypes
 import unittest
 import i2c
 import mock
@@ -54,5 +55,94 @@ class TestI2C(unittest.TestCase):
             mock_ioctl.assert_called_with(mock.ANY, i2c.I2C_SLAVE, fake_device)
 
 
+class TestPersistentI2C(unittest.TestCase):
+
+    def setUp(self):
+        self.i2cdevice = i2c.I2C(1, persistent=True)
+
+    def test_opens_once(self):
+        with mock.patch('io.open') as mock_open, mock.patch('fcntl.ioctl'):
+            self.i2cdevice.write(1, b'fake')
+            self.i2cdevice.read(1, 4)
+            self.i2cdevice.write(2, b'fake')
+            self.assertEqual(mock_open.call_count, 1)
+
+    def test_caches_slave_address(self):
+        with mock.patch('io.open'), mock.patch('fcntl.ioctl') as mock_ioctl:
+            self.i2cdevice.write(1, b'fake')
+            self.i2cdevice.read(1, 4)
+            self.assertEqual(mock_ioctl.call_count, 1)
+            self.i2cdevice.read(2, 4)
+            self.assertEqual(mock_ioctl.call_count, 2)
+            mock_ioctl.assert_called_with(mock.ANY, i2c.I2C_SLAVE, 2)
+
+    def test_close_resets_handle(self):
+        with mock.patch('io.open') as mock_open, mock.patch('fcntl.ioctl') as mock_ioctl:
+            self.i2cdevice.write(1, b'fake')
+            self.i2cdevice.close()
+            mock_open.return_value.close.assert_called_once_with()
+            self.i2cdevice.write(1, b'fake')
+            self.assertEqual(mock_open.call_count, 2)
+            self.assertEqual(mock_ioctl.call_count, 2)
+
+    def test_context_manager(self):
+        device = i2c.I2C(1)
+        with mock.patch('io.open') as mock_open, mock.patch('fcntl.ioctl'):
+            with device as bus:
+                bus.write(1, b'fake')
+                bus.write(1, b'fake')
+            self.assertEqual(mock_open.call_count, 1)
+            mock_open.return_value.close.assert_called_once_with()
+        self.assertFalse(device.persistent)
+
+    def test_readinto(self):
+        buf = bytearray(4)
+        with mock.patch('io.open') as mock_open, mock.patch('fcntl.ioctl'):
+            mock_open.return_value.readinto.return_value = 4
+            self.assertEqual(self.i2cdevice.readinto(1, buf), 4)
+            mock_open.return_value.readinto.assert_called_with(buf)
+
+    def test_write_read(self):
+        fake_device = 0x51
+        fake_data = b'SUP:TEL? 0,data\n'
+
+        def fake_ioctl(file, request, arg):
+            self.assertEqual(request, i2c.I2C_RDWR)
+            self.assertEqual(arg.nmsgs, 2)
+            write_msg, read_msg = arg.msgs[0], arg.msgs[1]
+            self.assertEqual(write_msg.addr, fake_device)
+            self.assertEqual(write_msg.flags, 0)
+            self.assertEqual(
+                ctypes.string_at(write_msg.buf, write_msg.len), fake_data)
+            self.assertEqual(read_msg.addr, fake_device)
+            self.assertEqual(read_msg.flags, i2c.I2C_M_RD)
+            ctypes.memmove(read_msg.buf, b'\x01\x02\x03', read_msg.len)
+
+        with mock.patch('io.open'), mock.patch('fcntl.ioctl') as mock_ioctl:
+            mock_ioctl.side_effect = fake_ioctl
+            self.assertEqual(
+                self.i2cdevice.write_read(fake_device, fake_data, 3),
+                b'\x01\x02\x03')
+
+    def test_write_read_list_data(self):
+        def fake_ioctl(file, request, arg):
+            write_msg = arg.msgs[0]
+            self.assertEqual(
+                ctypes.string_at(write_msg.buf, write_msg.len), b'\x01\x02')
+
+        with mock.patch('io.open'), mock.patch('fcntl.ioctl') as mock_ioctl:
+            mock_ioctl.side_effect = fake_ioctl
+            self.assertEqual(self.i2cdevice.write_read(0x50, [1, 2], 4), bytes(4))
+
+    def test_write_read_keeps_slave_address(self):
+        with mock.patch('io.open'), mock.patch('fcntl.ioctl') as mock_ioctl:
+            self.i2cdevice.write(1, b'fake')
+            self.i2cdevice.write_read(2, b'fake', 1)
+            self.i2cdevice.write(1, b'fake')
+            slave_calls = [call for call in mock_ioctl.call_args_list
+                           if call[0][1] == i2c.I2C_SLAVE]
+            self.assertEqual(len(slave_calls), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+
+"""
+Negotiated HTTP response compression for Kubos services
+"""
+
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Compressor:
+    """
+    Compresses responses of at least threshold bytes with the best
+    encoding the client accepts: zstd (if zstandard is installed), gzip or
+    deflate. Ties in the client's preferences go to the first of these.
+    """
+
+    def __init__(self, threshold=1024, level=6):
+        self.threshold = threshold
+        self.level = level
+        self.encodings = ['gzip', 'deflate']
+        if zstandard is not None:
+            self.encodings.insert(0, 'zstd')
+
+    def install(self, app):
+        app.after_request(self.compress)
+
+    def compress(self, response):
+        if (response.direct_passthrough or response.is_streamed or
+                'Content-Encoding' in response.headers or
+                response.status_code < 200 or response.status_code == 204):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.content_length is None or \
+                response.content_length < self.threshold:
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if encoding == 'zstd':
+            data = zstandard.ZstdCompressor(
+                level=min(self.level, 22)).compress(data)
+        elif encoding == 'gzip':
+            data = gzip.compress(data, compresslevel=self.level)
+        else:
+            data = zlib.compress(data, self.level)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+def make_compressor(settings):
+    """
+    Creates the Compressor for the server settings, or returns None if
+    compression is disabled.
+    """
+    if not settings['compression']:
+        return None
+    return Compressor(
+        threshold=settings['compression_threshold'],
+        level=settings['compression_level'])
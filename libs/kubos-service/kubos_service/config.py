@@ -5,22 +5,110 @@
 # See LICENSE file for details
 
 import argparse
+import logging
+import os
+import threading
+import time
+import weakref
 import toml
 
 DEFAULT_IP = "127.0.0.1"
 DEFAULT_PORT = 8001
 DEFAULT_PATH = "/etc/kubos-config.toml"
+# Seconds between checks of the config file's modification time
+DEFAULT_WATCH_INTERVAL = 2.0
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_args = None
+# path -> _ConfigFile
+_files = {}
 
 
 def get_args(name):
-    parser = argparse.ArgumentParser(description=name)
-    parser = argparse.ArgumentParser(description='Example Service')
-    parser.add_argument("-c", "--config", type=str, help='path to config file')
-    return parser.parse_args()
+    """
+    Parses the command line once per process.
+    """
+    global _args
+    if _args is None:
+        parser = argparse.ArgumentParser(description=name)
+        parser.add_argument("-c", "--config", type=str, help='path to config file')
+        _args = parser.parse_args()
+    return _args
+
+
+class _ConfigFile:
+    """
+    A config file parsed once and shared by every Config reading it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.configs = weakref.WeakSet()
+        self.watcher = None
+        self.mtime = os.stat(path).st_mtime_ns
+        self.data = toml.load(path)
+
+    def check(self):
+        """
+        Reloads the file if it was modified, then updates every Config
+        reading it. A file that fails to parse is ignored until it changes
+        again.
+        Output: True if the file was reloaded
+        """
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                logger.error("Can't check config file {}: {}".format(
+                    self.path, e))
+                return False
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            try:
+                self.data = toml.load(self.path)
+            except Exception as e:
+                logger.error("Failed to reload config file {}: {}".format(
+                    self.path, e))
+                return False
+            configs = list(self.configs)
+        for config in configs:
+            config._update(self.data)
+        return True
+
+    def watch(self, interval):
+        with self.lock:
+            if self.watcher is not None:
+                return
+            self.watcher = threading.Thread(
+                target=self._watch, args=(interval,), name="config-watcher")
+            self.watcher.daemon = True
+            self.watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            self.check()
+
+
+def _get_file(path):
+    with _lock:
+        if path not in _files:
+            _files[path] = _ConfigFile(path)
+        return _files[path]
 
 
 class Config:
-    """Service configuration"""
+    """Service configuration
+
+    The config file is parsed once per process and shared by every Config.
+    After reload() or while watch() is running, changes to the file are
+    applied to ip, port and raw, and the subscribers are notified if this
+    service's section changed.
+    """
     name = ""
     ip = ""
     port = 0
@@ -32,13 +120,58 @@ class Config:
             path = args.config
         else:
             path = DEFAULT_PATH
+        self.name = name
+        self._file = None
+        self._subscribers = []
         try:
-            data = toml.load(path)
-            self.name = name
-            self.ip = data[name]['addr']['ip']
-            self.port = data[name]['addr']['port']
-            self.raw = data[name]
+            self._file = _get_file(path)
+            self._file.configs.add(self)
+            self._apply(self._file.data)
 
         except Exception:
             self.ip = DEFAULT_IP
             self.port = DEFAULT_PORT
+
+    def _apply(self, data):
+        self.ip = data[self.name]['addr']['ip']
+        self.port = data[self.name]['addr']['port']
+        self.raw = data[self.name]
+
+    def _update(self, data):
+        if data.get(self.name) == self.raw:
+            return
+        try:
+            self._apply(data)
+        except Exception as e:
+            logger.error("Invalid config for {}: {}".format(self.name, e))
+            return
+        for callback in self._subscribers:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error("Config subscriber failed: {}".format(e))
+
+    def subscribe(self, callback):
+        """
+        Calls callback(config) whenever this service's section changes.
+        ip and port are updated too, but a running server keeps listening
+        on its original address.
+        """
+        self._subscribers.append(callback)
+
+    def reload(self):
+        """
+        Reloads the config file now if it was modified.
+        Output: True if the file was reloaded
+        """
+        if self._file is None:
+            return False
+        return self._file.check()
+
+    def watch(self, interval=DEFAULT_WATCH_INTERVAL):
+        """
+        Checks the config file for changes every interval seconds, from a
+        background thread shared by every Config reading the file.
+        """
+        if self._file is not None:
+            self._file.watch(interval)
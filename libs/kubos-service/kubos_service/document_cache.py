@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+
+"""
+LRU cache of parsed and validated GraphQL documents
+"""
+
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from graphql.backend.base import GraphQLDocument
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.execution import ExecutionResult, execute
+from graphql.language.base import parse
+from graphql.validation import validate
+
+DEFAULT_SIZE = 256
+
+
+def _invalid(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+class CachedBackend(GraphQLCoreBackend):
+    """
+    GraphQL backend keeping the most recently used documents, keyed by
+    schema and query text.
+
+    A document is parsed and validated once, when it is first seen. Later
+    requests with the same text go straight to execution. Documents that
+    fail validation are cached with their errors. Documents that can't be
+    parsed aren't cached.
+
+    Pass it as the backend of schema.execute or GraphQLView.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, executor=None):
+        GraphQLCoreBackend.__init__(self, executor=executor)
+        self.size = size
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, document_string)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                self.hits += 1
+                return document
+            self.misses += 1
+
+        document = self._compile(schema, document_string)
+
+        with self._lock:
+            self._documents[key] = document
+            while len(self._documents) > self.size:
+                self._documents.popitem(last=False)
+                self.evictions += 1
+        return document
+
+    def _compile(self, schema, document_string):
+        document_ast = parse(document_string)
+        errors = validate(schema, document_ast)
+        if errors:
+            run = partial(_invalid, errors)
+        else:
+            run = partial(
+                execute, schema, document_ast, **self.execute_params)
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=run)
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._documents),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
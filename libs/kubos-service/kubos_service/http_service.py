@@ -9,36 +9,499 @@
 Wrapper for creating a HTTP based Kubos service
 """
 
-from flask import Flask
+import io
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+
+from flask import Flask, Response, g, jsonify, request
 from flask_graphql import GraphQLView
+from graphql_server import HttpQueryError
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
+from .compression import make_compressor
+from .document_cache import DEFAULT_SIZE, CachedBackend
+from .persisted import PersistedQueryError, make_registry
+from .stats import make_stats
+from .subscriptions import SUBSCRIPTION_DEFAULTS, SubscriptionError, make_manager
 
-def start(config, schema, context={}):
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+CBOR_MIMETYPE = 'application/cbor'
+
+# Server settings used when the service's config has no "server" table
+SERVER_DEFAULTS = {
+    "mode": "development",
+    "workers": 8,
+    "processes": 2,
+    "queue_depth": 64,
+    "backlog": 128,
+    "keep_alive": 5.0,
+    "document_cache": DEFAULT_SIZE,
+    "stats": False,
+    "stats_sample": 1.0,
+    "stats_interval": 0,
+    "persisted_queries": "",
+    "persisted_size": 1024,
+    "persisted_register": True,
+    "compression": False,
+    "compression_threshold": 1024,
+    "compression_level": 6,
+    "subscription_heartbeat": 15.0
+}
+SERVER_DEFAULTS.update(SUBSCRIPTION_DEFAULTS)
+
+
+class KubosGraphQLView(GraphQLView):
+    """
+    GraphQLView which passes context to resolvers and looks up persisted
+    queries in registry.
+
+    If cbor2 is installed, requests with an application/cbor body are
+    decoded from CBOR, and clients preferring application/cbor in their
+    Accept header get CBOR responses.
+    """
+    registry = None
+    context = None
+
+    def get_context(self):
+        # Flask-GraphQL 2 dropped the context option and passes the request
+        if self.context is not None:
+            return self.context
+        return request
+
+    def dispatch_request(self):
+        response = GraphQLView.dispatch_request(self)
+        if self.wants_cbor() and not isinstance(response, str):
+            response.content_type = CBOR_MIMETYPE
+        return response
+
+    def format_error(self, error):
+        # Called for each error of the response, execution or HTTP
+        g.graphql_errors = True
+        return GraphQLView.format_error(error)
+
+    def wants_cbor(self):
+        if cbor2 is None:
+            return False
+        return request.accept_mimetypes.best_match(
+            ['application/json', CBOR_MIMETYPE]) == CBOR_MIMETYPE
+
+    def encode(self, data, pretty=False):
+        if self.wants_cbor():
+            return cbor2.dumps(data)
+        return GraphQLView.encode(data, pretty)
+
+    def parse_body(self):
+        if request.mimetype == CBOR_MIMETYPE:
+            if cbor2 is None:
+                raise HttpQueryError(415, 'CBOR is not supported.')
+            try:
+                data = cbor2.loads(request.data)
+            except Exception:
+                raise HttpQueryError(400, 'POST body sent invalid CBOR.')
+        else:
+            data = GraphQLView.parse_body(self)
+        if self.registry is None or not isinstance(data, dict):
+            return data
+        extensions = data.get('extensions') or request.args.get('extensions')
+        if not extensions:
+            return data
+        try:
+            if isinstance(extensions, str):
+                extensions = json.loads(extensions)
+            query = self.registry.resolve(
+                data.get('query') or request.args.get('query'), extensions)
+        except PersistedQueryError as e:
+            raise HttpQueryError(200, str(e))
+        except ValueError:
+            raise HttpQueryError(400, 'Extensions are invalid JSON.')
+        data = dict(data)
+        data['query'] = query
+        return data
+
+
+def _has_errors():
     """
-    Creates flask based graphql and graphiql endpoints
+    Whether the response of the current request holds GraphQL errors.
+    """
+    return g.get('graphql_errors', False)
+
+
+def _subscription_view(subscriptions, registry, heartbeat, streams=None):
+    slots = None
+    if streams is not None:
+        slots = threading.BoundedSemaphore(max(streams, 0))
+
+    def subscribe():
+        if request.method == 'POST':
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return _subscription_error('POST body sent invalid JSON.')
+        else:
+            data = request.args
+        if slots is not None and not slots.acquire(blocking=False):
+            return _subscription_error('Too many subscription streams.', 503)
+        try:
+            variables = data.get('variables')
+            extensions = data.get('extensions')
+            if isinstance(variables, str):
+                variables = json.loads(variables)
+            if isinstance(extensions, str):
+                extensions = json.loads(extensions)
+            query = data.get('query')
+            if registry is not None:
+                query = registry.resolve(query, extensions)
+            on_change = data.get('onChange', False)
+            if isinstance(on_change, str):
+                on_change = on_change.lower() in ('1', 'true')
+            events = queue.Queue(maxsize=16)
+
+            def sink(id, response):
+                try:
+                    events.put_nowait(response)
+                except queue.Full:
+                    # The client isn't keeping up, it gets the next one
+                    pass
+
+            id = subscriptions.subscribe(
+                query, sink, variables=variables,
+                operation_name=data.get('operationName'),
+                period=data.get('period', 1.0), on_change=on_change, lease=0)
+        except (PersistedQueryError, SubscriptionError, ValueError) as e:
+            if slots is not None:
+                slots.release()
+            return _subscription_error(str(e))
+
+        def stream():
+            try:
+                while True:
+                    try:
+                        response = events.get(timeout=heartbeat)
+                    except queue.Empty:
+                        # Fails once the client has gone away
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield 'data: {}\n\n'.format(json.dumps(response))
+            finally:
+                subscriptions.unsubscribe(id)
+
+        response = Response(stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+        if slots is not None:
+            # Runs even if the stream was never started
+            response.call_on_close(slots.release)
+        return response
+
+    return subscribe
+
+
+def _subscription_error(message, status=400):
+    response = jsonify({'errors': [{'message': message}]})
+    response.status_code = status
+    return response
+
+
+def create_app(schema, context={}, backend=None, stats=None, registry=None,
+               compressor=None, subscriptions=None, heartbeat=15.0,
+               streams=None):
+    """
+    Creates the Flask app with the graphql and graphiql endpoints.
+    backend is the GraphQL backend both endpoints execute queries with.
+    If a ServiceStats is given, requests and resolvers are recorded in it
+    and the schema gets its serviceStats query. Persisted queries are
+    looked up in registry, and responses compressed by compressor, if
+    given.
+
+    If a SubscriptionManager is given, the subscribe endpoint streams the
+    results of subscribed queries as server-sent events, with a comment
+    every heartbeat seconds while there are no results. If streams is
+    given, at most that many streams are open at once.
     """
 
     app = Flask(__name__)
-    app.debug = True
+    middleware = []
+    if compressor is not None:
+        # after_request hooks run in reverse order, so this one runs last
+        # and the stats see the uncompressed response
+        compressor.install(app)
+    if stats is not None:
+        schema = stats.instrument(schema)
+        middleware = stats.middleware()
+
+        @app.before_request
+        def start_timer():
+            g.started = time.perf_counter()
+
+        @app.after_request
+        def record_request(response):
+            stats.record_request(
+                time.perf_counter() - g.started,
+                request.content_length or 0,
+                response.content_length or 0,
+                response.status_code >= 400 or _has_errors())
+            return response
 
     app.add_url_rule(
         '/',
-        view_func=GraphQLView.as_view(
+        view_func=KubosGraphQLView.as_view(
             'graphql',
             schema=schema,
             context=context,
+            backend=backend,
+            registry=registry,
+            middleware=middleware,
             graphiql=False
         )
     )
 
     app.add_url_rule(
         '/graphiql',
-        view_func=GraphQLView.as_view(
+        view_func=KubosGraphQLView.as_view(
             'graphiql',
             schema=schema,
             context=context,
+            backend=backend,
+            registry=registry,
+            middleware=middleware,
             graphiql=True
         )
     )
 
-    app.run(config.ip, config.port)
+    if subscriptions is not None:
+        app.add_url_rule(
+            '/subscribe',
+            'subscribe',
+            view_func=_subscription_view(
+                subscriptions, registry, heartbeat, streams),
+            methods=['GET', 'POST']
+        )
+
+    return app
+
+
+def server_settings(config):
+    """
+    Returns the server settings from the service's "server" config table,
+    with defaults filled in.
+    """
+    settings = dict(SERVER_DEFAULTS)
+    settings.update(config.raw.get('server', {}))
+    return settings
+
+
+def start(config, schema, context={}):
+    """
+    Creates flask based graphql and graphiql endpoints and serves them.
+
+    Settings come from the "server" table of the service's config (see
+    README.md):
+
+    mode - "development" (default), "threaded", "prefork" or "waitress"
+    workers - threads serving requests
+    processes - forked processes in "prefork" mode
+    queue_depth - accepted connections waiting for a worker
+    backlog - listen backlog of the socket
+    keep_alive - seconds an idle connection is kept open
+    document_cache - parsed and validated queries kept
+    stats - adds a serviceStats query (see ServiceStats)
+    stats_sample - fraction of resolver calls timed
+    stats_interval - seconds between stats log messages
+    persisted_queries - JSON file of queries (see kubos_service.persisted)
+    persisted_size - client-registered queries kept
+    persisted_register - false to only accept persisted_queries
+    compression - compresses responses (see kubos_service.compression)
+    compression_threshold - smallest response compressed, in bytes
+    compression_level - compression level
+    subscription_workers - threads running subscribed queries
+    subscription_limit - most subscriptions active at once
+    subscription_min_period - shortest period accepted, in seconds
+    subscription_heartbeat - seconds between keep-alives on idle streams
+
+    Clients subscribe at /subscribe (see create_app). Each stream holds a
+    connection and a worker, so apart from in "development" mode at most
+    workers - 1 streams are open at once, leaving a worker for queries.
+    """
+
+    settings = server_settings(config)
+    backend = CachedBackend(size=settings['document_cache'])
+    stats = make_stats(config, settings, backend)
+    registry = make_registry(settings)
+    if stats is not None:
+        stats.add_source('persisted', registry.stats)
+    subscriptions = make_manager(settings, schema, context, backend)
+    if stats is not None:
+        stats.add_source('subscriptions', subscriptions.stats)
+    mode = settings['mode']
+    streams = None
+    if mode != "development":
+        streams = settings['workers'] - 1
+    app = create_app(schema, context, backend=backend, stats=stats,
+                     registry=registry, compressor=make_compressor(settings),
+                     subscriptions=subscriptions,
+                     heartbeat=settings['subscription_heartbeat'],
+                     streams=streams)
+
+    if mode == "development":
+        app.debug = True
+        app.run(config.ip, config.port)
+    elif mode == "threaded":
+        make_server(config.ip, config.port, app, settings).serve_forever()
+    elif mode == "prefork":
+        serve_prefork(make_server(config.ip, config.port, app, settings),
+                      settings['processes'])
+    elif mode == "waitress":
+        serve_waitress(config.ip, config.port, app, settings)
+    else:
+        raise ValueError('Unknown server mode: {}'.format(mode))
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    WSGI server handing connections to a fixed pool of worker threads.
+
+    Accepted connections wait in a queue of queue_depth entries. When it
+    is full, the server stops accepting and new connections wait in the
+    listen backlog instead. A worker serves every request of a keep-alive
+    connection until it has been idle for keep_alive seconds.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, workers=8, queue_depth=64,
+                 backlog=128, handler=None):
+        # Used by server_activate, so it must be set before binding
+        self.request_queue_size = backlog
+        self.workers = workers
+        self._requests = queue.Queue(maxsize=queue_depth)
+        self._threads = []
+        BaseWSGIServer.__init__(self, host, port, app, handler=handler)
+
+    def start_workers(self):
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name="http-worker-{}".format(index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def serve_forever(self, poll_interval=0.5):
+        if not self._threads:
+            self.start_workers()
+        BaseWSGIServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+def make_server(host, port, app, settings):
+    """
+    Creates a PooledWSGIServer from server settings.
+    """
+
+    class RequestHandler(WSGIRequestHandler):
+        # HTTP/1.1 keeps connections open between requests
+        protocol_version = "HTTP/1.1" if settings['keep_alive'] else "HTTP/1.0"
+        timeout = settings['keep_alive'] or None
+
+        def setup(self):
+            WSGIRequestHandler.setup(self)
+            # Headers and body are written separately. Without this, a kept
+            # alive connection waits for the client's delayed ACK in between
+            self.connection.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def make_environ(self):
+            environ = WSGIRequestHandler.make_environ(self)
+            self.body_read = False
+            self.sized = False
+            length = environ.get('CONTENT_LENGTH') or '0'
+            if settings['keep_alive'] and \
+                    'wsgi.input_terminated' not in environ and length.isdigit():
+                # Reading the whole body up front leaves the connection at
+                # the start of the next request, whatever the app reads
+                environ['wsgi.input'] = io.BytesIO(self.rfile.read(int(length)))
+                self.body_read = True
+            return environ
+
+        def send_header(self, keyword, value):
+            if keyword.lower() == 'content-length':
+                self.sized = True
+            # werkzeug closes every connection, as it can't tell whether
+            # the request body was read. Keep it open if it was, and the
+            # response has a known length
+            if keyword.lower() == 'connection' and value.lower() == 'close' \
+                    and self.body_read and self.sized:
+                return
+            WSGIRequestHandler.send_header(self, keyword, value)
+
+    return PooledWSGIServer(
+        host, port, app,
+        workers=settings['workers'],
+        queue_depth=settings['queue_depth'],
+        backlog=settings['backlog'],
+        handler=RequestHandler)
+
+
+def serve_prefork(server, processes):
+    """
+    Forks processes copies of a bound server and waits for them. Stopping
+    the parent stops every child.
+    """
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
+    finally:
+        server.server_close()
+
+
+def serve_waitress(host, port, app, settings):
+    try:
+        import waitress
+    except ImportError:
+        raise ImportError(
+            'Server mode "waitress" requires the waitress package')
+    waitress.serve(
+        app, host=host, port=port,
+        threads=settings['workers'],
+        backlog=settings['backlog'],
+        connection_limit=settings['queue_depth'] + settings['workers'],
+        channel_timeout=settings['keep_alive'] or 120)
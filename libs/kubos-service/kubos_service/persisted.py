@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+
+"""
+Persisted query registry for Kubos services
+
+Clients send the SHA-256 hash of a query instead of its text, in the
+request's extensions, as in Apollo's automatic persisted queries:
+
+    {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}},
+     "variables": {...}}
+
+Hashes of unknown queries are answered with a PersistedQueryNotFound
+error. The client then sends the full text along with the hash, and the
+query is registered for the next time.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+NOT_FOUND = "PersistedQueryNotFound"
+HASH_MISMATCH = "provided sha does not match query"
+
+DEFAULT_SIZE = 1024
+
+
+class PersistedQueryError(Exception):
+    pass
+
+
+def query_hash(query):
+    """
+    Returns the hex SHA-256 hash of a query's text.
+    """
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class QueryRegistry:
+    """
+    Query texts by hash.
+
+    Queries loaded from a file are kept for good. Queries registered by
+    clients are kept in an LRU of size entries, or refused if register is
+    False.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, register=True):
+        self.size = size
+        self.allow_register = register
+        self._loaded = {}
+        self._registered = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """
+        Loads queries from a JSON file, holding either a list of query texts
+        or an object mapping hashes to query texts.
+        """
+        with open(path) as file:
+            queries = json.load(file)
+        if isinstance(queries, list):
+            queries = {query_hash(query): query for query in queries}
+        for sha, query in queries.items():
+            if query_hash(query) != sha:
+                raise ValueError("Hash doesn't match query: {}".format(sha))
+        with self._lock:
+            self._loaded.update(queries)
+
+    def register(self, query, sha=None):
+        """
+        Adds a query sent by a client. Raises PersistedQueryError if sha
+        isn't the query's hash.
+        """
+        if sha is not None and query_hash(query) != sha:
+            raise PersistedQueryError(HASH_MISMATCH)
+        if not self.allow_register:
+            return
+        with self._lock:
+            self._registered[sha or query_hash(query)] = query
+            while len(self._registered) > self.size:
+                self._registered.popitem(last=False)
+
+    def lookup(self, sha):
+        """
+        Returns the text of a query, or None if the hash is unknown.
+        """
+        with self._lock:
+            query = self._loaded.get(sha)
+            if query is None:
+                query = self._registered.get(sha)
+                if query is not None:
+                    self._registered.move_to_end(sha)
+            if query is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return query
+
+    def resolve(self, query, extensions):
+        """
+        Returns the query text of a request, given its query (or None) and
+        extensions. Registers it if both the text and hash were sent.
+        Raises PersistedQueryError if the hash is unknown or wrong.
+        """
+        persisted = (extensions or {}).get('persistedQuery')
+        if not persisted:
+            return query
+        sha = persisted.get('sha256Hash')
+        if query:
+            self.register(query, sha)
+            return query
+        query = self.lookup(sha)
+        if query is None:
+            raise PersistedQueryError(NOT_FOUND)
+        return query
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': len(self._loaded),
+                'registered': len(self._registered),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+def make_registry(settings):
+    """
+    Creates the QueryRegistry for the server settings.
+    """
+    registry = QueryRegistry(
+        size=settings['persisted_size'],
+        register=settings['persisted_register'])
+    if settings['persisted_queries']:
+        registry.load(settings['persisted_queries'])
+    return registry
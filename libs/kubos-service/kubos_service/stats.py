@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+
+"""
+Request and resolver statistics for Kubos services
+"""
+
+import bisect
+import json
+import logging
+import random
+import threading
+import time
+
+import graphene
+from promise import Promise
+
+# Upper bounds of the latency buckets: 1us to about 8s, doubling
+LATENCY_BOUNDS = tuple(2 ** power / 1000000.0 for power in range(24))
+# Upper bounds of the size buckets: 16 bytes to 1MB, doubling
+SIZE_BOUNDS = tuple(2 ** power for power in range(4, 21))
+
+
+class Histogram:
+    """
+    Counts of values in fixed buckets, plus their sum and maximum.
+    Values above the last bound go in an overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound of the bucket holding the given percentile,
+        or the maximum for the overflow bucket.
+        """
+        if not self.count:
+            return 0
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index == len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+class _FieldStats:
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.errors = 0
+
+
+class ServiceStats:
+    """
+    Collects request counts, latencies, errors and payload sizes, and the
+    latency of every resolver.
+
+    Used as graphql-core middleware, it times sample_rate of the resolver
+    calls. Resolvers are keyed by type and field name ("Query.ping"), so
+    memory is bounded by the size of the schema. Requests are all counted,
+    whatever the sample rate.
+    """
+
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._fields = {}
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.request_bytes = Histogram(SIZE_BOUNDS)
+        self.response_bytes = Histogram(SIZE_BOUNDS)
+        self.sources = {}
+
+    def resolve(self, next, root, info, **args):
+        """
+        graphql-core middleware entry point.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return next(root, info, **args)
+        started = time.perf_counter()
+        try:
+            result = next(root, info, **args)
+        except Exception:
+            self._record_field(info, time.perf_counter() - started, True)
+            raise
+        if isinstance(result, Promise) and result.is_pending:
+            def resolved(value):
+                self._record_field(
+                    info, time.perf_counter() - started, False)
+                return value
+
+            def rejected(error):
+                self._record_field(
+                    info, time.perf_counter() - started, True)
+                raise error
+
+            return result.then(resolved, rejected)
+        error = isinstance(result, Promise) and result.is_rejected
+        self._record_field(info, time.perf_counter() - started, error)
+        return result
+
+    def _record_field(self, info, elapsed, error):
+        key = "{}.{}".format(info.parent_type.name, info.field_name)
+        with self._lock:
+            stats = self._fields.get(key)
+            if stats is None:
+                stats = self._fields[key] = _FieldStats()
+            stats.latency.add(elapsed)
+            if error:
+                stats.errors += 1
+
+    def record_request(self, elapsed, request_bytes, response_bytes, error):
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self.latency.add(elapsed)
+            self.request_bytes.add(request_bytes)
+            self.response_bytes.add(response_bytes)
+
+    def add_source(self, name, stats):
+        """
+        Includes stats() of another component, eg. the document cache, in
+        the output under name.
+        """
+        self.sources[name] = stats
+
+    def as_dict(self):
+        with self._lock:
+            output = {
+                'uptime': time.time() - self.started,
+                'sample_rate': self.sample_rate,
+                'requests': {
+                    'count': self.requests,
+                    'errors': self.errors,
+                    'latency': self.latency.as_dict(),
+                    'request_bytes': self.request_bytes.as_dict(),
+                    'response_bytes': self.response_bytes.as_dict()
+                },
+                'fields': {
+                    key: dict(stats.latency.as_dict(), errors=stats.errors)
+                    for key, stats in self._fields.items()
+                }
+            }
+        for name, stats in self.sources.items():
+            output[name] = stats()
+        return output
+
+    def middleware(self):
+        """
+        Returns the middleware list to execute queries with: empty when
+        resolvers aren't sampled.
+        """
+        if self.sample_rate <= 0:
+            return []
+        return [self]
+
+    def instrument(self, schema):
+        """
+        Returns a copy of a graphene schema with a serviceStats query
+        returning as_dict().
+        """
+        stats = self
+
+        class Query(schema._query):
+            serviceStats = graphene.JSONString()
+
+            def resolve_serviceStats(self, info):
+                return stats.as_dict()
+
+        return graphene.Schema(
+            query=Query,
+            mutation=schema._mutation,
+            subscription=schema._subscription,
+            types=schema.types,
+            auto_camelcase=schema.auto_camelcase)
+
+    def log_periodically(self, logger, interval):
+        """
+        Logs as_dict() every interval seconds from a background thread.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                logger.info("Service stats: {}".format(
+                    json.dumps(self.as_dict())))
+
+        thread = threading.Thread(target=run, name="service-stats")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def make_stats(config, settings, backend):
+    """
+    Creates the ServiceStats for the server settings, or returns None if
+    stats are disabled.
+    """
+    if not settings['stats']:
+        return None
+    stats = ServiceStats(sample_rate=settings['stats_sample'])
+    stats.add_source('documents', backend.stats)
+    if settings['stats_interval']:
+        stats.log_periodically(
+            logging.getLogger(config.name), settings['stats_interval'])
+    return stats
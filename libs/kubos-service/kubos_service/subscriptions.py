@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+
+"""
+Push-based query subscriptions for Kubos services
+
+A client registers a query once, with a period. The service runs it every
+period and pushes the result to the client's sink, or only pushes results
+that differ from the last one when on_change is set.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from graphql.backend import get_default_backend
+
+logger = logging.getLogger(__name__)
+
+# Server settings for subscriptions
+SUBSCRIPTION_DEFAULTS = {
+    "subscription_workers": 2,
+    "subscription_limit": 64,
+    "subscription_min_period": 0.1,
+    "subscription_lease": 300.0
+}
+
+
+class SubscriptionError(Exception):
+    pass
+
+
+class Subscription:
+
+    def __init__(self, id, query, sink, variables, operation_name, period,
+                 on_change, lease):
+        self.id = id
+        self.query = query
+        self.sink = sink
+        self.variables = variables
+        self.operation_name = operation_name
+        self.period = period
+        self.on_change = on_change
+        self.lease = lease
+        self.expires = time.monotonic() + lease if lease else None
+        self.due = time.monotonic()
+        self.running = False
+        self.last = None
+        self.pushes = 0
+
+
+class SubscriptionManager:
+    """
+    Runs subscribed queries on a pool of worker threads.
+
+    sink(id, response) is called with the subscription id and each
+    {"data", "errors"} response to push. A sink returning False, or
+    raising, ends its subscription. Subscriptions with a lease end lease
+    seconds after they were made or last renewed.
+    """
+
+    def __init__(self, schema, context={}, backend=None, workers=2, limit=64,
+                 min_period=0.1, lease=300.0):
+        self.schema = schema
+        self.context = context
+        self.backend = backend
+        self.limit = limit
+        self.min_period = min_period
+        self.lease = lease
+        self._ids = itertools.count(1)
+        self._subscriptions = {}
+        # heap of (due, id)
+        self._schedule = []
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._thread = None
+        self.pushes = 0
+
+    def subscribe(self, query, sink, variables=None, operation_name=None,
+                  period=1.0, on_change=False, lease=None):
+        """
+        Registers a query. The first result is pushed straight away.
+        Output: the subscription id
+        Raises SubscriptionError if the query can't be parsed or isn't a
+        query operation, if the period is too short or if there are too
+        many subscriptions.
+        """
+        if not query:
+            raise SubscriptionError("Must provide query string.")
+        period = float(period)
+        if period < self.min_period:
+            raise SubscriptionError(
+                "Period must be at least {} seconds".format(self.min_period))
+        backend = self.backend or get_default_backend()
+        try:
+            document = backend.document_from_string(self.schema, query)
+        except Exception as e:
+            raise SubscriptionError(str(e))
+        # Mutations would be run again every period
+        if document.get_operation_type(operation_name) != 'query':
+            raise SubscriptionError("Only queries can be subscribed to")
+        with self._cond:
+            if len(self._subscriptions) >= self.limit:
+                raise SubscriptionError("Too many subscriptions")
+            subscription = Subscription(
+                next(self._ids), query, sink, variables, operation_name,
+                period, on_change, self.lease if lease is None else lease)
+            self._subscriptions[subscription.id] = subscription
+            heapq.heappush(self._schedule, (subscription.due, subscription.id))
+            self._cond.notify()
+        self._ensure_started()
+        return subscription.id
+
+    def unsubscribe(self, id):
+        with self._cond:
+            return self._subscriptions.pop(id, None) is not None
+
+    def renew(self, id):
+        """
+        Extends a subscription's lease.
+        Output: False if the subscription doesn't exist anymore
+        """
+        with self._cond:
+            subscription = self._subscriptions.get(id)
+            if subscription is None:
+                return False
+            if subscription.lease:
+                subscription.expires = time.monotonic() + subscription.lease
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                'active': len(self._subscriptions),
+                'limit': self.limit,
+                'pushes': self.pushes
+            }
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="subscriptions")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while not self._schedule or self._schedule[0][0] > now:
+                    if self._schedule:
+                        self._cond.wait(self._schedule[0][0] - now)
+                    else:
+                        self._cond.wait()
+                    now = time.monotonic()
+                (_, id) = heapq.heappop(self._schedule)
+                subscription = self._subscriptions.get(id)
+                if subscription is None:
+                    continue
+                if subscription.expires is not None and \
+                        subscription.expires <= now:
+                    del self._subscriptions[id]
+                    continue
+                # Runs late rather than piling up if a run overruns
+                subscription.due = max(now, subscription.due + subscription.period)
+                heapq.heappush(self._schedule, (subscription.due, id))
+                if subscription.running:
+                    continue
+                subscription.running = True
+            self._executor.submit(self._evaluate, subscription)
+
+    def _evaluate(self, subscription):
+        try:
+            response = self.execute(subscription)
+            if subscription.on_change and response == subscription.last:
+                return
+            subscription.last = response
+            if subscription.sink(subscription.id, response) is False:
+                self.unsubscribe(subscription.id)
+                return
+            with self._cond:
+                subscription.pushes += 1
+                self.pushes += 1
+        except Exception as e:
+            logger.error("Subscription {} ended: {}".format(
+                subscription.id, e))
+            self.unsubscribe(subscription.id)
+        finally:
+            subscription.running = False
+
+    def execute(self, subscription):
+        errs = None
+        msg = None
+        try:
+            result = self.schema.execute(
+                subscription.query, context_value=self.context,
+                variables=subscription.variables,
+                operation_name=subscription.operation_name,
+                backend=self.backend)
+            msg = result.data
+            if result.errors:
+                errs = [str(e) for e in result.errors]
+        except Exception as e:
+            errs = "Exception encountered {}".format(e)
+        return {"data": msg, "errors": errs}
+
+
+def make_manager(settings, schema, context, backend):
+    """
+    Creates the SubscriptionManager for the server settings.
+    """
+    return SubscriptionManager(
+        schema, context, backend,
+        workers=settings['subscription_workers'],
+        limit=settings['subscription_limit'],
+        min_period=settings['subscription_min_period'],
+        lease=settings['subscription_lease'])
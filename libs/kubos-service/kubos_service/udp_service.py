@@ -7,40 +7,380 @@
 
 """
 Wrapper for creating a UDP based Kubos service
+
+Requests are either the plain text of a GraphQL query, answered with one
+JSON datagram, or framed. A framed datagram starts with a 10 byte header:
+
+    magic (1 byte, 0xCB)
+    flags (1 byte, bit 0 set for CBOR payloads)
+    request id (4 bytes, big-endian)
+    fragment index (2 bytes, big-endian)
+    fragment count (2 bytes, big-endian)
+
+A framed request is a single datagram. Its response carries the same
+request id, split into fragments whose payloads join in index order.
+
+If cbor2 is installed, framed requests with the CBOR flag and unframed
+requests starting with a CBOR map byte (0xA0 to 0xBF) are CBOR, and are
+answered in CBOR.
+
+A request object with a "subscribe" member, eg. {"period": 1.0,
+"onChange": false, "callback": "ip:port", "lease": 300}, subscribes to its
+query. Results are pushed to the callback, framed like the request, until
+{"unsubscribe": id} or the end of the lease, renewed with {"renew": id}.
 """
 
 import socket
 import json
 import logging
+import queue
+import struct
+import threading
+import time
+
+from .document_cache import DEFAULT_SIZE, CachedBackend
+from .persisted import PersistedQueryError, make_registry
+from .stats import make_stats
+from .subscriptions import SUBSCRIPTION_DEFAULTS, make_manager
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Largest UDP payload over IPv4
+MAX_DATAGRAM = 65507
+
+FRAME_MAGIC = 0xCB
+FRAME_HEADER = struct.Struct('>BBIHH')
+FLAG_CBOR = 0x01
+
+# Server settings used when the service's config has no "server" table
+SERVER_DEFAULTS = {
+    "workers": 4,
+    "queue_depth": 64,
+    "fragment_size": 1400,
+    "document_cache": DEFAULT_SIZE,
+    "stats": False,
+    "stats_sample": 1.0,
+    "stats_interval": 0,
+    "persisted_queries": "",
+    "persisted_size": 1024,
+    "persisted_register": True,
+    "subscription_max_lease": 3600.0,
+    "subscription_remote_callback": False
+}
+SERVER_DEFAULTS.update(SUBSCRIPTION_DEFAULTS)
+
+
+class Frame:
+    """
+    One framed datagram.
+    """
+
+    def __init__(self, request_id, payload, index=0, count=1, flags=0):
+        self.request_id = request_id
+        self.payload = payload
+        self.index = index
+        self.count = count
+        self.flags = flags
+
+    def pack(self):
+        return FRAME_HEADER.pack(
+            FRAME_MAGIC, self.flags, self.request_id, self.index,
+            self.count) + self.payload
+
+
+def is_framed(data):
+    return len(data) >= FRAME_HEADER.size and data[0] == FRAME_MAGIC
+
+
+def parse_frame(data):
+    """
+    Splits a framed datagram into its header fields and payload.
+    Raises ValueError if it isn't framed.
+    """
+    if not is_framed(data):
+        raise ValueError("Datagram is not framed")
+    (_, flags, request_id, index, count) = FRAME_HEADER.unpack_from(data)
+    if index >= count:
+        raise ValueError("Fragment index {} out of {}".format(index, count))
+    return Frame(request_id, data[FRAME_HEADER.size:], index, count, flags)
+
+
+def fragment(request_id, payload, fragment_size, flags=0):
+    """
+    Splits a payload into framed datagrams of at most fragment_size bytes.
+    """
+    size = fragment_size - FRAME_HEADER.size
+    if size <= 0:
+        raise ValueError("fragment_size must be larger than the header")
+    count = max(1, -(-len(payload) // size))
+    if count > 0xFFFF:
+        raise ValueError("Payload too large to fragment")
+    return [Frame(request_id, payload[index * size:(index + 1) * size],
+                  index, count, flags).pack()
+            for index in range(count)]
+
+
+def is_cbor(data, frame=None):
+    """
+    Whether a request is CBOR encoded.
+    """
+    if frame is not None:
+        return bool(frame.flags & FLAG_CBOR)
+    return len(data) > 0 and 0xA0 <= data[0] <= 0xBF
+
+
+def encode(response, cbor=False):
+    if cbor:
+        return cbor2.dumps(response)
+    return str.encode(json.dumps(response))
+
+
+def decode_request(data, cbor=False):
+    """
+    Returns the request object of a JSON or CBOR request, or the text of a
+    plain text request.
+    """
+    if cbor:
+        if cbor2 is None:
+            raise ValueError("CBOR is not supported, install cbor2")
+        return cbor2.loads(data)
+    text = data.decode() if isinstance(data, bytes) else data
+    stripped = text.lstrip()
+    # '{"' can't start a GraphQL document
+    if not (stripped.startswith('{') and
+            stripped[1:].lstrip().startswith('"')):
+        return text
+    return json.loads(text)
+
+
+def is_subscription(request):
+    """
+    Whether a decoded request subscribes, renews or unsubscribes.
+    """
+    return isinstance(request, dict) and any(
+        key in request for key in ('subscribe', 'renew', 'unsubscribe'))
+
+
+def parse_request(data, registry=None, cbor=False):
+    """
+    Returns the (query, variables, operation name) of a request: either the
+    plain text of a query, or an object with "query", "variables",
+    "operationName" and "extensions" members, as sent over HTTP, in JSON
+    or CBOR. Persisted queries are looked up in registry.
+    """
+    request = decode_request(data, cbor)
+    if not isinstance(request, dict):
+        return request, None, None
+    query = request.get('query')
+    if registry is not None:
+        query = registry.resolve(query, request.get('extensions'))
+    if not query:
+        raise ValueError("Must provide query string.")
+    return query, request.get('variables'), request.get('operationName')
+
+
+def execute(schema, query, context, backend=None, stats=None, registry=None,
+            cbor=False):
+    """
+    Runs a request and returns the encoded response, in CBOR if cbor is
+    set or JSON otherwise. The request is recorded in stats, if given.
+    """
+    started = time.perf_counter()
+    errs = None
+    msg = None
+    try:
+        (document, variables, operation_name) = parse_request(
+            query, registry, cbor)
+        result = schema.execute(
+            document, context_value=context, variables=variables,
+            operation_name=operation_name, backend=backend,
+            middleware=stats.middleware() if stats else None)
+        msg = result.data
+        if result.errors:
+            errs = []
+            for e in result.errors:
+                errs.append(str(e))
+
+    except PersistedQueryError as e:
+        errs = [str(e)]
+    except Exception as e:
+        errs = "Exception encountered {}".format(e)
+
+    response = encode({
+        "data": msg,
+        "errors": errs
+    }, cbor and cbor2 is not None)
+    if stats is not None:
+        stats.record_request(time.perf_counter() - started, len(query),
+                             len(response), errs is not None)
+    return response
+
+
+def error_response(error, cbor=False):
+    return encode({"data": None, "errors": error}, cbor and cbor2 is not None)
+
+
+def parse_address(address):
+    """
+    Splits an "ip:port" address.
+    """
+    (ip, _, port) = address.rpartition(':')
+    if not ip:
+        raise ValueError("Invalid callback address: {}".format(address))
+    return ip, int(port)
+
+
+def subscription_request(subscriptions, request, source, send, registry=None,
+                         max_lease=None, remote_callback=False):
+    """
+    Runs a subscribe, renew or unsubscribe request. Results of a new
+    subscription are passed to send(address, response). Unless
+    remote_callback is set, the callback must have the source's IP address.
+    Requested leases must be positive, and are cut to max_lease.
+    Output: the response to send back, or None for a new subscription
+    """
+    try:
+        if 'unsubscribe' in request:
+            return {"data": {"unsubscribe": subscriptions.unsubscribe(
+                request['unsubscribe'])}, "errors": None}
+        if 'renew' in request:
+            return {"data": {"renew": subscriptions.renew(request['renew'])},
+                    "errors": None}
+        options = request['subscribe'] or {}
+        callback = source
+        if options.get('callback'):
+            callback = parse_address(options['callback'])
+            if not remote_callback and callback[0] != source[0]:
+                raise ValueError(
+                    "Callback must be at the request's source address")
+        lease = options.get('lease')
+        if lease is not None:
+            lease = float(lease)
+            if lease <= 0:
+                raise ValueError("Lease must be positive")
+            if max_lease:
+                lease = min(lease, max_lease)
+        query = request.get('query')
+        if registry is not None:
+            query = registry.resolve(query, request.get('extensions'))
+
+        def sink(id, response):
+            send(callback, dict(response, subscription=id))
+
+        subscriptions.subscribe(
+            query, sink, variables=request.get('variables'),
+            operation_name=request.get('operationName'),
+            period=options.get('period', 1.0),
+            on_change=options.get('onChange', False),
+            lease=lease)
+        return None
+    except Exception as e:
+        return {"data": None, "errors": [str(e)]}
 
 
 def start(logger, config, schema, context={}):
+    """
+    Serves GraphQL requests over UDP.
+
+    Settings come from the "server" table of the service's config, as for
+    http_service.start, plus:
+
+    workers - threads running requests (default 4)
+    queue_depth - requests waiting before "Service busy" is answered
+    fragment_size - largest framed response datagram
+    subscription_lease - seconds until a subscription ends unless renewed
+    subscription_max_lease - longest lease a client may ask for
+    subscription_remote_callback - allow callbacks at other addresses
+
+    Requests are either the text of a query, or a JSON object as sent over
+    HTTP, with "query", "variables", "operationName" and "extensions".
+    """
+    settings = dict(SERVER_DEFAULTS)
+    settings.update(config.raw.get('server', {}))
+
     logger.info("{} starting on {}:{}".format(config.name, config.ip, config.port))
     sock = socket.socket(socket.AF_INET,  # Internet
                          socket.SOCK_DGRAM)  # UDP
     sock.bind((config.ip, config.port))
     base_schema = schema.schema
+    backend = CachedBackend(size=settings['document_cache'])
+    stats = make_stats(config, settings, backend)
+    registry = make_registry(settings)
+    if stats is not None:
+        stats.add_source('persisted', registry.stats)
+        base_schema = stats.instrument(base_schema)
+    subscriptions = make_manager(settings, base_schema, context, backend)
+    if stats is not None:
+        stats.add_source('subscriptions', subscriptions.stats)
+
+    requests = queue.Queue(maxsize=settings['queue_depth'])
+
+    def reply(source, response, frame, cbor):
+        if frame is None:
+            if len(response) > MAX_DATAGRAM:
+                response = error_response(
+                    "Response too large for one datagram, "
+                    "send a framed request", cbor)
+            sock.sendto(response, source)
+            return
+        flags = FLAG_CBOR if cbor and cbor2 is not None else 0
+        for datagram in fragment(
+                frame.request_id, response, settings['fragment_size'], flags):
+            sock.sendto(datagram, source)
+
+    def work():
+        while True:
+            source, query, frame, cbor = requests.get()
+            try:
+                try:
+                    request = decode_request(query, cbor)
+                except Exception:
+                    # execute reports it
+                    request = None
+                if is_subscription(request):
+                    response = subscription_request(
+                        subscriptions, request, source,
+                        # Pushes keep the framing and encoding of this
+                        # request, not of the worker's later ones
+                        lambda address, response, frame=frame, cbor=cbor: reply(
+                            address, encode(response, cbor), frame, cbor),
+                        registry, settings['subscription_max_lease'],
+                        settings['subscription_remote_callback'])
+                    if response is not None:
+                        reply(source, encode(response, cbor), frame, cbor)
+                    continue
+                reply(source, execute(
+                    base_schema, query, context, backend, stats, registry,
+                    cbor), frame, cbor)
+            except Exception as e:
+                logging.error("Exception encountered {}".format(e))
+
+    for index in range(settings['workers']):
+        thread = threading.Thread(
+            target=work, name="udp-worker-{}".format(index))
+        thread.daemon = True
+        thread.start()
 
     while True:
         try:
-            data, source = sock.recvfrom(1024)
-            errs = None
-            msg = None
+            data, source = sock.recvfrom(MAX_DATAGRAM)
+            frame = None
+            cbor = False
             try:
-                result = base_schema.execute(data.decode(), context_value=context)
-                msg = result.data
-                if result.errors:
-                    errs = []
-                    for e in result.errors:
-                        errs.append(str(e))
-
+                if is_framed(data):
+                    frame = parse_frame(data)
+                    if frame.count != 1:
+                        raise ValueError("Fragmented requests are not supported")
+                    data = frame.payload
+                cbor = is_cbor(data, frame)
+                requests.put_nowait((source, data, frame, cbor))
+            except queue.Full:
+                reply(source, error_response("Service busy", cbor), frame, cbor)
             except Exception as e:
-                errs = "Exception encountered {}".format(e)
-
-            result = json.dumps({
-                "data": msg,
-                "errors": errs
-            })
-            sock.sendto(str.encode(result), source)
+                reply(source, error_response(
+                    "Exception encountered {}".format(e), cbor), frame, cbor)
         except Exception as e:
             logging.error("Exception encountered {}".format(e))
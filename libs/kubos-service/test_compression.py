@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for HTTP response compression.
+"""
+
+import gzip
+import json
+import unittest
+import zlib
+
+import graphene
+
+from kubos_service import http_service
+from kubos_service.compression import Compressor
+
+
+class Query(graphene.ObjectType):
+    text = graphene.String(size=graphene.Int())
+
+    def resolve_text(self, info, size):
+        return "x" * size
+
+
+schema = graphene.Schema(query=Query)
+
+
+class TestCompressor(unittest.TestCase):
+
+    def setUp(self):
+        compressor = Compressor(threshold=100)
+        compressor.encodings = ['gzip', 'deflate']
+        self.app = http_service.create_app(schema, compressor=compressor)
+
+    def post(self, size, accept=None):
+        headers = {}
+        if accept is not None:
+            headers['Accept-Encoding'] = accept
+        return self.app.test_client().post(
+            '/', data=json.dumps({'query': '{{text(size: {})}}'.format(size)}),
+            content_type='application/json', headers=headers)
+
+    def test_gzip(self):
+        response = self.post(1000, 'gzip, deflate')
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        body = json.loads(gzip.decompress(response.get_data()))
+        assert body == {'data': {'text': 'x' * 1000}}
+
+    def test_preference(self):
+        response = self.post(1000, 'gzip;q=0.5, deflate')
+
+        assert response.headers['Content-Encoding'] == 'deflate'
+        body = json.loads(zlib.decompress(response.get_data()))
+        assert body == {'data': {'text': 'x' * 1000}}
+
+    def test_threshold(self):
+        response = self.post(10, 'gzip')
+
+        assert 'Content-Encoding' not in response.headers
+        assert 'Accept-Encoding' in response.headers['Vary']
+
+    def test_not_accepted(self):
+        for accept in [None, 'br', 'identity']:
+            response = self.post(1000, accept)
+            assert 'Content-Encoding' not in response.headers
+            assert json.loads(response.get_data()) == {'data': {'text': 'x' * 1000}}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for service config loading and reloading.
+"""
+
+import argparse
+import os
+import tempfile
+import unittest
+
+import mock
+
+from kubos_service import config
+
+CONFIG = '''
+[test-service]
+modules = {}
+
+[test-service.addr]
+ip = "0.0.0.0"
+port = {}
+
+[other-service.addr]
+ip = "127.0.0.1"
+port = 9000
+'''
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        (handle, self.path) = tempfile.mkstemp(suffix='.toml')
+        os.close(handle)
+        self.addCleanup(os.remove, self.path)
+        self.write(['pim'], 8150)
+        patcher = mock.patch.object(
+            config, '_args', argparse.Namespace(config=self.path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, modules, port, other=9000):
+        text = CONFIG.replace('modules = {}', 'modules = {}'.format(modules))
+        text = text.replace('port = {}', 'port = {}'.format(port))
+        text = text.replace('port = 9000', 'port = {}'.format(other))
+        with open(self.path, 'w') as file:
+            file.write(text.replace("'", '"'))
+        # Changes within the file system's timestamp resolution
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 1000000000))
+
+    def test_load(self):
+        c = config.Config("test-service")
+
+        assert (c.ip, c.port) == ("0.0.0.0", 8150)
+        assert c.raw['modules'] == ['pim']
+
+    def test_shared(self):
+        c = config.Config("test-service")
+        other = config.Config("other-service")
+
+        assert c._file is other._file
+        assert other.port == 9000
+
+    def test_reload(self):
+        c = config.Config("test-service")
+        changes = []
+        c.subscribe(changes.append)
+
+        assert not c.reload()
+        self.write(['pim', 'bim'], 8151)
+        assert c.reload()
+        assert changes == [c]
+        assert c.port == 8151
+        assert c.raw['modules'] == ['pim', 'bim']
+
+    def test_other_section(self):
+        c = config.Config("test-service")
+        other = config.Config("other-service")
+        changes = []
+        c.subscribe(changes.append)
+
+        self.write(['pim'], 8150, other=9001)
+        assert c.reload()
+        assert changes == []
+        assert other.port == 9001
+
+    def test_invalid(self):
+        c = config.Config("test-service")
+
+        with open(self.path, 'w') as file:
+            file.write('[test-service')
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 2000000000))
+        assert not c.reload()
+        assert c.port == 8150
+        self.write(['pim'], 8152)
+        assert c.reload()
+        assert c.port == 8152
+
+    def test_missing(self):
+        with mock.patch.object(
+                config, '_args', argparse.Namespace(config='/no/such/file')):
+            c = config.Config("test-service")
+
+        assert (c.ip, c.port) == (config.DEFAULT_IP, config.DEFAULT_PORT)
+        assert not c.reload()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the GraphQL document cache.
+"""
+
+import unittest
+
+import graphene
+
+from kubos_service.document_cache import CachedBackend
+
+
+class Query(graphene.ObjectType):
+    ping = graphene.String()
+    value = graphene.Int(x=graphene.Int())
+
+    def resolve_ping(self, info):
+        return "pong"
+
+    def resolve_value(self, info, x):
+        return x
+
+
+schema = graphene.Schema(query=Query)
+
+
+class TestCachedBackend(unittest.TestCase):
+
+    def test_hit(self):
+        backend = CachedBackend()
+
+        for x in range(3):
+            result = schema.execute(
+                'query ($x: Int) {value(x: $x)}', variables={'x': x},
+                backend=backend)
+            assert result.data == {'value': x}
+        stats = backend.stats()
+        assert (stats['hits'], stats['misses']) == (2, 1)
+
+    def test_eviction(self):
+        backend = CachedBackend(size=2)
+
+        schema.execute('{ping}', backend=backend)
+        schema.execute('{value(x: 1)}', backend=backend)
+        # Most recently used
+        schema.execute('{ping}', backend=backend)
+        schema.execute('{value(x: 2)}', backend=backend)
+        assert backend.stats()['evictions'] == 1
+        schema.execute('{ping}', backend=backend)
+        assert backend.stats()['hits'] == 2
+
+    def test_invalid(self):
+        backend = CachedBackend()
+
+        for _ in range(2):
+            result = schema.execute('{unknown}', backend=backend)
+            assert result.invalid
+            assert "unknown" in str(result.errors[0])
+        assert backend.stats()['hits'] == 1
+
+    def test_syntax_error(self):
+        backend = CachedBackend()
+
+        result = schema.execute('{ping', backend=backend)
+
+        assert result.errors
+        assert backend.stats()['size'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the HTTP service wrapper.
+"""
+
+import json
+import unittest
+
+import graphene
+
+from kubos_service import http_service
+from kubos_service.stats import ServiceStats
+
+
+class Result(graphene.ObjectType):
+    success = graphene.Boolean()
+    errors = graphene.String()
+
+
+class Query(graphene.ObjectType):
+    ping = graphene.String()
+    context = graphene.String()
+    result = graphene.Field(Result)
+    fail = graphene.String()
+
+    def resolve_ping(self, info):
+        return "pong"
+
+    def resolve_result(self, info):
+        return Result(success=True, errors="")
+
+    def resolve_fail(self, info):
+        raise EnvironmentError("No response")
+
+    def resolve_context(self, info):
+        return info.context['name']
+
+
+schema = graphene.Schema(query=Query)
+
+
+class TestCreateApp(unittest.TestCase):
+
+    def query(self, app, query):
+        response = app.test_client().post(
+            '/', data=json.dumps({'query': query}),
+            content_type='application/json')
+        return json.loads(response.get_data())
+
+    def test_context(self):
+        app = http_service.create_app(schema, {'name': 'test-service'})
+
+        assert self.query(app, '{context}') == {'data': {'context': 'test-service'}}
+
+    def test_error_count(self):
+        stats = ServiceStats()
+        app = http_service.create_app(schema, stats=stats)
+
+        # A field named errors is not an error
+        self.query(app, '{result {success, errors}}')
+        assert (stats.requests, stats.errors) == (1, 0)
+        self.query(app, '{fail}')
+        assert (stats.requests, stats.errors) == (2, 1)
+        self.query(app, '{unknown}')
+        assert (stats.requests, stats.errors) == (3, 2)
+
+    def test_cbor(self):
+        if http_service.cbor2 is None:
+            self.skipTest("cbor2 is not installed")
+        cbor2 = http_service.cbor2
+        app = http_service.create_app(schema)
+
+        response = app.test_client().post(
+            '/', data=cbor2.dumps({'query': '{ping}'}),
+            content_type='application/cbor',
+            headers={'Accept': 'application/cbor'})
+
+        assert response.mimetype == 'application/cbor'
+        assert cbor2.loads(response.get_data()) == {'data': {'ping': 'pong'}}
+        # JSON unless the client prefers CBOR
+        response = app.test_client().post(
+            '/', data=cbor2.dumps({'query': '{ping}'}),
+            content_type='application/cbor')
+        assert json.loads(response.get_data()) == {'data': {'ping': 'pong'}}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the persisted query registry.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import graphene
+
+from kubos_service import http_service
+from kubos_service.persisted import (HASH_MISMATCH, NOT_FOUND,
+                                     PersistedQueryError, QueryRegistry,
+                                     query_hash)
+
+QUERY = '{ping}'
+
+
+def extensions(query):
+    return {'persistedQuery': {'version': 1, 'sha256Hash': query_hash(query)}}
+
+
+class TestQueryRegistry(unittest.TestCase):
+
+    def test_miss_then_register(self):
+        registry = QueryRegistry()
+
+        with self.assertRaises(PersistedQueryError) as e:
+            registry.resolve(None, extensions(QUERY))
+        assert str(e.exception) == NOT_FOUND
+        assert registry.resolve(QUERY, extensions(QUERY)) == QUERY
+        assert registry.resolve(None, extensions(QUERY)) == QUERY
+        assert registry.stats() == {
+            'loaded': 0, 'registered': 1, 'hits': 1, 'misses': 1}
+
+    def test_hash_mismatch(self):
+        registry = QueryRegistry()
+
+        with self.assertRaises(PersistedQueryError) as e:
+            registry.resolve(QUERY, extensions('{other}'))
+        assert str(e.exception) == HASH_MISMATCH
+        assert registry.lookup(query_hash(QUERY)) is None
+
+    def test_register_disabled(self):
+        registry = QueryRegistry(register=False)
+
+        registry.resolve(QUERY, extensions(QUERY))
+
+        assert registry.lookup(query_hash(QUERY)) is None
+
+    def test_size(self):
+        registry = QueryRegistry(size=2)
+
+        for query in ['{a}', '{b}', '{c}']:
+            registry.register(query)
+
+        assert registry.lookup(query_hash('{a}')) is None
+        assert registry.lookup(query_hash('{c}')) == '{c}'
+
+    def test_load(self):
+        (handle, path) = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'w') as file:
+            json.dump([QUERY], file)
+        registry = QueryRegistry(size=0)
+
+        registry.load(path)
+
+        assert registry.resolve(None, extensions(QUERY)) == QUERY
+
+    def test_plain_request(self):
+        assert QueryRegistry().resolve(QUERY, None) == QUERY
+
+
+class Query(graphene.ObjectType):
+    ping = graphene.String()
+
+    def resolve_ping(self, info):
+        return "pong"
+
+
+class TestPersistedHTTP(unittest.TestCase):
+
+    def post(self, app, request):
+        response = app.test_client().post(
+            '/', data=json.dumps(request), content_type='application/json')
+        return json.loads(response.get_data())
+
+    def test_register(self):
+        app = http_service.create_app(
+            graphene.Schema(query=Query), registry=QueryRegistry())
+
+        response = self.post(app, {'extensions': extensions(QUERY)})
+        assert response['errors'][0]['message'] == NOT_FOUND
+        response = self.post(app, {'query': QUERY, 'extensions': extensions(QUERY)})
+        assert response == {'data': {'ping': 'pong'}}
+        response = self.post(app, {'extensions': extensions(QUERY)})
+        assert response == {'data': {'ping': 'pong'}}
+
+
+if __name__ == '__main__':
+    unittest.main()
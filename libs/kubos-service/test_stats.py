@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for service statistics.
+"""
+
+import json
+import unittest
+
+import graphene
+
+from kubos_service.stats import Histogram, ServiceStats
+
+
+class Query(graphene.ObjectType):
+    ping = graphene.String()
+    fail = graphene.String()
+
+    def resolve_ping(self, info):
+        return "pong"
+
+    def resolve_fail(self, info):
+        raise EnvironmentError("No response")
+
+
+schema = graphene.Schema(query=Query)
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentile(self):
+        histogram = Histogram((1, 2, 4, 8))
+
+        for value in [1, 1, 3, 3, 3, 3, 3, 3, 3, 7]:
+            histogram.add(value)
+
+        assert histogram.percentile(10) == 1
+        assert histogram.percentile(50) == 4
+        assert histogram.percentile(99) == 7
+        assert histogram.as_dict()['mean'] == 3.0
+
+    def test_overflow(self):
+        histogram = Histogram((1, 2))
+
+        histogram.add(100)
+
+        assert histogram.counts == [0, 0, 1]
+        assert histogram.percentile(50) == 100
+
+    def test_empty(self):
+        assert Histogram((1,)).as_dict() == {
+            'count': 0, 'mean': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+
+
+class TestServiceStats(unittest.TestCase):
+
+    def test_fields(self):
+        stats = ServiceStats()
+        instrumented = stats.instrument(schema)
+
+        instrumented.execute('{ping}', middleware=stats.middleware())
+        instrumented.execute('{ping, fail}', middleware=stats.middleware())
+
+        fields = stats.as_dict()['fields']
+        assert fields['Query.ping']['count'] == 2
+        assert fields['Query.fail']['errors'] == 1
+
+    def test_instrument(self):
+        stats = ServiceStats()
+        stats.add_source('documents', lambda: {'hits': 1})
+        stats.record_request(0.01, 10, 100, False)
+
+        result = stats.instrument(schema).execute('{serviceStats}')
+
+        output = json.loads(result.data['serviceStats'])
+        assert output['requests']['count'] == 1
+        assert output['requests']['response_bytes']['max'] == 100
+        assert output['documents'] == {'hits': 1}
+
+    def test_unsampled(self):
+        stats = ServiceStats(sample_rate=0)
+
+        assert stats.middleware() == []
+        stats.record_request(0.01, 10, 100, True)
+        assert stats.as_dict()['requests']['errors'] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
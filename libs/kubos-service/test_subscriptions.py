@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for query subscriptions.
+"""
+
+import queue
+import time
+import unittest
+
+import graphene
+
+from kubos_service import http_service
+from kubos_service.subscriptions import SubscriptionError, SubscriptionManager
+
+
+class Query(graphene.ObjectType):
+    ping = graphene.String()
+    count = graphene.Int()
+
+    def resolve_ping(self, info):
+        return "pong"
+
+    def resolve_count(self, info):
+        info.context['count'] += 1
+        return info.context['count']
+
+
+class Noop(graphene.Mutation):
+    success = graphene.Boolean()
+
+    def mutate(self, info):
+        return Noop(success=True)
+
+
+class Mutation(graphene.ObjectType):
+    noop = Noop.Field()
+
+
+schema = graphene.Schema(query=Query, mutation=Mutation)
+
+
+class TestSubscriptionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = SubscriptionManager(
+            schema, {'count': 0}, min_period=0.01, lease=0)
+        self.pushes = queue.Queue()
+
+    def sink(self, id, response):
+        self.pushes.put((id, response))
+
+    def test_push(self):
+        id = self.manager.subscribe('{count}', self.sink, period=0.01)
+
+        for count in range(1, 4):
+            assert self.pushes.get(timeout=1) == (
+                id, {'data': {'count': count}, 'errors': None})
+
+    def test_on_change(self):
+        self.manager.subscribe(
+            '{ping}', self.sink, period=0.01, on_change=True)
+
+        self.pushes.get(timeout=1)
+        time.sleep(0.1)
+        assert self.pushes.empty()
+        assert self.manager.stats()['pushes'] == 1
+
+    def test_unsubscribe(self):
+        id = self.manager.subscribe('{ping}', self.sink, period=0.01)
+        self.pushes.get(timeout=1)
+
+        assert self.manager.unsubscribe(id)
+        assert not self.manager.unsubscribe(id)
+        assert not self.manager.renew(id)
+        assert self.manager.stats()['active'] == 0
+
+    def test_sink_ends(self):
+        self.manager.subscribe('{ping}', lambda id, response: False, period=0.01)
+
+        time.sleep(0.1)
+        assert self.manager.stats() == {'active': 0, 'limit': 64, 'pushes': 0}
+
+    def test_lease(self):
+        id = self.manager.subscribe(
+            '{ping}', self.sink, period=0.05, lease=0.2)
+
+        # Renewing keeps the subscription past its first lease
+        for _ in range(4):
+            time.sleep(0.1)
+            assert self.manager.renew(id)
+        time.sleep(0.3)
+        assert not self.manager.renew(id)
+        assert self.manager.stats()['active'] == 0
+
+    def test_rejected(self):
+        for (query, period) in [
+                ('mutation {noop {success}}', 1.0),
+                ('{ping', 1.0),
+                ('', 1.0),
+                ('{ping}', 0.001)]:
+            with self.assertRaises(SubscriptionError):
+                self.manager.subscribe(query, self.sink, period=period)
+
+    def test_limit(self):
+        self.manager.limit = 1
+        self.manager.subscribe('{ping}', self.sink)
+
+        with self.assertRaises(SubscriptionError):
+            self.manager.subscribe('{ping}', self.sink)
+
+
+class TestStreams(unittest.TestCase):
+
+    def test_streams(self):
+        manager = SubscriptionManager(schema, {'count': 0}, min_period=0.01)
+        client = http_service.create_app(
+            schema, subscriptions=manager, streams=1).test_client()
+        url = '/subscribe?query={ping}&period=0.01'
+
+        stream = client.get(url, buffered=False)
+        assert stream.status_code == 200
+        assert next(stream.response).startswith(b'data: ')
+        # The other workers are left for queries
+        assert client.get(url).status_code == 503
+        stream.close()
+        stream = client.get(url, buffered=False)
+        assert stream.status_code == 200
+        stream.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
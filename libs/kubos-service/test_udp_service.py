@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the UDP service wrapper.
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+import unittest
+
+import graphene
+
+from kubos_service import udp_service
+
+
+class Query(graphene.ObjectType):
+    ping = graphene.String()
+
+    def resolve_ping(self, info):
+        return "pong"
+
+
+class Schema:
+    schema = graphene.Schema(query=Query)
+
+
+class Config:
+    name = "test-service"
+    ip = "127.0.0.1"
+
+    def __init__(self, server):
+        # A free port for the service
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((self.ip, 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.raw = {'server': server}
+
+
+def serve(server):
+    config = Config(server)
+    thread = threading.Thread(
+        target=udp_service.start,
+        args=(logging.getLogger(), config, Schema()))
+    thread.daemon = True
+    thread.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.connect((config.ip, config.port))
+    # Wait for the service to bind
+    client.settimeout(0.1)
+    for _ in range(50):
+        try:
+            client.send(b'{ping}')
+            client.recv(udp_service.MAX_DATAGRAM)
+            break
+        except (ConnectionRefusedError, socket.timeout):
+            time.sleep(0.1)
+    client.settimeout(2)
+    return client
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_round_trip(self):
+        payload = bytes(range(256)) * 10
+
+        datagrams = udp_service.fragment(9, payload, 100, udp_service.FLAG_CBOR)
+
+        assert all(len(datagram) <= 100 for datagram in datagrams)
+        frames = [udp_service.parse_frame(datagram) for datagram in datagrams]
+        assert [frame.index for frame in frames] == list(range(len(frames)))
+        assert {(frame.request_id, frame.count, frame.flags)
+                for frame in frames} == {(9, len(frames), udp_service.FLAG_CBOR)}
+        assert b''.join(frame.payload for frame in frames) == payload
+
+    def test_empty(self):
+        (datagram,) = udp_service.fragment(1, b'', 100)
+
+        assert udp_service.parse_frame(datagram).payload == b''
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            udp_service.parse_frame(b'{ping}')
+        with self.assertRaises(ValueError):
+            udp_service.parse_frame(udp_service.Frame(1, b'', 2, 2).pack())
+        with self.assertRaises(ValueError):
+            udp_service.fragment(1, b'data', udp_service.FRAME_HEADER.size)
+
+    def test_service(self):
+        client = serve({'fragment_size': 200})
+        client.send(udp_service.Frame(3, b'{__schema {types {name}}}').pack())
+
+        frames = {}
+        while not frames or len(frames) < next(iter(frames.values())).count:
+            frame = udp_service.parse_frame(
+                client.recv(udp_service.MAX_DATAGRAM))
+            assert frame.request_id == 3
+            frames[frame.index] = frame
+        response = json.loads(b''.join(
+            frames[index].payload for index in sorted(frames)))
+        assert len(frames) > 1
+        assert {'name': 'Query'} in response['data']['__schema']['types']
+        client.close()
+
+    def test_cbor(self):
+        if udp_service.cbor2 is None:
+            self.skipTest("cbor2 is not installed")
+        cbor2 = udp_service.cbor2
+        client = serve({})
+        request = cbor2.dumps({'query': '{ping}'})
+
+        client.send(udp_service.Frame(
+            4, request, flags=udp_service.FLAG_CBOR).pack())
+        frame = udp_service.parse_frame(client.recv(udp_service.MAX_DATAGRAM))
+        assert frame.flags & udp_service.FLAG_CBOR
+        assert cbor2.loads(frame.payload)['data'] == {'ping': 'pong'}
+        # Unframed CBOR maps get CBOR back
+        client.send(request)
+        assert cbor2.loads(client.recv(udp_service.MAX_DATAGRAM))['data'] == \
+            {'ping': 'pong'}
+        client.close()
+
+
+class TestSubscriptions(unittest.TestCase):
+
+    def test_push_framing(self):
+        client = serve({'workers': 1, 'subscription_min_period': 0.05})
+        request = json.dumps({
+            'query': '{ping}', 'subscribe': {'period': 0.05}}).encode()
+        client.send(udp_service.Frame(7, request).pack())
+        frame = udp_service.parse_frame(client.recv(udp_service.MAX_DATAGRAM))
+        assert frame.request_id == 7
+
+        # A plain request handled by the same worker
+        client.send(b'{ping}')
+        pushes = 0
+        plain = 0
+        while pushes < 3 or not plain:
+            data = client.recv(udp_service.MAX_DATAGRAM)
+            if not udp_service.is_framed(data):
+                assert json.loads(data) == {'data': {'ping': 'pong'}, 'errors': None}
+                plain += 1
+                continue
+            frame = udp_service.parse_frame(data)
+            assert frame.request_id == 7
+            assert json.loads(frame.payload)['subscription'] == 1
+            pushes += 1
+        assert plain == 1
+        client.close()
+
+
+class FakeManager:
+
+    def __init__(self):
+        self.leases = []
+
+    def subscribe(self, query, sink, variables=None, operation_name=None,
+                  period=1.0, on_change=False, lease=None):
+        self.leases.append(lease)
+        return len(self.leases)
+
+
+class TestSubscriptionRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = FakeManager()
+        self.source = ("10.0.0.2", 5000)
+
+    def subscribe(self, options, **kwargs):
+        return udp_service.subscription_request(
+            self.manager, {'query': '{ping}', 'subscribe': options},
+            self.source, lambda address, response: None, **kwargs)
+
+    def test_callback_at_source(self):
+        assert self.subscribe({'callback': '10.0.0.2:9000'}) is None
+        assert self.manager.leases == [None]
+
+    def test_remote_callback(self):
+        response = self.subscribe({'callback': '10.0.0.3:9000'})
+
+        assert "source address" in response['errors'][0]
+        assert self.manager.leases == []
+        # Unless allowed
+        assert self.subscribe(
+            {'callback': '10.0.0.3:9000'}, remote_callback=True) is None
+
+    def test_lease(self):
+        response = self.subscribe({'lease': 0})
+
+        assert "positive" in response['errors'][0]
+        assert self.subscribe({'lease': 7200}, max_lease=3600) is None
+        assert self.subscribe({'lease': 60}, max_lease=3600) is None
+        assert self.manager.leases == [3600, 60]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,6 +11,7 @@ Currently only implements integration testing for hardware services.
 """
 
 import app_api
+import requests
 import socket
 
 DEFAULT_CONFIG_PATH = "/etc/kubos-config.toml"
@@ -26,17 +27,33 @@ class IntegrationTest:
         self.api = app_api.Services(config_filepath)
 
     def test_services(self, query=SERVICE_MUTATION):
-        for service in self.api.config:
-            self.test_service(service=service, query=query)
+        # Test every service at once, then report in config order
+        services = list(self.api.config)
+        responses = self.api.query_many(
+            [(service, query) for service in services],
+            timeout=QUERY_TIMEOUT)
+        for service, response in zip(services, responses):
+            self.report(service, response)
 
     def test_service(self, service, query=SERVICE_MUTATION):
-        response = []
         try:
             # Complete the test mutation
             response = self.api.query(
                 service=service,
                 query=query,
                 timeout=QUERY_TIMEOUT)
+        except Exception as e:
+            response = e
+        self.report(service, response)
+
+    def report(self, service, response):
+        """
+        Prints the outcome of a test mutation: its response, or the
+        exception raised while sending it.
+        """
+        try:
+            if isinstance(response, Exception):
+                raise response
 
             # Check for successful test
             if response['test']['success']:
@@ -45,7 +62,7 @@ class IntegrationTest:
             else:
                 print("Status : FAILED\n {}".format(service))
                 print("Response : {}\n".format(response))
-        except socket.timeout as e:
+        except (socket.timeout, requests.exceptions.Timeout) as e:
             print("Status : TIMEOUT\n {}".format(service))
             print("No response from server")
             print("Timeout : {} seconds\n".format(QUERY_TIMEOUT))
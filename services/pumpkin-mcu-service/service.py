@@ -13,9 +13,12 @@ from logging.handlers import SysLogHandler
 import sys
 
 from service import schema
+from service.forwarder import TelemetryForwarder
+from service.telemetry import Poller
 
+import app_api
 from kubos_service import http_service
-from kubos_service.config import Config
+from kubos_service.config import DEFAULT_PATH, Config, get_args
 
 c = Config("pumpkin-mcu-service")
 
@@ -35,5 +38,33 @@ logger.addHandler(stdout)
 # Set which modules are present and their addresses from the config file.
 schema.MODULES = c.raw['modules']
 
+# Forward every reading to the telemetry database service, if configured.
+if 'forward' in c.raw:
+    services = app_api.Services(get_args(c.name).config or DEFAULT_PATH)
+    schema.FORWARDER = TelemetryForwarder(c.raw['forward'], services)
+    schema.CACHE.subscribe(schema.FORWARDER.submit)
+
+# Start refreshing the telemetry cache in the background, if configured.
+poller = None
+if 'poll' in c.raw:
+    poller = Poller(schema.MODULES, schema.CACHE, c.raw['poll'])
+    poller.start()
+
+
+def apply_config(config):
+    """
+    Applies a changed module list without restarting, keeping the caches
+    warm. Changes to the poll groups and forwarding need a restart.
+    """
+    schema.MODULES = config.raw['modules']
+    if poller is not None:
+        poller.modules = schema.MODULES
+    logger.info("Modules reconfigured: {}".format(schema.MODULES))
+
+
+# Watch the config file for module list changes.
+c.subscribe(apply_config)
+c.watch()
+
 # Starts the HTTP service
 http_service.start(c, schema.schema)
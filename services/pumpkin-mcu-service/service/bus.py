@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Process-wide I2C bus manager for the Pumpkin MCU service.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+import mcu_api
+
+logger = logging.getLogger("pumpkin-mcu-service")
+
+# Lower values run first
+PRIORITY_COMMAND = 0
+PRIORITY_TELEMETRY = 1
+PRIORITY_HOUSEKEEPING = 2
+
+
+class _Job:
+    """
+    One queued bus operation. Telemetry jobs are shared by every request
+    for the same field while they are pending or in flight.
+    """
+
+    def __init__(self, address, key=None, field=None, function=None):
+        self.address = address
+        self.key = key
+        self.field = field
+        self.function = function
+        self.future = Future()
+        self.started = False
+
+
+class BusManager:
+    """
+    Owns the I2C handle and runs every transaction from one worker thread.
+
+    Jobs are queued per module address and ordered by priority, so
+    passthrough commands go ahead of queued telemetry. Each module has at
+    most one telemetry command in flight, while different modules settle
+    concurrently. Requests for a field that is already queued or in flight
+    share that read instead of issuing another one.
+    """
+
+    def __init__(self, i2cfile=None):
+        self.i2cfile = i2cfile
+        self._cond = threading.Condition()
+        self._sequence = 0
+        self._thread = None
+        self._mcus = {}
+        # address -> heap of (priority, sequence, job)
+        self._pending = {}
+        # (address, fieldname) -> job, while pending or in flight
+        self._coalesce = {}
+        # address -> [job, started, attempt], telemetry in flight
+        self._active = {}
+        # heap of (deadline, sequence, address)
+        self._timers = []
+        self.coalesced = 0
+
+    def read_telemetry(self, module, address, module_fields,
+                       priority=PRIORITY_TELEMETRY, timeout=None):
+        """
+        Reads TelemetryFields from a module and returns the merged output,
+        as MCU.read_telemetry would.
+        """
+        output = {}
+        for future in self.submit_telemetry(
+                address, module_fields, priority=priority):
+            output.update(future.result(timeout))
+        return output
+
+    def submit_telemetry(self, address, module_fields,
+                         priority=PRIORITY_TELEMETRY):
+        """
+        Queues TelemetryFields for reading.
+        Output: a list of Futures, one per field, each resolving to that
+        field's formatted output.
+        """
+        futures = []
+        with self._cond:
+            for field in module_fields:
+                key = (address, field.name)
+                job = self._coalesce.get(key)
+                if job is None:
+                    job = _Job(address, key=key, field=field)
+                    self._coalesce[key] = job
+                else:
+                    self.coalesced += 1
+                # Queueing a job again at a higher priority bumps it, the
+                # lower priority entry is skipped once the job has started.
+                self._push(job, priority)
+                futures.append(job.future)
+            self._cond.notify()
+        self._ensure_started()
+        return futures
+
+    def write(self, address, command, priority=PRIORITY_COMMAND):
+        """
+        Writes a command to a module. See MCU.write.
+        """
+        return self.call(
+            address, lambda mcu: mcu.write(command), priority=priority)
+
+    def read(self, address, count, priority=PRIORITY_COMMAND):
+        """
+        Reads raw bytes from a module. See MCU.read.
+        """
+        return self.call(
+            address, lambda mcu: mcu.read(count=count), priority=priority)
+
+    def call(self, address, function, priority=PRIORITY_COMMAND):
+        """
+        Runs function(MCU) on the worker once the module is idle and
+        returns its result.
+        """
+        job = _Job(address, function=function)
+        with self._cond:
+            self._push(job, priority)
+            self._cond.notify()
+        self._ensure_started()
+        return job.future.result()
+
+    def set_i2cfile(self, i2cfile):
+        """
+        Switches to another I2C device. MCUs opened on the old one are
+        dropped, so later jobs use the new device and the current
+        mcu_api defaults.
+        """
+        with self._cond:
+            self.i2cfile = i2cfile
+            self._mcus = {}
+
+    def _push(self, job, priority):
+        self._sequence += 1
+        heapq.heappush(
+            self._pending.setdefault(job.address, []),
+            (priority, self._sequence, job))
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="pumpkin-mcu-bus")
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _mcu(self, address):
+        if address not in self._mcus:
+            self._mcus[address] = mcu_api.MCU(
+                address=address, i2cfile=self.i2cfile)
+        return self._mcus[address]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                action = self._next_action()
+                while action is None:
+                    if self._timers:
+                        wait = self._timers[0][0] - time.monotonic()
+                        if wait > 0:
+                            self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                    action = self._next_action()
+            try:
+                action()
+            except Exception as e:
+                logger.error("Bus manager error: {}".format(e))
+
+    def _next_action(self):
+        """
+        Picks the next bus operation. Must be called with the lock held.
+        Output: a callable to run without the lock, or None if there is
+        nothing to do yet.
+        """
+        # Due data checks are short and free up their module
+        if self._timers and self._timers[0][0] <= time.monotonic():
+            (_, _, address) = heapq.heappop(self._timers)
+            return lambda: self._check(address)
+
+        best = None
+        for address, heap in self._pending.items():
+            if address in self._active:
+                continue
+            while heap and heap[0][2].started:
+                heapq.heappop(heap)
+            if heap and (best is None or heap[0] < best):
+                best = heap[0]
+        if best is None:
+            return None
+
+        job = best[2]
+        heapq.heappop(self._pending[job.address])
+        job.started = True
+        if job.field is None:
+            return lambda: self._run_call(job)
+        self._active[job.address] = [job, None, 0]
+        return lambda: self._start(job)
+
+    def _run_call(self, job):
+        try:
+            job.future.set_result(job.function(self._mcu(job.address)))
+        except Exception as e:
+            job.future.set_exception(e)
+
+    def _start(self, job):
+        mcu = self._mcu(job.address)
+        try:
+            mcu._send(job.field)
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        with self._cond:
+            self._active[job.address][1] = time.monotonic()
+            self._schedule(job.address, mcu._settle_time(job.field))
+
+    def _check(self, address):
+        job, started, attempt = self._active[address]
+        try:
+            result, wait = self._mcu(address)._check_ready(
+                job.field, started, attempt)
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        if result is None:
+            with self._cond:
+                self._active[address][2] = attempt + 1
+                self._schedule(address, wait)
+            return
+        self._finish(job, result=result)
+
+    def _schedule(self, address, wait):
+        self._sequence += 1
+        heapq.heappush(
+            self._timers,
+            (time.monotonic() + wait, self._sequence, address))
+
+    def _finish(self, job, result=None, error=None):
+        with self._cond:
+            del self._active[job.address]
+            if self._coalesce.get(job.key) is job:
+                del self._coalesce[job.key]
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+
+# The bus manager shared by every resolver and the poller.
+BUS = BusManager()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Batched forwarding of sampled telemetry into the telemetry database service.
+"""
+
+import threading
+import time
+
+import app_api
+
+
+class TelemetryForwarder:
+    """
+    Stores every new sampled reading in telemetry-service, through an
+    app_api.TelemetryWriter which buffers and sends them in batches.
+
+    Configured from the service's "forward" table in config.toml:
+
+        [pumpkin-mcu-service.forward]
+        service = "telemetry-service"
+        transport = "udp"
+        batch_size = 100
+        interval = 5.0
+        buffer = 1000
+
+    service is telemetry-service's name in the config file, and services
+    the app_api.Services reading that file. The other settings are those
+    of TelemetryWriter. Points are stored with subsystem set to the module
+    name and parameter to the telemetry name.
+    """
+
+    def __init__(self, config, services):
+        self.writer = app_api.TelemetryWriter(
+            services,
+            service=config.get('service', 'telemetry-service'),
+            transport=config.get('transport', 'udp'),
+            batch_size=config.get('batch_size', 100),
+            interval=config.get('interval', 5.0),
+            buffer=config.get('buffer', 1000),
+            block=config.get('block', False),
+            block_timeout=config.get('block_timeout', 1.0),
+            timeout=config.get('timeout', 2.0))
+        self._lock = threading.Lock()
+        # (module, name) -> MCU timestamp of the last point forwarded
+        self._last = {}
+
+    def submit(self, module, fragments):
+        """
+        Queues telemetry for forwarding. fragments is a dict of
+        {fieldname: {name: {'timestamp': ..., 'data': ...}}}, as stored in
+        the TelemetryCache. Readings that were not ready (timestamp 0) or
+        were already forwarded are skipped.
+        """
+        now = time.time()
+        points = []
+        with self._lock:
+            for fragment in fragments.values():
+                for name, value in fragment.items():
+                    key = (module, name)
+                    timestamp = value['timestamp']
+                    if timestamp == 0 or self._last.get(key) == timestamp:
+                        continue
+                    self._last[key] = timestamp
+                    points.append((name, value['data']))
+        for name, data in points:
+            self.writer.write(module, name, data, timestamp=now)
+
+    def stats(self):
+        stats = self.writer.stats()
+        stats['transport'] = self.writer.transport
+        return stats
+
+    def close(self):
+        """
+        Sends what is left and stops the writer.
+        """
+        self.writer.close()
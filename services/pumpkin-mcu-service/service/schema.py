@@ -11,6 +11,8 @@ Graphene schema setup to enable queries.
 import graphene
 import logging
 from .models import *
+from .bus import BUS
+from .telemetry import TelemetryCache, expand_fields, telemetry_loader
 import mcu_api
 
 # Initialize MODULES global. This is then configured in the service file.
@@ -20,6 +22,12 @@ MODULES = {
     "module_name": {"address": 0xFF}
 }
 
+# Most recent telemetry, filled by live reads and the optional poller.
+CACHE = TelemetryCache()
+
+# Optional TelemetryForwarder, configured in the service file.
+FORWARDER = None
+
 logger = logging.getLogger("pumpkin-mcu-service")
 
 class Query(graphene.ObjectType):
@@ -34,7 +42,9 @@ class Query(graphene.ObjectType):
         count=graphene.Int())
     mcuTelemetry = graphene.JSONString(
         module=graphene.String(),
-        fields=graphene.List(graphene.String, default_value=["all"]))
+        fields=graphene.List(graphene.String, default_value=["all"]),
+        maxAge=graphene.Float())
+    forwarderStats = graphene.JSONString()
 
     def resolve_ping(self, info):
         return "pong"
@@ -46,6 +56,14 @@ class Query(graphene.ObjectType):
         """
         return MODULES
 
+    def resolve_forwarderStats(self, info):
+        """
+        Counters of the telemetry forwarder, or null if forwarding is off.
+        """
+        if FORWARDER is None:
+            return None
+        return FORWARDER.stats()
+
     def resolve_fieldList(self, info, module):
         """
         This allows discovery of which fields are available for a
@@ -69,16 +87,15 @@ class Query(graphene.ObjectType):
         if module not in MODULES:
             raise KeyError('Module not configured: {}'.format(module))
         address = MODULES[module]['address']
-        mcu = mcu_api.MCU(address=address)
         try:
-            bin_data = mcu.read(count=count)
+            bin_data = BUS.read(address, count)
 
             return bin_data.encode("hex")
         except Exception as e:
             logger.error("Failed to read {} bytes from {}: {}".format(count, module, e))
             raise
 
-    def resolve_mcuTelemetry(self, info, module, fields):
+    def resolve_mcuTelemetry(self, info, module, fields, maxAge=None):
         """
         Queries specific telemetry item fields from the speficied
         module.
@@ -87,6 +104,14 @@ class Query(graphene.ObjectType):
         configuration data in the mcu_api.py file. Inputting ['all']
         retrieves all available telemetry for that module.
 
+        Fields are answered from the cache while they are younger than
+        their TTL, or than maxAge (seconds) if given. Anything older is
+        read live from the module. maxAge: 0 always reads live.
+
+        Every mcuTelemetry field of a request, such as several aliased
+        selections, is read in one batched bus pass, with fields requested
+        more than once read once.
+
         Retuns json dump of the form:
         {
         'fieldname1':{'timestamp':float,'data':configured datatype},
@@ -96,14 +121,14 @@ class Query(graphene.ObjectType):
         if module not in MODULES:
             raise KeyError('Module not configured: {}'.format(module))
         address = MODULES[module]['address']
-        fields = list(map(str, fields))
-        mcu = mcu_api.MCU(address=address)
-        try:
-            out = mcu.read_telemetry(module=module, fields=fields)
-            return out
-        except Exception as e:
+        fields = tuple(map(str, fields))
+
+        def failed(e):
             logger.error("Failed to read telemetry from {}: {}".format(module, e))
-            raise
+            raise e
+
+        return telemetry_loader(CACHE).load(
+            (module, address, fields, maxAge)).then(None, failed)
 
 
 class Passthrough(graphene.Mutation):
@@ -125,9 +150,8 @@ class Passthrough(graphene.Mutation):
             raise KeyError('Module not configured', module)
         if type(command) == str:
             command = str.encode(command)
-        mcu = mcu_api.MCU(address=MODULES[module]['address'])
         try:
-            out = mcu.write(command)
+            out = BUS.write(MODULES[module]['address'], command)
             commandStatus = CommandStatus(status=out[0], command=out[1])
             return commandStatus
         except Exception as e:
@@ -155,10 +179,10 @@ class Test(graphene.Mutation):
         elif test == 1:  # NOOP
             for module in MODULES:
                 try:
-                    mcu = mcu_api.MCU(address=MODULES[module]['address'])
-                    out = mcu.read_telemetry(
-                        module=module,
-                        fields=['firmware_version'])
+                    out = BUS.read_telemetry(
+                        module,
+                        MODULES[module]['address'],
+                        expand_fields(module, ['firmware_version']))
                     mcu_out = {module: out}
                     test_output.update(mcu_out)
                 except Exception as e:
@@ -170,10 +194,10 @@ class Test(graphene.Mutation):
         elif test == 2:  # INTEGRATION test
             for module in MODULES:
                 try:
-                    mcu = mcu_api.MCU(address=MODULES[module]['address'])
-                    out = mcu.read_telemetry(
-                        module=module,
-                        fields=['firmware_version'])
+                    out = BUS.read_telemetry(
+                        module,
+                        MODULES[module]['address'],
+                        expand_fields(module, ['firmware_version']))
                     mcu_out = {module: out}
                     test_output.update(mcu_out)
                 except Exception as e:
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Telemetry cache, request batching and background poller for the Pumpkin
+MCU service.
+"""
+
+import logging
+import threading
+import time
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+import mcu_api
+from .bus import BUS, PRIORITY_HOUSEKEEPING
+
+logger = logging.getLogger("pumpkin-mcu-service")
+
+
+def expand_fields(module, fields):
+    """
+    Returns the TelemetryFields requested, with ["all"] expanded.
+    Raises KeyError for unknown modules or fields, like mcu_api.
+    """
+    registry = mcu_api.get_registry()
+    if module not in registry.all_fields:
+        raise KeyError(
+            'Module name: {} not found in mcu_config file.'.format(module))
+    all_fields = registry.all_fields[module]
+    if fields == ["all"]:
+        return list(all_fields.values())
+    try:
+        return [all_fields[field] for field in fields]
+    except KeyError as e:
+        raise KeyError('Invalid field: {}'.format(e.args[0]))
+
+
+def split_fields(module_fields, output):
+    """
+    Splits a read_telemetry output into per-field fragments.
+    Output: dict of {fieldname: {outputname: {timestamp, data}}}
+    """
+    fragments = {}
+    for field in module_fields:
+        names = field.names or (field.name,)
+        if all(name in output for name in names):
+            fragments[field.name] = {name: output[name] for name in names}
+    return fragments
+
+
+class TelemetryCache:
+    """
+    Most recent reading of every telemetry field, with per-field TTLs.
+
+    Fields refreshed by the poller get the TTL of their poll group. Fields
+    that are only ever read live have a TTL of 0, so they are only served
+    from the cache when a query explicitly accepts an older value with
+    maxAge.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (module, field) -> (monotonic time stored, output fragment)
+        self._entries = {}
+        # (module, field) -> ttl in seconds
+        self._ttls = {}
+        self._listeners = []
+
+    def set_ttl(self, module, field, ttl):
+        with self._lock:
+            self._ttls[(module, field)] = ttl
+
+    def subscribe(self, listener):
+        """
+        Calls listener(module, fragments) with every reading stored, after
+        it has been cached.
+        """
+        self._listeners.append(listener)
+
+    def store(self, module, fragments):
+        """
+        Stores per-field fragments as returned by split_fields.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for field, fragment in fragments.items():
+                self._entries[(module, field)] = (now, fragment)
+        for listener in self._listeners:
+            try:
+                listener(module, fragments)
+            except Exception as e:
+                logger.error("Telemetry listener failed: {}".format(e))
+
+    def lookup(self, module, module_fields, max_age=None):
+        """
+        Looks up the requested fields.
+
+        max_age is the oldest reading accepted, in seconds. If None, each
+        field's TTL is used instead.
+
+        Output: (merged output of the fresh fields, list of the
+        TelemetryFields that are missing or too old)
+        """
+        now = time.monotonic()
+        output = {}
+        missing = []
+        with self._lock:
+            for field in module_fields:
+                key = (module, field.name)
+                entry = self._entries.get(key)
+                limit = max_age
+                if limit is None:
+                    limit = self._ttls.get(key, 0)
+                if entry is None or now - entry[0] > limit:
+                    missing.append(field)
+                else:
+                    output.update(entry[1])
+        return output, missing
+
+
+def read_live(module, address, module_fields, cache=None):
+    """
+    Reads fields straight from the module through the bus manager and
+    stores them in the cache.
+    """
+    output = BUS.read_telemetry(module, address, module_fields)
+    if cache is not None:
+        cache.store(module, split_fields(module_fields, output))
+    return output
+
+
+class TelemetryLoader(DataLoader):
+    """
+    Batches the mcuTelemetry reads of one request into one bus pass.
+
+    Keys are (module, address, fields, max_age) tuples, with fields a tuple
+    of field names. Every key loaded while a request executes is answered
+    together: the fields not fresh enough in the cache are deduplicated per
+    module and queued on the bus manager at once, so modules settle
+    concurrently and each field is read once. Each key then gets the
+    output of its own fields, or the error of its first failed field.
+
+    The loader doesn't remember results between batches, so one loader
+    per thread serves every request run on that thread.
+    """
+
+    def __init__(self, cache):
+        DataLoader.__init__(self, cache=False)
+        self.telemetry_cache = cache
+
+    def batch_load_fn(self, keys):
+        # key -> (merged cached output, missing TelemetryFields) or error
+        lookups = {}
+        # module -> (address, {fieldname: TelemetryField})
+        requested = {}
+        for key in set(keys):
+            (module, address, fields, max_age) = key
+            try:
+                module_fields = expand_fields(module, list(fields))
+            except KeyError as e:
+                lookups[key] = e
+                continue
+            out, missing = self.telemetry_cache.lookup(
+                module, module_fields, max_age=max_age)
+            lookups[key] = (out, missing)
+            if missing:
+                fields_read = requested.setdefault(module, (address, {}))[1]
+                for field in missing:
+                    fields_read[field.name] = field
+
+        # Queue everything before waiting on anything
+        futures = {}
+        for module, (address, fields_read) in requested.items():
+            futures[module] = dict(zip(
+                fields_read,
+                BUS.submit_telemetry(address, list(fields_read.values()))))
+
+        # module -> {fieldname: output or error}
+        results = {}
+        for module, field_futures in futures.items():
+            output = {}
+            results[module] = {}
+            for name, future in field_futures.items():
+                try:
+                    results[module][name] = future.result()
+                    output.update(results[module][name])
+                except Exception as e:
+                    # Logged by the resolvers the error is returned to
+                    results[module][name] = e
+            self.telemetry_cache.store(module, split_fields(
+                requested[module][1].values(), output))
+
+        values = []
+        for key in keys:
+            lookup = lookups[key]
+            if isinstance(lookup, Exception):
+                values.append(lookup)
+                continue
+            (out, missing) = lookup
+            out = dict(out)
+            for field in missing:
+                result = results[key[0]][field.name]
+                if isinstance(result, Exception):
+                    out = result
+                    break
+                out.update(result)
+            values.append(out)
+        return Promise.resolve(values)
+
+
+_loaders = threading.local()
+
+
+def telemetry_loader(cache):
+    """
+    Returns the calling thread's TelemetryLoader for a cache.
+    """
+    loader = getattr(_loaders, 'loader', None)
+    if loader is None or loader.telemetry_cache is not cache:
+        loader = _loaders.loader = TelemetryLoader(cache)
+    return loader
+
+
+class PollGroup:
+    """
+    A set of fields of one module refreshed at a fixed period.
+    """
+
+    def __init__(self, module, fields, period, ttl=None):
+        self.module = module
+        self.module_fields = expand_fields(module, fields)
+        self.period = float(period)
+        if ttl is None:
+            ttl = 2 * self.period
+        self.ttl = float(ttl)
+        self.due = 0.0
+
+
+class Poller(threading.Thread):
+    """
+    Background thread keeping the cache fresh.
+
+    Configured from the service's "poll" array in config.toml:
+
+        [[pumpkin-mcu-service.poll]]
+        module = "bm2"
+        fields = ["all"]
+        period = 30.0
+        ttl = 60.0
+
+    "fields" defaults to ["all"] and "ttl" to twice the period. Reads are
+    queued on the bus manager at housekeeping priority, so groups of
+    different modules are read concurrently and queries go first.
+    """
+
+    def __init__(self, modules, cache, config):
+        threading.Thread.__init__(self, name="pumpkin-mcu-poller")
+        self.daemon = True
+        self.modules = modules
+        self.cache = cache
+        self.groups = []
+        self._stop_event = threading.Event()
+        for entry in config:
+            module = entry['module']
+            if module not in modules:
+                raise KeyError('Module not configured: {}'.format(module))
+            group = PollGroup(
+                module=module,
+                fields=entry.get('fields', ["all"]),
+                period=entry['period'],
+                ttl=entry.get('ttl'))
+            for field in group.module_fields:
+                cache.set_ttl(module, field.name, group.ttl)
+            self.groups.append(group)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        logger.info("Telemetry poller started with {} groups".format(
+            len(self.groups)))
+        if not self.groups:
+            return
+        while not self._stop_event.is_set():
+            now = time.monotonic()
+            due = [group for group in self.groups if group.due <= now]
+            if due:
+                try:
+                    self.poll(due)
+                except Exception as e:
+                    logger.error("Telemetry poll failed: {}".format(e))
+                for group in due:
+                    group.due = now + group.period
+                continue
+            next_due = min(group.due for group in self.groups)
+            self._stop_event.wait(next_due - now)
+
+    def poll(self, groups):
+        """
+        Reads every field of the given groups and waits for the results.
+        """
+        requested = {}
+        for group in groups:
+            fields = requested.setdefault(group.module, {})
+            for field in group.module_fields:
+                fields[field.name] = field
+
+        futures = {}
+        for module, fields in requested.items():
+            futures[module] = BUS.submit_telemetry(
+                self.modules[module]['address'],
+                list(fields.values()),
+                priority=PRIORITY_HOUSEKEEPING)
+
+        for module, module_futures in futures.items():
+            output = {}
+            try:
+                for future in module_futures:
+                    output.update(future.result())
+            except Exception as e:
+                logger.error("Failed to poll telemetry from {}: {}".format(
+                    module, e))
+            self.cache.store(
+                module, split_fields(requested[module].values(), output))
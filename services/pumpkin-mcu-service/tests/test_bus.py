@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the Pumpkin MCU service bus manager.
+
+Run from the service directory, with the MCU API and I2C library on the
+path:
+
+    $ PYTHONPATH=../../apis/pumpkin-mcu-api:../../hal/python-hal/i2c \
+        python -m pytest tests/test_bus.py
+"""
+
+import threading
+import time
+import unittest
+
+import mock
+
+import mcu_api
+from service import bus
+
+
+class FakeMCU:
+    """
+    MCU answering every field straight away with its address as data, and
+    logging each bus operation.
+    """
+
+    def __init__(self, address, i2cfile=None):
+        self.address = address
+        self.log = i2cfile
+
+    def _send(self, field):
+        self.log.append(('send', self.address, field.name))
+
+    def _settle_time(self, field):
+        return 0
+
+    def _check_ready(self, field, started, attempt):
+        return ({field.name: {'timestamp': 1.0, 'data': self.address}}, 0)
+
+    def write(self, command):
+        self.log.append(('write', self.address, command))
+        return (True, command)
+
+
+def fields(module, *names):
+    all_fields = mcu_api.get_registry().all_fields[module]
+    return [all_fields[name] for name in names]
+
+
+class BusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(mcu_api, 'MCU', FakeMCU)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log = []
+        self.bus = bus.BusManager(i2cfile=self.log)
+
+    def hold(self):
+        """
+        Blocks the worker until the returned event is set, so jobs queue up.
+        """
+        held = threading.Event()
+        release = threading.Event()
+
+        def wait(mcu):
+            held.set()
+            release.wait(2)
+
+        thread = threading.Thread(target=self.bus.call, args=(0x10, wait))
+        thread.start()
+        held.wait(2)
+        return release, thread
+
+
+class TestBusManager(BusTestCase):
+
+    def test_read_telemetry(self):
+        output = self.bus.read_telemetry(
+            'bim', 0x31, fields('bim', 'temperature', 'firmware_version'))
+
+        assert output == {
+            'temperature': {'timestamp': 1.0, 'data': 0x31},
+            'firmware_version': {'timestamp': 1.0, 'data': 0x31}}
+
+    def test_priority(self):
+        release, thread = self.hold()
+        housekeeping = self.bus.submit_telemetry(
+            0x31, fields('bim', 'temperature'),
+            priority=bus.PRIORITY_HOUSEKEEPING)
+        telemetry = self.bus.submit_telemetry(
+            0x31, fields('bim', 'firmware_version'))
+        command = threading.Thread(
+            target=self.bus.write, args=(0x31, b'SUP:LED ON'))
+        command.start()
+        while not self.bus._pending.get(0x31) or \
+                len(self.bus._pending[0x31]) < 3:
+            time.sleep(0.01)
+        release.set()
+
+        command.join(2)
+        for future in housekeeping + telemetry:
+            future.result(2)
+        thread.join(2)
+        assert self.log == [
+            ('write', 0x31, b'SUP:LED ON'),
+            ('send', 0x31, 'firmware_version'),
+            ('send', 0x31, 'temperature')]
+
+    def test_coalesce(self):
+        release, thread = self.hold()
+        first = self.bus.submit_telemetry(
+            0x31, fields('bim', 'temperature'),
+            priority=bus.PRIORITY_HOUSEKEEPING)
+        other = self.bus.submit_telemetry(
+            0x31, fields('bim', 'firmware_version'))
+        second = self.bus.submit_telemetry(
+            0x31, fields('bim', 'temperature'), priority=bus.PRIORITY_COMMAND)
+        release.set()
+
+        assert first[0] is second[0]
+        assert self.bus.coalesced == 1
+        assert second[0].result(2) == {
+            'temperature': {'timestamp': 1.0, 'data': 0x31}}
+        other[0].result(2)
+        thread.join(2)
+        # Read once, bumped to the priority of the second request
+        assert [entry[2] for entry in self.log] == [
+            'temperature', 'firmware_version']
+
+    def test_error(self):
+        def fail(mcu, field, started, attempt):
+            raise IOError("No response")
+
+        with mock.patch.object(FakeMCU, '_check_ready', fail):
+            future = self.bus.submit_telemetry(
+                0x31, fields('bim', 'temperature'))[0]
+            with self.assertRaises(IOError):
+                future.result(2)
+        # A failed read isn't shared with later requests
+        assert self.bus.read_telemetry(
+            'bim', 0x31, fields('bim', 'temperature'))
+
+    def test_set_i2cfile(self):
+        self.bus.write(0x31, b'SUP:LED ON')
+        log = []
+
+        self.bus.set_i2cfile(log)
+        self.bus.write(0x31, b'SUP:LED OFF')
+
+        assert log == [('write', 0x31, b'SUP:LED OFF')]
+
+
+if __name__ == '__main__':
+    unittest.main()
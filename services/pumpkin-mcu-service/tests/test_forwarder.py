@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the Pumpkin MCU service telemetry forwarder.
+
+Run from the service directory, with the app API on the path:
+
+    $ PYTHONPATH=../../apis/app-api/python \
+        python -m pytest tests/test_forwarder.py
+"""
+
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+import mock
+
+import app_api
+from service import forwarder
+
+
+def fragments(timestamp=1.0):
+    return {
+        'temperature': {'temperature': {'timestamp': timestamp, 'data': 25}},
+        'imu': {
+            'gyro': {'timestamp': timestamp, 'data': [1, 2, 3]},
+            'accel': {'timestamp': timestamp, 'data': [4, 5, 6]}}}
+
+
+class ForwarderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(2)
+        self.addCleanup(self.sock.close)
+        (handle, path) = tempfile.mkstemp(suffix='.toml')
+        with os.fdopen(handle, 'w') as config:
+            config.write(
+                '[telemetry-service]\n'
+                'direct_port = {}\n'
+                '[telemetry-service.addr]\n'
+                'ip = "127.0.0.1"\n'
+                'port = 8020\n'.format(self.sock.getsockname()[1]))
+        self.addCleanup(os.remove, path)
+        self.services = app_api.Services(path)
+        self.addCleanup(self.services.close)
+
+    def forwarder(self, **config):
+        sender = forwarder.TelemetryForwarder(config, self.services)
+        self.addCleanup(sender.close)
+        return sender
+
+
+class TestUDP(ForwarderTestCase):
+
+    def test_payload(self):
+        sender = self.forwarder()
+
+        sender.submit('bim', fragments())
+        sender.close()
+
+        points = json.loads(self.sock.recv(app_api.TELEMETRY_DATAGRAM))
+        assert sorted((point['subsystem'], point['parameter'], point['value'])
+                      for point in points) == [
+            ('bim', 'accel', '[4, 5, 6]'),
+            ('bim', 'gyro', '[1, 2, 3]'),
+            ('bim', 'temperature', '25')]
+        assert all(isinstance(point['timestamp'], float) for point in points)
+        assert sender.stats()['sent'] == 3
+
+    def test_skipped(self):
+        sender = self.forwarder()
+
+        sender.submit('bim', fragments())
+        # Already forwarded, then not ready
+        sender.submit('bim', fragments())
+        sender.submit('bim', fragments(timestamp=0))
+
+        assert sender.stats()['queued'] == 3
+
+    def test_overflow(self):
+        sender = self.forwarder(buffer=2)
+
+        sender.submit('bim', fragments())
+
+        stats = sender.stats()
+        assert (stats['depth'], stats['dropped']) == (2, 1)
+
+
+class TestGraphQL(ForwarderTestCase):
+
+    def test_payload(self):
+        sender = self.forwarder(transport='graphql')
+        response = {'insertBulk': {'success': True, 'errors': ''}}
+
+        with mock.patch.object(self.services, 'query',
+                               return_value=response) as query:
+            sender.submit('bim', fragments())
+            sender.close()
+
+        assert query.call_args[1]['service'] == 'telemetry-service'
+        assert sorted(entry['parameter']
+                      for entry in query.call_args[1]['variables']['entries']) == [
+            'accel', 'gyro', 'temperature']
+        stats = sender.stats()
+        assert (stats['sent'], stats['transport']) == (3, 'graphql')
+
+    def test_transport(self):
+        with self.assertRaises(ValueError):
+            self.forwarder(transport='tcp')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Unit tests for the Pumpkin MCU service telemetry cache and batching.
+
+Run from the service directory, with the MCU API and I2C library on the
+path:
+
+    $ PYTHONPATH=../../apis/pumpkin-mcu-api:../../hal/python-hal/i2c \
+        python -m pytest tests/test_telemetry.py
+"""
+
+import json
+import unittest
+from concurrent.futures import Future
+
+import mock
+
+from service import schema, telemetry
+
+
+def reading(name, data=1):
+    return {name: {'timestamp': 1.0, 'data': data}}
+
+
+class FakeBus:
+    """
+    Bus manager answering every field straight away, and logging the fields
+    submitted per address.
+    """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit_telemetry(self, address, module_fields, priority=None):
+        self.submitted.append(
+            (address, sorted(field.name for field in module_fields)))
+        futures = []
+        for field in module_fields:
+            future = Future()
+            future.set_result(reading(field.name, address))
+            futures.append(future)
+        return futures
+
+
+class TelemetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = FakeBus()
+        patcher = mock.patch.object(telemetry, 'BUS', self.bus)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = telemetry.TelemetryCache()
+
+
+class TestTelemetryCache(TelemetryTestCase):
+
+    def test_ttl(self):
+        (commands, version) = telemetry.expand_fields(
+            'bim', ['commands_parsed', 'firmware_version'])
+        self.cache.set_ttl('bim', 'commands_parsed', 60)
+        self.cache.store('bim', {
+            'commands_parsed': reading('commands_parsed'),
+            'firmware_version': reading('firmware_version')})
+
+        output, missing = self.cache.lookup('bim', [commands, version])
+        assert output == reading('commands_parsed')
+        assert missing == [version]
+        output, missing = self.cache.lookup(
+            'bim', [commands, version], max_age=60)
+        assert missing == []
+        output, missing = self.cache.lookup('bim', [commands], max_age=0)
+        assert missing == [commands]
+
+    def test_expand_fields(self):
+        assert len(telemetry.expand_fields('bim', ['all'])) > 1
+        with self.assertRaises(KeyError):
+            telemetry.expand_fields('bim', ['unknown'])
+        with self.assertRaises(KeyError):
+            telemetry.expand_fields('unknown', ['all'])
+
+
+class TestTelemetryLoader(TelemetryTestCase):
+
+    def test_batch(self):
+        loader = telemetry.TelemetryLoader(self.cache)
+
+        values = loader.batch_load_fn([
+            ('bim', 0x31, ('commands_parsed',), 0),
+            ('bim', 0x31, ('commands_parsed', 'firmware_version'), 0),
+            ('pim', 0x53, ('firmware_version',), 0),
+            ('bim', 0x31, ('commands_parsed',), 0)]).get()
+
+        # One bus pass per module, each field read once
+        assert sorted(self.bus.submitted) == [
+            (0x31, ['commands_parsed', 'firmware_version']),
+            (0x53, ['firmware_version'])]
+        assert values[0] == values[3] == reading('commands_parsed', 0x31)
+        assert values[1] == dict(reading('commands_parsed', 0x31),
+                                 **reading('firmware_version', 0x31))
+        assert values[2] == reading('firmware_version', 0x53)
+
+    def test_cached(self):
+        loader = telemetry.TelemetryLoader(self.cache)
+        loader.batch_load_fn([('bim', 0x31, ('commands_parsed',), 0)]).get()
+
+        values = loader.batch_load_fn(
+            [('bim', 0x31, ('commands_parsed',), 60)]).get()
+
+        assert len(self.bus.submitted) == 1
+        assert values == [reading('commands_parsed', 0x31)]
+
+    def test_invalid_field(self):
+        loader = telemetry.TelemetryLoader(self.cache)
+
+        values = loader.batch_load_fn([
+            ('bim', 0x31, ('unknown',), 0),
+            ('bim', 0x31, ('commands_parsed',), 0)]).get()
+
+        assert isinstance(values[0], KeyError)
+        assert values[1] == reading('commands_parsed', 0x31)
+
+
+class TestSchema(TelemetryTestCase):
+
+    def setUp(self):
+        TelemetryTestCase.setUp(self)
+        patcher = mock.patch.multiple(
+            schema, CACHE=self.cache,
+            MODULES={'bim': {'address': 0x31}, 'pim': {'address': 0x53}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_aliases(self):
+        result = schema.schema.execute('''{
+            a: mcuTelemetry(module: "bim", fields: ["commands_parsed"], maxAge: 0)
+            b: mcuTelemetry(module: "bim", fields: ["commands_parsed", "firmware_version"], maxAge: 0)
+            c: mcuTelemetry(module: "pim", fields: ["firmware_version"], maxAge: 0)
+        }''')
+
+        assert result.errors is None
+        # One bus pass per module, each field read once
+        assert sorted(self.bus.submitted) == [
+            (0x31, ['commands_parsed', 'firmware_version']),
+            (0x53, ['firmware_version'])]
+        assert json.loads(result.data['a']) == reading('commands_parsed', 0x31)
+        assert json.loads(result.data['b']) == dict(
+            reading('commands_parsed', 0x31),
+            **reading('firmware_version', 0x31))
+        assert json.loads(result.data['c']) == reading('firmware_version', 0x53)
+
+    def test_unknown_module(self):
+        result = schema.schema.execute(
+            '{mcuTelemetry(module: "sim", fields: ["all"])}')
+
+        assert "not configured" in str(result.errors[0])
+        assert self.bus.submitted == []
+
+    def test_failure_logged(self):
+        with self.assertLogs('pumpkin-mcu-service', 'ERROR') as logs:
+            result = schema.schema.execute('''{
+                a: mcuTelemetry(module: "bim", fields: ["unknown"])
+                b: mcuTelemetry(module: "bim", fields: ["commands_parsed"], maxAge: 0)
+            }''')
+
+        assert len(result.errors) == 1
+        assert json.loads(result.data['b']) == reading('commands_parsed', 0x31)
+        assert len(logs.output) == 1
+        assert "Failed to read telemetry from bim" in logs.output[0]
+
+
+class TestPoller(TelemetryTestCase):
+
+    def test_poll(self):
+        poller = telemetry.Poller(
+            {'bim': {'address': 0x31}}, self.cache,
+            [{'module': 'bim', 'fields': ['commands_parsed'], 'period': 30}])
+
+        poller.poll(poller.groups)
+
+        output, missing = self.cache.lookup(
+            'bim', poller.groups[0].module_fields)
+        assert output == reading('commands_parsed', 0x31)
+        assert missing == []
+
+    def test_unknown_module(self):
+        with self.assertRaises(KeyError):
+            telemetry.Poller({}, self.cache, [{'module': 'bim', 'period': 30}])
+
+
+if __name__ == '__main__':
+    unittest.main()
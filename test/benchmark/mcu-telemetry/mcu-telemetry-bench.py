@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Copyright 2018 Kubos Corporation
+# Licensed under the Apache License, Version 2.0
+# See LICENSE file for details.
+
+"""
+Telemetry throughput benchmarks for the Pumpkin MCU API and service,
+run against a simulated SupMCU bus.
+"""
+
+import argparse
+import asyncio
+import threading
+import time
+
+import mcu_api
+import mcu_sim
+
+FIRST_ADDRESS = 0x50
+
+
+class Result:
+
+    def __init__(self, name, fields, elapsed, cpu, latencies):
+        self.name = name
+        self.fields = fields
+        self.elapsed = elapsed
+        self.cpu = cpu
+        self.latencies = sorted(latencies)
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(self.latencies) - 1)))
+        return self.latencies[index]
+
+    def row(self):
+        return "{:<28} | {:>10.1f} | {:>9.1f} | {:>9.1f} | {:>12.0f}".format(
+            self.name,
+            self.fields / self.elapsed,
+            self.percentile(50) * 1000,
+            self.percentile(99) * 1000,
+            self.cpu / self.fields * 1000000)
+
+
+def field_count(modules, fields):
+    registry = mcu_api.get_registry()
+    if fields == ["all"]:
+        return sum(len(registry.all_fields[module]) for module in modules)
+    return len(fields) * len(modules)
+
+
+def measure(name, args, modules, run, adaptive):
+    """
+    Runs run(bus, addresses) args.iterations times on a fresh simulated
+    bus and collects the results. run returns the number of fields it
+    served, or None for one read of each requested field.
+    """
+    addresses = {module: FIRST_ADDRESS + index
+                 for index, module in enumerate(modules)}
+    bus = mcu_sim.SimulatedBus(
+        {address: module for module, address in addresses.items()},
+        latency=(args.latency_min, args.latency_max),
+        bit_rate=args.bit_rate)
+    mcu_api.reset_latency_stats()
+    # Let adaptive mode learn the latencies before measuring
+    if adaptive and args.warmup:
+        run(bus, addresses)
+        bus.latencies = []
+
+    start = time.monotonic()
+    cpu = time.process_time()
+    fields = 0
+    for _ in range(args.iterations):
+        served = run(bus, addresses)
+        if served is None:
+            served = field_count(modules, args.fields)
+        fields += served
+    cpu = time.process_time() - cpu
+    elapsed = time.monotonic() - start
+    return Result(name, fields, elapsed, cpu, bus.latencies)
+
+
+def read_telemetry(args, adaptive):
+    def run(bus, addresses):
+        for module, address in addresses.items():
+            mcu = mcu_api.MCU(address=address, i2cfile=bus, adaptive=adaptive)
+            mcu.read_telemetry(module=module, fields=args.fields)
+    return run
+
+
+def scan_telemetry(args, adaptive):
+    def run(bus, addresses):
+        scan = mcu_api.TelemetryScan()
+        for module, address in addresses.items():
+            scan.add(module=module, fields=args.fields, mcu=mcu_api.MCU(
+                address=address, i2cfile=bus, adaptive=adaptive))
+        scan.run()
+        if scan.errors:
+            raise list(scan.errors.values())[0]
+    return run
+
+
+def async_scan(args, adaptive):
+    async def scan(bus, addresses):
+        await asyncio.gather(*[
+            mcu_api.AsyncMCU(
+                address=address, i2cfile=bus, adaptive=adaptive
+            ).read_telemetry(module=module, fields=args.fields)
+            for module, address in addresses.items()])
+
+    def run(bus, addresses):
+        asyncio.run(scan(bus, addresses))
+    return run
+
+
+def service_queries(args, adaptive):
+    """
+    Runs mcuTelemetry queries through the Pumpkin MCU service schema, one
+    client thread per module and args.clients threads in total.
+    """
+    from service import bus as service_bus
+    from service import schema
+
+    def run(bus, addresses):
+        default = mcu_api.ADAPTIVE_DELAY
+        mcu_api.ADAPTIVE_DELAY = adaptive
+        try:
+            return serve(bus, addresses)
+        finally:
+            mcu_api.ADAPTIVE_DELAY = default
+
+    def serve(bus, addresses):
+        service_bus.BUS.set_i2cfile(bus)
+        schema.MODULES = {module: {"address": address}
+                          for module, address in addresses.items()}
+        errors = []
+
+        def client(module):
+            query = '{{mcuTelemetry(module: "{}", fields: {}, maxAge: 0)}}'
+            result = schema.schema.execute(query.format(
+                module, str(args.fields).replace("'", '"')))
+            if result.errors:
+                errors.extend(result.errors)
+
+        modules = list(addresses)
+        clients = [modules[index % len(modules)]
+                   for index in range(max(args.clients, len(modules)))]
+        threads = [threading.Thread(target=client, args=(module,))
+                   for module in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise Exception(errors[0])
+        # Every client is served its fields, coalesced on the bus or not
+        return sum(field_count([module], args.fields) for module in clients)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--modules', default="pim,bim,bsm,epsm",
+                        help='Comma separated list of modules to read')
+    parser.add_argument('-f', '--fields', default="all",
+                        help='Comma separated list of fields, or "all"')
+    parser.add_argument('-i', '--iterations', type=int, default=1)
+    parser.add_argument('-d', '--delay', type=float, default=mcu_api.DELAY,
+                        help='Fixed settle DELAY in seconds')
+    parser.add_argument('--latency-min', type=float, default=0.005,
+                        help='Shortest simulated settle latency in seconds')
+    parser.add_argument('--latency-max', type=float, default=0.050,
+                        help='Longest simulated settle latency in seconds')
+    parser.add_argument('--bit-rate', type=int, default=100000,
+                        help='Simulated I2C clock, 0 for instant transfers')
+    parser.add_argument('--clients', type=int, default=1,
+                        help='Concurrent clients for the service benchmark')
+    parser.add_argument('--no-warmup', dest='warmup', action='store_false')
+    parser.add_argument('--no-service', dest='service', action='store_false',
+                        help='Skip the pumpkin-mcu-service benchmark')
+    args = parser.parse_args()
+    args.fields = args.fields.split(',')
+    modules = args.modules.split(',')
+    mcu_api.DELAY = args.delay
+
+    benchmarks = [
+        ("read_telemetry_fixed", read_telemetry, False),
+        ("read_telemetry_adaptive", read_telemetry, True),
+        ("scan_telemetry_fixed", scan_telemetry, False),
+        ("scan_telemetry_adaptive", scan_telemetry, True),
+        ("async_scan_adaptive", async_scan, True),
+    ]
+    if args.service:
+        try:
+            import service.schema
+            benchmarks += [
+                ("service_fixed", service_queries, False),
+                ("service_adaptive", service_queries, True),
+            ]
+        except ImportError as e:
+            print("Skipping service benchmarks: {}".format(e))
+
+    print("{:<28} | {:>10} | {:>9} | {:>9} | {:>12}".format(
+        "NAME", "fields/s", "p50 (ms)", "p99 (ms)", "CPU/field (us)"))
+    print("-" * 81)
+    for name, benchmark, adaptive in benchmarks:
+        result = measure(
+            name, args, modules, benchmark(args, adaptive), adaptive)
+        print(result.row())
+
+
+if __name__ == "__main__":
+    main()